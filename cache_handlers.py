@@ -0,0 +1,353 @@
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlparse
+
+
+class CacheHandler:
+    __name__ = "CacheHandler"
+
+
+    def parse_args(self, parser: argparse.ArgumentParser) -> dict:
+        args, _ = parser.parse_known_args()
+        args = vars(args)
+        return args
+
+
+class BasemapTileCache(CacheHandler):
+    """
+    Size-bounded LRU cache of basemap tiles stored as blobs in a single
+    SQLite file. Tiles are keyed by `(mosaic name, z, x, y, proc)` and their
+    contents are content-addressed, so identical tiles (e.g. empty ocean
+    tiles repeated across months) are stored once.
+
+    The SQLite file is only opened when the cache is first used. Access 
+    times of hits are buffered and written in batches, so hits do not 
+    commit. Methods block, so call them from a thread rather than from an 
+    event loop.
+    """
+    __name__ = "BasemapTileCache"
+
+    DEFAULT_TILE_CACHE_PATH: str = "datasets/basemap_tile_cache.sqlite3"
+    DEFAULT_TILE_CACHE_MAX_GB: float = 10.0
+    # Evict down to this fraction of the size limit to amortize evictions
+    EVICTION_TARGET_FRACTION: float = 0.9
+    # Lists of available mosaics are refreshed after this many seconds
+    MOSAIC_NAMES_MAX_AGE: float = 24 * 60 * 60
+    # Buffered access times are written once this many hits have accrued
+    ACCESS_FLUSH_SIZE: int = 1024
+
+
+    def __init__(
+        self, path: Optional[str] = None, max_gb: Optional[float] = None
+    ):
+        args = self.parse_args()
+        if path is None:
+            path = args["tile_cache_path"]
+        if max_gb is None:
+            max_gb = args["tile_cache_max_gb"]
+        self.path = path
+        self.max_bytes = int(float(max_gb) * 1e9)
+        self.enabled = bool(path)
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+        self.num_negative_hits = 0
+
+        self._lock = threading.Lock()
+        self._conn = None
+        self._total_bytes = 0
+        self._pending_accesses = dict()
+
+        self.args = args
+
+
+    def parse_args(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            "--tile-cache-path",
+            default=self.DEFAULT_TILE_CACHE_PATH,
+            help="Path to the SQLite basemap tile cache. Pass an empty " \
+                "string to disable caching."
+        )
+        parser.add_argument(
+            "--tile-cache-max-gb",
+            default=self.DEFAULT_TILE_CACHE_MAX_GB,
+            type=float
+        )
+        args = super().parse_args(parser=parser)
+        return args
+
+
+    @staticmethod
+    def _connect(path: str) -> sqlite3.Connection:
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS tiles (
+                key TEXT PRIMARY KEY, digest TEXT NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS tiles_last_access ON tiles (last_access)"
+        )
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY, data BLOB NOT NULL,
+                size INTEGER NOT NULL, refcount INTEGER NOT NULL
+            )"""
+        )
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS missing_tiles (
+                key TEXT PRIMARY KEY, recorded_at REAL NOT NULL
+            )"""
+        )
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS mosaic_names (
+                name TEXT PRIMARY KEY, fetched_at REAL NOT NULL
+            )"""
+        )
+        conn.commit()
+        return conn
+
+
+    def _get_total_bytes(self) -> int:
+        (total_bytes,) = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM blobs"
+        ).fetchone()
+        return total_bytes
+
+
+    def _get_conn(self) -> sqlite3.Connection:
+        # Called with `self._lock` held
+        if self._conn is None:
+            self._conn = self._connect(self.path)
+            self._total_bytes = self._get_total_bytes()
+        return self._conn
+
+
+    def _flush_accesses(self) -> None:
+        # Called with `self._lock` held; the caller commits
+        if self._pending_accesses:
+            self._get_conn().executemany(
+                "UPDATE tiles SET last_access = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._pending_accesses.items()]
+            )
+            self._pending_accesses.clear()
+
+
+    @staticmethod
+    def make_key(
+        mosaic_name: str, z: int, x: int, y: int, proc: Optional[str] = None
+    ) -> str:
+        return f"{mosaic_name}/{z}/{x}/{y}/{proc or ''}"
+
+
+    @classmethod
+    def get_key_from_url(cls, request_url: str) -> str:
+        """
+        Builds the cache key from a basemap tile URL of the form
+        `.../{mosaic_name}/gmap/{z}/{x}/{y}.png?api_key=...&proc=...`.
+        The API key is not part of the key.
+        """
+        parsed = urlparse(request_url)
+        parts = parsed.path.rstrip("/").split("/")
+        mosaic_name, z, x, y = parts[-5], parts[-3], parts[-2], parts[-1]
+        y = os.path.splitext(y)[0]
+        proc = parse_qs(parsed.query).get("proc", [None])[0]
+        return cls.make_key(mosaic_name, int(z), int(x), int(y), proc)
+
+
+    def get(self, key: str) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            conn = self._get_conn()
+            row = conn.execute(
+                """SELECT blobs.data FROM tiles
+                JOIN blobs ON tiles.digest = blobs.digest WHERE tiles.key = ?""",
+                (key,)
+            ).fetchone()
+            if row is None:
+                self.num_misses += 1
+                return None
+            self._pending_accesses[key] = time.time()
+            if len(self._pending_accesses) >= self.ACCESS_FLUSH_SIZE:
+                self._flush_accesses()
+                conn.commit()
+            self.num_hits += 1
+            return bytes(row[0])
+
+
+    def _release_digest(self, digest: str) -> None:
+        self._conn.execute(
+            "UPDATE blobs SET refcount = refcount - 1 WHERE digest = ?", (digest,)
+        )
+        row = self._conn.execute(
+            "SELECT size FROM blobs WHERE digest = ? AND refcount <= 0", (digest,)
+        ).fetchone()
+        if row is not None:
+            self._conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+            self._total_bytes -= row[0]
+
+
+    def set(self, key: str, data: bytes) -> None:
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._get_conn()
+            row = self._conn.execute(
+                "SELECT digest FROM tiles WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                if row[0] == digest:
+                    return
+                self._release_digest(row[0])
+            updated = self._conn.execute(
+                "UPDATE blobs SET refcount = refcount + 1 WHERE digest = ?",
+                (digest,)
+            ).rowcount
+            if not updated:
+                self._conn.execute(
+                    "INSERT INTO blobs (digest, data, size, refcount) VALUES (?, ?, ?, 1)",
+                    (digest, sqlite3.Binary(data), len(data))
+                )
+                self._total_bytes += len(data)
+            self._pending_accesses.pop(key, None)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tiles (key, digest, last_access) VALUES (?, ?, ?)",
+                (key, digest, time.time())
+            )
+            if self._total_bytes > self.max_bytes:
+                # Evict by up-to-date access times
+                self._flush_accesses()
+                self._evict(int(self.max_bytes * self.EVICTION_TARGET_FRACTION))
+            self._conn.commit()
+
+
+    def _evict(self, target_bytes: int) -> None:
+        while self._total_bytes > target_bytes:
+            rows = self._conn.execute(
+                "SELECT key, digest FROM tiles ORDER BY last_access ASC LIMIT 1024"
+            ).fetchall()
+            if not rows:
+                break
+            for key, digest in rows:
+                if self._total_bytes <= target_bytes:
+                    break
+                self._conn.execute("DELETE FROM tiles WHERE key = ?", (key,))
+                self._release_digest(digest)
+                self.num_evictions += 1
+
+
+    def is_missing(self, key: str) -> bool:
+        """
+        Returns True if a previous request for `key` returned a 404.
+        """
+        if not self.enabled:
+            return False
+        with self._lock:
+            row = self._get_conn().execute(
+                "SELECT 1 FROM missing_tiles WHERE key = ?", (key,)
+            ).fetchone()
+        if row is not None:
+            self.num_negative_hits += 1
+            return True
+        return False
+
+
+    def set_missing(self, key: str) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._get_conn().execute(
+                "INSERT OR REPLACE INTO missing_tiles (key, recorded_at) VALUES (?, ?)",
+                (key, time.time())
+            )
+            self._conn.commit()
+
+
+    def get_mosaic_names(self) -> Optional[Set[str]]:
+        """
+        Returns the cached names of available mosaics, or None if they have 
+        not been cached or are older than `MOSAIC_NAMES_MAX_AGE` seconds.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            rows = self._get_conn().execute(
+                "SELECT name FROM mosaic_names WHERE fetched_at >= ?",
+                (time.time() - self.MOSAIC_NAMES_MAX_AGE,)
+            ).fetchall()
+        if not rows:
+            return None
+        return {name for (name,) in rows}
+
+
+    def set_mosaic_names(self, names: Iterable[str]) -> None:
+        if not self.enabled:
+            return
+        fetched_at = time.time()
+        with self._lock:
+            self._get_conn().execute("DELETE FROM mosaic_names")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO mosaic_names (name, fetched_at) VALUES (?, ?)",
+                ((name, fetched_at) for name in names)
+            )
+            self._conn.commit()
+
+
+    def get_stats(self) -> Tuple[int, int, int, int]:
+        return (
+            self.num_hits, self.num_misses, self.num_evictions, 
+            self.num_negative_hits
+        )
+
+
+    def log_stats(self) -> None:
+        if not self.enabled or self._conn is None:
+            return
+        num_lookups = self.num_hits + self.num_misses
+        hit_rate = self.num_hits / num_lookups if num_lookups else 0.0
+        logging.info(
+            f"Basemap tile cache {self.path}: {self.num_hits} hits, " \
+            f"{self.num_misses} misses ({hit_rate:.1%} hit rate), " \
+            f"{self.num_evictions} evictions, {self.num_negative_hits} " \
+            f"known-missing tiles skipped, {self._total_bytes} bytes stored."
+        )
+
+
+    def flush(self) -> None:
+        """
+        Writes buffered access times.
+        """
+        if self._conn is None:
+            return
+        with self._lock:
+            self._flush_accesses()
+            self._conn.commit()
+
+
+    def close(self) -> None:
+        if self._conn is not None:
+            with self._lock:
+                self._flush_accesses()
+                self._conn.commit()
+                self._conn.close()
+            self._conn = None
+            self.enabled = False
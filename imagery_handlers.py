@@ -3,21 +3,30 @@ __author__ = "Richard Correro (richard@richardcorrero.com)"
 
 import argparse
 import asyncio
+import concurrent.futures
 import datetime
+import functools
 import io
 import json
 import logging
-from collections import OrderedDict
+import multiprocessing
+import os
 from typing import Generator, List, Optional, Tuple, Set
 
 import aiohttp
 # import requests
-from light_pipe import AsyncGatherer, Data, Transformer
+from light_pipe import (BlockingProcessPooler, BlockingThreadPooler, Data,
+                        Transformer)
+import numpy as np
 from PIL import Image, ImageDraw
 import pandas as pd
 
-from light_pipe_geo import mercantile
-from light_pipe_rest import AiohttpGatherer
+from cache_handlers import BasemapTileCache
+from ledger_handlers import TileLedger
+from memory_handlers import MemoryGovernor
+from prefetch_handlers import ScenePrefetcher
+from light_pipe_geo import gridding, mercantile, raster_io, spectral
+from light_pipe_rest import AiohttpGatherer, BoundedAsyncGatherer
 from sample_handlers import QuadKeyTileHandler, StandardTileHandler
 from script_utils import get_random_string
 from storage_handlers import (AWSStorage, GCSStorage, LocalStorage,
@@ -25,6 +34,134 @@ from storage_handlers import (AWSStorage, GCSStorage, LocalStorage,
 from target_handlers import GeoJsonHandler
 
 
+IMAGE_FORMAT_SIGNATURES = {
+    "png": b"\x89PNG\r\n\x1a\n",
+    "jpeg": b"\xff\xd8\xff",
+    "gif": b"GIF8"
+}
+
+
+def get_image_format_from_bytes(bs: bytes) -> Optional[str]:
+    for image_format, signature in IMAGE_FORMAT_SIGNATURES.items():
+        if bs[:len(signature)] == signature:
+            return image_format
+    return None
+
+
+def make_shared_palette(images: List[Image.Image], num_colors: Optional[int] = 256) -> Image.Image:
+    """
+    Quantizes all frames of a timelapse together so every GIF frame can 
+    reuse one palette instead of computing its own.
+    """
+    width = max(image.width for image in images)
+    height = sum(image.height for image in images)
+    montage = Image.new("RGB", (width, height))
+    yoff = 0
+    for image in images:
+        montage.paste(image.convert("RGB"), (0, yoff))
+        yoff += image.height
+    return montage.quantize(colors=num_colors)
+
+
+def _encode_mosaic_responses(
+    input, dates: List[str], duration, make_gifs: Optional[bool] = False,
+    save_images: Optional[bool] = True, embed_date: Optional[bool] = True, 
+    image_format: Optional[str] = "png", 
+    local_indices: Optional[List[str]] = None
+) -> Tuple:
+    """
+    Decodes the monthly mosaics of a single tile, draws the date overlay and 
+    encodes the timelapse and per-month images. Returns encoded bytes only 
+    so that it can be run in a separate process. Responses already in 
+    `image_format` are passed through without being decoded when no overlay 
+    is drawn. Each of `local_indices` is computed from the RGB bands of all 
+    months at once and saved as a colormapped PNG per month.
+    """
+    responses, z, x, y, geojson_name = input
+    # Months whose mosaic is missing for this tile are None
+    pairs = [
+        (date, response) for date, response in zip(dates, responses) 
+        if response is not None
+    ]
+    dates = [date for date, _ in pairs]
+    responses = [response for _, response in pairs]
+    image_format = image_format.lower()
+    if image_format == "jpg":
+        image_format = "jpeg"
+    passthrough = [
+        not embed_date and get_image_format_from_bytes(response) == image_format
+        for response in responses
+    ]
+
+    images = list()
+    rgb_arrays = list()
+    for date, response, is_passthrough in zip(dates, responses, passthrough):
+        if is_passthrough and not make_gifs and not local_indices:
+            images.append(None)
+            continue
+        img = Image.open(io.BytesIO(response))
+        if local_indices:
+            # Read before the overlay is drawn
+            rgb_arrays.append(np.asarray(img.convert("RGB")))
+        if embed_date:
+            year, month = date.split("_")
+            draw = ImageDraw.Draw(img)
+            draw.text((0, 0),f"{year} {month} {z} {x} {y}",(255,255,255))
+        images.append(img)
+
+    timelapse_bytes = None
+    if make_gifs and images:
+        palette = make_shared_palette(images)
+        frames = [image.convert("RGB").quantize(palette=palette) for image in images]
+        bs = io.BytesIO()
+        frames[0].save(fp=bs, format='GIF', append_images=frames[1:],
+                save_all=True, duration=duration, loop=0, interlace=False,
+                include_color_table=True, optimize=False)
+        timelapse_bytes = bs.getvalue()
+
+    images_bytes = list()
+    if save_images:
+        for date, response, image, is_passthrough in zip(
+            dates, responses, images, passthrough
+        ):
+            if is_passthrough:
+                images_bytes.append((date, response, image_format))
+                continue
+            if image_format == "jpeg" and image.mode != "RGB":
+                image = image.convert("RGB")
+            bs = io.BytesIO()
+            image.save(fp=bs, format=image_format)
+            images_bytes.append((date, bs.getvalue(), image_format))
+
+    if local_indices and rgb_arrays:
+        indices = spectral.compute_indices(
+            np.stack(rgb_arrays), local_indices, band_map=spectral.RGB_BAND_MAP,
+            scale=spectral.RGB_SCALE, band_axis=-1
+        )
+        for index_name, colors in spectral.colormap_indices(indices).items():
+            for date, rgba in zip(dates, colors):
+                bs = io.BytesIO()
+                Image.fromarray(rgba, mode="RGBA").save(fp=bs, format="png")
+                images_bytes.append((f"{date}_{index_name}", bs.getvalue(), "png"))
+    return timelapse_bytes, images_bytes, z, x, y, geojson_name
+
+
+def encode_mosaic_responses(input, *args, **kwargs) -> Tuple:
+    """
+    Wraps `_encode_mosaic_responses()` so that a tile which failed upstream
+    or fails to encode does not stop the pipeline. The last element of the
+    returned tuple is the encoding error, if any.
+    """
+    responses, z, x, y, geojson_name = input
+    if responses is None: # Fetching failed and has already been recorded
+        return None, None, z, x, y, geojson_name, None
+    try:
+        encoded = _encode_mosaic_responses(input, *args, **kwargs)
+    except Exception as e:
+        return None, None, z, x, y, geojson_name, repr(e)
+    return (*encoded, None)
+
+
 class ImageryHandler:
     __name__ = "ImageryHandler"
 
@@ -81,13 +218,14 @@ class PlanetScope(ImageryHandler):
     MANIFEST_NAME: str = "order_manifest.json"
     RESPONSE_MANIFEST_NAME: str = "order_responses.json"
 
+    BASEMAPS_MOSAICS_URL: str = "https://api.planet.com/basemaps/v1/mosaics"
+    MONTHLY_MOSAIC_NAME_FORMAT: str = "global_monthly_{}_mosaic"
+
     TIMELAPSES_SUB_DIR: str = "gifs/"
     PNGS_SUB_DIR: str = "pngs/"
     TRUNCATE = True
 
-    VALID_FC_INDICES = [
-        "ndvi", "ndwi", "msavi2", "mtvi2", "vari", "tgi"
-    ]
+    VALID_FC_INDICES = list(spectral.SPECTRAL_INDICES.keys())
 
     TILES_DIR = "tiles/"
 
@@ -136,6 +274,11 @@ class PlanetScope(ImageryHandler):
         SampleHandler = self.SAMPLE_HANDLERS[sample_handler_name]
         self.sample_handler = SampleHandler()
 
+        self.tile_cache = BasemapTileCache()
+        self._available_mosaic_names = None
+        self._mosaic_time_strs = dict()
+        self.tile_ledger = None
+
         self.args = args        
 
 
@@ -227,7 +370,8 @@ class PlanetScope(ImageryHandler):
             **self.args, 
             **self.target_handler.args, 
             **self.storage_handler.args,
-            **self.sample_handler.args
+            **self.sample_handler.args,
+            **self.tile_cache.args
         }
         return args
 
@@ -675,10 +819,24 @@ class PlanetScope(ImageryHandler):
         return asset_id, geojson, img_bs, udm_bs
 
 
+    def _get_asset_openers(self, input, storage_handler: StorageHandler):
+        """
+        Defers reading each scene until it is cut into tiles, at which point
+        `storage_handler` opens it as a GDAL dataset without intermediate 
+        copies.
+        """
+        asset_id, geojson, img_path, udm_path = input
+        img_opener = functools.partial(storage_handler.open_as_gdal_dataset, img_path)
+        udm_opener = functools.partial(storage_handler.open_as_gdal_dataset, udm_path)
+        return asset_id, geojson, img_opener, udm_opener
+
+
     def prepare_samples(
         self, manifest_path: str, train: Optional[bool] = True,  
         from_cloud_storage: Optional[bool] = True, src_base_dir: Optional[str] = None,
-        ext: str = ".tif", zooms: Optional[List[int]] = [15], truncate: Optional[bool] = True
+        ext: str = ".tif", zooms: Optional[List[int]] = [15], truncate: Optional[bool] = True,
+        prefetch_scenes: Optional[int] = 0, prefetch_decode: Optional[bool] = False,
+        memory_budget_gb: Optional[float] = None
     ):
         if from_cloud_storage:
             StorageHandler = self.STORAGE_HANDLERS[GCSStorage.__name__]
@@ -696,8 +854,30 @@ class PlanetScope(ImageryHandler):
             self.load_order_manifest, path=manifest_path
         )
 
-        data >> Transformer(self._get_asset_paths_from_list, paths=paths) \
-             >> Transformer(self._get_assets_as_bytes, storage_handler=storage_handler)
+        data >> Transformer(self._get_asset_paths_from_list, paths=paths)
+        prefetcher = None
+        if prefetch_scenes > 0:
+            # Fetch up to `prefetch_scenes` assets ahead of the one being tiled
+            governor = None
+            if memory_budget_gb:
+                governor = MemoryGovernor(budget_bytes=memory_budget_gb * 1e9)
+            prefetcher = ScenePrefetcher(
+                storage_handler, decode=prefetch_decode, governor=governor
+            )
+            data >> Transformer(
+                prefetcher.fetch_asset, parallelizer=BlockingThreadPooler(
+                    max_workers=prefetch_scenes, queue_size=prefetch_scenes
+                )
+            )
+        else:
+            if memory_budget_gb:
+                # Each asset is fetched only when it is tiled, so there is 
+                # never more than one in flight to hold back
+                logging.warning(
+                    f"Ignoring the memory budget of {memory_budget_gb} GB, " \
+                    "which only applies when scenes are prefetched."
+                )
+            data >> Transformer(self._get_asset_openers, storage_handler=storage_handler)
             #  >> Transformer(self._get_tiles_from_bytes, zooms=zooms, truncate=truncate)
 
 
@@ -706,6 +886,8 @@ class PlanetScope(ImageryHandler):
             storage_handler=self.storage_handler,
             train=train, zooms=zooms, truncate=truncate
         )
+        if prefetcher is not None:
+            prefetcher.log_stats()
 
         # data >> Transformer(self._save_samples, save_dir=self.save_dir)        
 
@@ -715,14 +897,88 @@ class PlanetScope(ImageryHandler):
         return (start, end), path, bs     
 
 
-    def get_mosaic_time_str_from_start_end(self, start, end):
-        dates = [start, end]
-        start, end = [datetime.datetime.strptime(_, "%Y_%m") for _ in dates]
-        return OrderedDict(((start + datetime.timedelta(_)).strftime(r"%Y_%m"), None) for _ in range((end - start).days)).keys()
+    def get_mosaic_time_str_from_start_end(self, start, end) -> List[str]:
+        """
+        Returns the `YYYY_MM` strings of the months from `start` up to but 
+        not including `end`.
+        """
+        start, end = [datetime.datetime.strptime(_, "%Y_%m") for _ in (start, end)]
+        start_i = start.year * 12 + start.month - 1
+        end_i = end.year * 12 + end.month - 1
+        return [f"{i // 12:04d}_{i % 12 + 1:02d}" for i in range(start_i, end_i)]
+
+
+    async def _get_available_mosaic_names(self) -> Set[str]:
+        names = set()
+        url = self.BASEMAPS_MOSAICS_URL
+        params = {
+            "api_key": self.planet_api_key, 
+            "name__contains": "global_monthly_"
+        }
+        async with aiohttp.ClientSession() as session:
+            while url:
+                async with session.get(url, params=params) as response:
+                    response.raise_for_status()
+                    page = await response.json()
+                names.update(mosaic["name"] for mosaic in page.get("mosaics", list()))
+                url = page.get("_links", dict()).get("_next")
+                params = None # The next-page link already carries the query
+        return names
 
 
-    def make_papi_monthly_mosaic_requests(self, tiles, geojson, start, end, false_color_index):
-        if geojson:
+    def get_available_mosaic_names(self) -> Optional[Set[str]]:
+        """
+        Returns the names of the available monthly basemap mosaics, reading 
+        them from the tile cache when possible. Returns None if they cannot 
+        be listed, in which case requested months are not validated.
+        """
+        if self._available_mosaic_names is None:
+            names = self.tile_cache.get_mosaic_names()
+            if names is None:
+                try:
+                    names = asyncio.run(self._get_available_mosaic_names())
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logging.warning(
+                        f"Could not list available basemap mosaics: {e}. " \
+                        "Requested months will not be validated."
+                    )
+                    return None
+                self.tile_cache.set_mosaic_names(names)
+            self._available_mosaic_names = names
+        return self._available_mosaic_names
+
+
+    def get_mosaic_time_strs(self, start, end) -> List[str]:
+        """
+        Returns the months from `start` to `end` for which a monthly mosaic 
+        exists. Computed once per `(start, end)` and shared by all tiles.
+        """
+        if (start, end) not in self._mosaic_time_strs:
+            time_strs = self.get_mosaic_time_str_from_start_end(start, end)
+            names = self.get_available_mosaic_names()
+            if names:
+                missing = [
+                    time_str for time_str in time_strs 
+                    if self.MONTHLY_MOSAIC_NAME_FORMAT.format(time_str) not in names
+                ]
+                if missing:
+                    logging.warning(
+                        f"Skipping months without a monthly mosaic: {missing}"
+                    )
+                time_strs = [
+                    time_str for time_str in time_strs if time_str not in missing
+                ]
+            self._mosaic_time_strs[(start, end)] = time_strs
+        return self._mosaic_time_strs[(start, end)]
+
+
+    def make_papi_monthly_mosaic_requests(
+        self, tiles, geojson, start, end, false_color_index, 
+        geojson_name: Optional[str] = None
+    ):
+        if geojson_name is not None:
+            pass
+        elif geojson:
             try:
                 geojson_name = geojson["name"]
             except KeyError:
@@ -734,8 +990,9 @@ class PlanetScope(ImageryHandler):
             x = tile.x
             y = tile.y            
             request_urls = list()
-            for year_month in self.get_mosaic_time_str_from_start_end(start, end):
-                request_url = f"https://tiles.planet.com/basemaps/v1/planet-tiles/global_monthly_{year_month}_mosaic/gmap/{z}/{x}/{y}.png?api_key={self.planet_api_key}"
+            for year_month in self.get_mosaic_time_strs(start, end):
+                mosaic_name = self.MONTHLY_MOSAIC_NAME_FORMAT.format(year_month)
+                request_url = f"https://tiles.planet.com/basemaps/v1/planet-tiles/{mosaic_name}/gmap/{z}/{x}/{y}.png?api_key={self.planet_api_key}"
                 if false_color_index:
                     request_url += f"&proc={false_color_index}"
                 request_urls.append(request_url)
@@ -761,6 +1018,31 @@ class PlanetScope(ImageryHandler):
         yield from requests         
 
 
+    def _make_monthly_mosaic_requests_from_ledger_entry(
+        self, entry: Tuple, start: str, end: str, false_color_index
+    ) -> Generator:
+        z, x, y, geojson_name = entry
+        tiles = [mercantile.Tile(x=x, y=y, z=z)]
+        requests = self.make_papi_monthly_mosaic_requests(
+            tiles=tiles, geojson=None, start=start, end=end, 
+            false_color_index=false_color_index, geojson_name=geojson_name
+        )
+        yield from requests
+
+
+    def _record_tile_failure(
+        self, z, x, y, geojson_name, stage: str, error: Optional[str] = None
+    ) -> None:
+        if self.tile_ledger is not None:
+            self.tile_ledger.record_failure(
+                z, x, y, geojson_name, stage=stage, error=error
+            )
+        else:
+            logging.warning(
+                f"Tile {z}/{x}/{y} ({geojson_name}) failed while {stage}: {error}"
+            )
+
+
     # def post_monthly_mosaic_request(self, input):
     #     request_urls, z, x, y, geojson_name = input
     #     responses = list()
@@ -771,16 +1053,86 @@ class PlanetScope(ImageryHandler):
     #     return responses, z, x, y, geojson_name
 
 
-    async def post_monthly_mosaic_request(self, input):
-        request_urls, z, x, y, geojson_name = input
-        responses = list()
-        async with aiohttp.ClientSession() as session:
-            for request_url in request_urls:
+    async def _get_basemap_tile(
+        self, session: aiohttp.ClientSession, request_url: str, key: str,
+        max_retries: Optional[int] = 3, retry_base_delay: Optional[float] = 1.0
+    ) -> Optional[bytes]:
+        """
+        Fetches a single basemap tile, retrying server errors, rate limits 
+        and connection errors with exponential backoff. Returns None if the 
+        tile does not exist.
+        """
+        for attempt in range(max_retries + 1):
+            try:
                 async with session.get(request_url) as response:
+                    if response.status == 404:
+                        await asyncio.get_running_loop().run_in_executor(
+                            None, self.tile_cache.set_missing, key
+                        )
+                        return None
                     response.raise_for_status()
-                    content = await response.read()
-                    responses.append(content)
-                    # print(response)
+                    return await response.read()
+            except aiohttp.ClientResponseError as e:
+                retryable = e.status >= 500 or e.status == 429
+                if not retryable or attempt >= max_retries:
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= max_retries:
+                    raise
+            await asyncio.sleep(retry_base_delay * 2 ** attempt)
+
+
+    def _get_cached_tiles(self, keys: List[str]) -> Tuple[List, List[int]]:
+        """
+        Returns the cached tiles of `keys` (None where missing) and the
+        indices of those which should be fetched.
+        """
+        responses = [self.tile_cache.get(key) for key in keys]
+        to_fetch = [
+            i for i, (response, key) in enumerate(zip(responses, keys)) 
+            if response is None and not self.tile_cache.is_missing(key)
+        ]
+        return responses, to_fetch
+
+
+    async def post_monthly_mosaic_request(
+        self, input, max_retries: Optional[int] = 3, 
+        retry_base_delay: Optional[float] = 1.0
+    ):
+        request_urls, z, x, y, geojson_name = input
+        keys = [self.tile_cache.get_key_from_url(url) for url in request_urls]
+        # Cache calls block on SQLite, so they run off the event loop which
+        # drives every in-flight fetch
+        loop = asyncio.get_running_loop()
+        responses, to_fetch = await loop.run_in_executor(
+            None, self._get_cached_tiles, keys
+        )
+        if not to_fetch:
+            return responses, z, x, y, geojson_name
+        try:
+            async with aiohttp.ClientSession() as session:
+                for i in to_fetch:
+                    # Missing months are left as None and skipped when saving
+                    content = await self._get_basemap_tile(
+                        session, request_urls[i], keys[i], 
+                        max_retries=max_retries, retry_base_delay=retry_base_delay
+                    )
+                    if content is not None:
+                        await loop.run_in_executor(
+                            None, self.tile_cache.set, keys[i], content
+                        )
+                    responses[i] = content
+        except Exception as e:
+            # Months fetched before the failure stay in the tile cache. 
+            # Request URLs carry the API key and are left out of the error
+            if isinstance(e, aiohttp.ClientResponseError):
+                error = f"HTTP {e.status} {e.message}"
+            else:
+                error = f"{type(e).__name__}: {e}"
+            self._record_tile_failure(
+                z, x, y, geojson_name, stage="fetching", error=error
+            )
+            return None, z, x, y, geojson_name
         return responses, z, x, y, geojson_name     
 
 
@@ -843,49 +1195,100 @@ class PlanetScope(ImageryHandler):
     #         self.storage_handler.set_from_bytes(path, bs)
 
 
+    def write_encoded_responses(
+        self, input, start, end, timelapse_format: Optional[str] = "gif"
+    ) -> None:
+        timelapse_bytes, images_bytes, z, x, y, geojson_name, error = input
+        if images_bytes is None:
+            if error is not None:
+                self._record_tile_failure(
+                    z, x, y, geojson_name, stage="encoding", error=error
+                )
+            return
+        try:
+            if timelapse_bytes is not None:
+                timelapse_filename = f"{start}_{end}/{z}/{geojson_name}/{z}_{x}_{y}/{z}_{x}_{y}_{start}_{end}.{timelapse_format}"
+                path = self.storage_handler.join_paths(self.save_dir, self.TIMELAPSES_SUB_DIR, timelapse_filename)
+                self.storage_handler.set_from_bytes(path, io.BytesIO(timelapse_bytes))
+
+            for date, image_bytes, extension in images_bytes:
+                image_path = f"{start}_{end}/{z}/{geojson_name}/{z}_{x}_{y}/{z}_{x}_{y}_{date}.{extension}"
+                path = self.storage_handler.join_paths(self.save_dir, self.PNGS_SUB_DIR, image_path)
+                self.storage_handler.set_from_bytes(path, io.BytesIO(image_bytes))
+        except Exception as e:
+            self._record_tile_failure(
+                z, x, y, geojson_name, stage="writing", error=repr(e)
+            )
+            return
+        if self.tile_ledger is not None:
+            self.tile_ledger.record_completion(z, x, y, geojson_name)
+
+
     def save_responses(
         self, input, start, end, duration, make_gifs: Optional[bool] = False,
         save_images: Optional[bool] = True, embed_date = True, 
-        timelapse_format: Optional[str] = "gif", image_format: Optional[str] = "png"
+        timelapse_format: Optional[str] = "gif", image_format: Optional[str] = "png",
+        local_indices: Optional[List[str]] = None
     ) -> None:
-        responses, z, x, y, geojson_name = input
-        images = list()
-        dates = self.get_mosaic_time_str_from_start_end(start, end)
-        if embed_date:
-            responses = list(zip(dates, responses))
-        for response in responses:
-            if embed_date:
-                date, response = response
-                year, month = date.split("_")
-            img_bs = io.BytesIO(response)
-            img = Image.open(img_bs)  
-            if embed_date: 
-                draw = ImageDraw.Draw(img)
-                # font = ImageFont.truetype(<font-file>, <font-size>)
-                # font = ImageFont.truetype("sans-serif.ttf", 16)
-                # draw.text((x, y),"Sample Text",(r,g,b))
-                draw.text((0, 0),f"{year} {month} {z} {x} {y}",(255,255,255))            
-            images.append(img)
-
-        if make_gifs:
-            bs = io.BytesIO()
-            imgs_iter = iter(images)
-            first_img = next(imgs_iter)
-            first_img.save(fp=bs, format='GIF', append_images=imgs_iter,
-                    save_all=True, duration=duration, loop=0, interlace=False,
-                    include_color_table=True)        
-            # imageio.mimsave(bs, images, duration=duration)
-            timelapse_filename = f"{start}_{end}/{z}/{geojson_name}/{z}_{x}_{y}/{z}_{x}_{y}_{start}_{end}.{timelapse_format}"
-            path = self.storage_handler.join_paths(self.save_dir, self.TIMELAPSES_SUB_DIR, timelapse_filename)
-            self.storage_handler.set_from_bytes(path, bs)                 
-
-        if save_images:
-            for date, image in list(zip(dates, images)):
-                bs = io.BytesIO()
-                image.save(fp=bs, format=image_format)
-                image_path = f"{start}_{end}/{z}/{geojson_name}/{z}_{x}_{y}/{z}_{x}_{y}_{date}.{image_format}"
-                path = self.storage_handler.join_paths(self.save_dir, self.PNGS_SUB_DIR, image_path)
-                self.storage_handler.set_from_bytes(path, bs)                
+        dates = self.get_mosaic_time_strs(start, end)
+        encoded = encode_mosaic_responses(
+            input, dates=dates, duration=duration, make_gifs=make_gifs,
+            save_images=save_images, embed_date=embed_date, 
+            image_format=image_format, local_indices=local_indices
+        )
+        self.write_encoded_responses(
+            encoded, start=start, end=end, timelapse_format=timelapse_format
+        )
+
+
+    def _add_fetch_encode_and_write_stages(
+        self, data: Data, start, end, duration, embed_date: Optional[bool] = True, 
+        make_gifs: Optional[bool] = True, save_images: Optional[bool] = True,
+        max_in_flight_tiles: Optional[int] = 64,
+        num_encode_workers: Optional[int] = None,
+        num_write_workers: Optional[int] = 4,
+        max_fetch_retries: Optional[int] = 3,
+        retry_base_delay: Optional[float] = 1.0,
+        local_indices: Optional[List[str]] = None
+    ) -> Data:
+        # At most `max_in_flight_tiles` tiles are fetched concurrently. 
+        # Decoding and encoding are CPU-bound and run in a process pool; 
+        # writes are I/O-bound and run in a thread pool. Encoding workers are
+        # started while the fetch stage's event loop thread is running, so 
+        # they are spawned rather than forked, which could copy a lock held
+        # by that thread (e.g. logging or SSL) into a child
+        if num_encode_workers is None:
+            num_encode_workers = os.cpu_count()
+        dates = self.get_mosaic_time_strs(start, end)
+        data >> Transformer(
+                    self.post_monthly_mosaic_request, 
+                    max_retries=max_fetch_retries, 
+                    retry_base_delay=retry_base_delay,
+                    parallelizer=BoundedAsyncGatherer(
+                        max_in_flight=max_in_flight_tiles
+                    )
+                ) \
+            >> Transformer(
+                    encode_mosaic_responses, dates=dates, duration=duration, 
+                    embed_date=embed_date, make_gifs=make_gifs, 
+                    save_images=save_images, local_indices=local_indices,
+                    parallelizer=BlockingProcessPooler(
+                        max_workers=num_encode_workers, 
+                        queue_size=2 * num_encode_workers,
+                        DefaultBlockingExecutor=functools.partial(
+                            concurrent.futures.ProcessPoolExecutor,
+                            mp_context=multiprocessing.get_context("spawn")
+                        )
+                    )
+                ) \
+            >> Transformer(
+                    self.write_encoded_responses, start=start, end=end,
+                    parallelizer=BlockingThreadPooler(
+                        max_workers=num_write_workers, 
+                        queue_size=num_write_workers
+                    )
+                )
+        return data
 
 
     # def make_timelapses(
@@ -917,101 +1320,202 @@ class PlanetScope(ImageryHandler):
     #             )
 
 
-    def _get_tile_from_preds_csv_path(
+    def _get_tile_coordinate_chunks(
         self, preds_csv_path: str,
         filter_by_target_value: Optional[bool] = False,
         target_column_name: Optional[str] = "Predicted Class", 
         target_value: Optional[int] = 1,
-        coordinate_column_names: Optional[List[str]] = ["Z", "X", "Y"]
-    ):
-        df = pd.read_csv(preds_csv_path)
-        if filter_by_target_value and target_column_name is not None:
-            tile_coordinates = df[df[target_column_name] == target_value][coordinate_column_names]
+        coordinate_column_names: Optional[List[str]] = ["Z", "X", "Y"],
+        chunk_size: Optional[int] = 1048576
+    ) -> Generator:
+        """
+        Yields `(n, 3)` integer arrays of Z/X/Y tile coordinates, reading 
+        only the needed columns of `preds_csv_path` `chunk_size` rows at a 
+        time.
+        """
+        filter_rows = filter_by_target_value and target_column_name is not None
+        column_names = list(coordinate_column_names)
+        if filter_rows:
+            column_names.append(target_column_name)
+        if raster_io.file_is_a(preds_csv_path, extension=".parquet"):
+            chunks = raster_io.iter_table_columns(
+                preds_csv_path, column_names, chunk_size=chunk_size
+            )
         else:
-            tile_coordinates = df[coordinate_column_names]
-        for tile_coords in tile_coordinates.values:
-            z = tile_coords[0]
-            x = tile_coords[1]
-            y = tile_coords[2]
-            tile = mercantile.Tile(x=x, y=y, z=z)
-            yield tile
+            chunks = pd.read_csv(
+                preds_csv_path, usecols=column_names, chunksize=chunk_size,
+                dtype={name: np.int32 for name in coordinate_column_names}
+            )
+        for chunk in chunks:
+            tile_coordinates = np.stack(
+                [np.asarray(chunk[name]) for name in coordinate_column_names],
+                axis=1
+            ).astype(np.int64)
+            if filter_rows:
+                tile_coordinates = tile_coordinates[
+                    np.asarray(chunk[target_column_name]) == target_value
+                ]
+            yield tile_coordinates
 
 
-    def _make_timelapses_from_preds_csv_path(
-        self, start, end, zooms, duration, false_color_index = None, 
-        embed_date: Optional[bool] = True, make_gifs: Optional[bool] = True,
-        save_images: Optional[bool] = True, preds_csv_path: Optional[str] = None,
+    def _get_tile_from_preds_csv_path(
+        self, preds_csv_path: str,
+        filter_by_target_value: Optional[bool] = False,
         target_column_name: Optional[str] = "Predicted Class", 
         target_value: Optional[int] = 1,
         coordinate_column_names: Optional[List[str]] = ["Z", "X", "Y"],
-        num_tiles_per_sublist: Optional[int] = 128,
-        filter_by_target_value: Optional[bool] = False
+        chunk_size: Optional[int] = 1048576
     ):
-        # def yield_tiles(tiles: Set[mercantile.Tile]) -> Generator:
-        #     yield from tiles
+        """
+        Streams unique tiles from a predictions file. Duplicates are removed
+        with vectorized set operations on packed Z/X/Y keys, so only the 
+        keys of tiles seen so far are held in memory.
+        """
+        seen_keys = np.empty(0, dtype=np.int64)
+        chunks = self._get_tile_coordinate_chunks(
+            preds_csv_path=preds_csv_path, 
+            filter_by_target_value=filter_by_target_value,
+            target_column_name=target_column_name, target_value=target_value,
+            coordinate_column_names=coordinate_column_names, 
+            chunk_size=chunk_size
+        )
+        for tile_coordinates in chunks:
+            keys = np.unique(gridding.pack_grid_cell_ids(
+                tile_coordinates[:, 0], tile_coordinates[:, 1], 
+                tile_coordinates[:, 2]
+            ))
+            keys = keys[np.isin(keys, seen_keys, assume_unique=True, invert=True)]
+            if keys.size == 0:
+                continue
+            seen_keys = np.union1d(seen_keys, keys)
+            zs, xs, ys = gridding.unpack_grid_cell_ids(keys)
+            for z, x, y in zip(zs.tolist(), xs.tolist(), ys.tolist()):
+                yield mercantile.Tile(x=x, y=y, z=z)
 
 
+    def _make_timelapses_from_preds_csv_path(
+        self, start, end, false_color_index = None, 
+        preds_csv_path: Optional[str] = None,
+        target_column_name: Optional[str] = "Predicted Class", 
+        target_value: Optional[int] = 1,
+        coordinate_column_names: Optional[List[str]] = ["Z", "X", "Y"],
+        filter_by_target_value: Optional[bool] = False,
+        csv_chunk_size: Optional[int] = 1048576, **kwargs
+    ):
+        # A single streaming pipeline: each stage only holds a bounded window
+        # of tiles, so memory does not grow with the number of tiles in 
+        # `preds_csv_path`
         data = Data(
-            self._get_tile_from_preds_csv_path, 
+            self._get_tile_from_preds_csv_path,
             preds_csv_path=preds_csv_path, target_column_name=target_column_name,
             target_value=target_value, coordinate_column_names=coordinate_column_names,
-            filter_by_target_value=filter_by_target_value
+            filter_by_target_value=filter_by_target_value, chunk_size=csv_chunk_size
         )
-        tiles: List[mercantile.Tile] = data(block=True, no_return=False) # Accumulate tiles
-        tiles = list(set(tiles)) # Remove duplicates
 
-        # Chunk tiles to prevent order bottlenecks
-        tiles = [
-            tiles[i:i + num_tiles_per_sublist] for i in range(0, len(tiles), num_tiles_per_sublist)
-        ]
+        with data:
+            data >> Transformer(self._make_monthly_mosaic_requests_from_tile, 
+                        start=start, end=end, false_color_index=false_color_index
+                    )
+            self._add_fetch_encode_and_write_stages(
+                data, start=start, end=end, **kwargs
+            )
+
 
-        for tile_chunk in tiles:
-            data = Data(tile_chunk)
+    def _make_timelapses_from_targets(
+        self, start, end, zooms, false_color_index = None, **kwargs
+    ):
+        data = Data(
+            self.storage_handler.get_filepaths_from_dir, 
+            dir=self.target_handler.targets_dir
+        )
 
-            with data:
-                data >> Transformer(self._make_monthly_mosaic_requests_from_tile, 
-                            start=start, end=end, false_color_index=false_color_index
-                        ) \
-                    >> Transformer(self.post_monthly_mosaic_request, parallelizer=AsyncGatherer()) \
-                    >> Transformer(
-                            self.save_responses, start=start, end=end, 
-                            duration=duration, embed_date=embed_date, make_gifs=make_gifs,
-                            save_images=save_images
-                )    
+        with data:
+            data >> Transformer(self.storage_handler.get_as_bytes) \
+                >> Transformer(self.make_monthly_mosaic_interval, start=start, end=end) \
+                >> Transformer(self.make_monthly_mosaic_requests, zooms=zooms, 
+                    truncate=self.TRUNCATE, false_color_index=false_color_index)
+            self._add_fetch_encode_and_write_stages(
+                data, start=start, end=end, **kwargs
+            )
+
+
+    def _make_timelapses_from_ledger(
+        self, start, end, false_color_index = None, **kwargs
+    ):
+        # Only tiles whose latest ledger entry is a failure are reprocessed
+        failed_tiles = self.tile_ledger.get_failed_tiles()
+        logging.info(
+            f"Retrying {len(failed_tiles)} failed tiles from {self.tile_ledger.path}."
+        )
+        data = Data(failed_tiles)
+
+        with data:
+            data >> Transformer(self._make_monthly_mosaic_requests_from_ledger_entry, 
+                        start=start, end=end, false_color_index=false_color_index
+                    )
+            self._add_fetch_encode_and_write_stages(
+                data, start=start, end=end, **kwargs
+            )
 
 
     def make_timelapses(
         self, start, end, zooms, duration, false_color_index = None, 
         embed_date: Optional[bool] = True, make_gifs: Optional[bool] = True,
         save_images: Optional[bool] = True, preds_csv_path: Optional[str] = None,
-        **kwargs
+        max_in_flight_tiles: Optional[int] = 64,
+        num_encode_workers: Optional[int] = None,
+        num_write_workers: Optional[int] = 4, 
+        max_fetch_retries: Optional[int] = 3,
+        retry_base_delay: Optional[float] = 1.0,
+        tile_ledger_path: Optional[str] = None,
+        retry_failed: Optional[bool] = False, 
+        local_indices: Optional[List[str]] = None, **kwargs
     ):
         if false_color_index:
             assert false_color_index in self.VALID_FC_INDICES, f"False color index {false_color_index} not recognized."
-        if preds_csv_path:
+        # Basemap tiles are rendered RGB, so only indices which need no NIR 
+        # band can be computed locally from a single fetch
+        for index_name in local_indices or list():
+            assert index_name in self.VALID_FC_INDICES, f"Spectral index {index_name} not recognized."
+            assert spectral.can_compute_index(index_name, spectral.RGB_BAND_MAP), \
+                f"Spectral index {index_name} requires bands " \
+                f"{spectral.get_index_bands(index_name)} which RGB basemap tiles " \
+                "do not have. Pass it as `false_color_index` instead."
+        if tile_ledger_path:
+            self.tile_ledger = TileLedger(tile_ledger_path)
+        if retry_failed:
+            assert self.tile_ledger is not None, \
+                "`tile_ledger_path` must be passed to retry failed tiles."
+        # Computed once here and shared by every tile
+        self.get_mosaic_time_strs(start, end)
+        stage_kwargs = {
+            "duration": duration, "embed_date": embed_date, 
+            "make_gifs": make_gifs, "save_images": save_images,
+            "max_in_flight_tiles": max_in_flight_tiles, 
+            "num_encode_workers": num_encode_workers, 
+            "num_write_workers": num_write_workers, 
+            "max_fetch_retries": max_fetch_retries, 
+            "retry_base_delay": retry_base_delay, "local_indices": local_indices
+        }
+        if retry_failed:
+            self._make_timelapses_from_ledger(
+                start=start, end=end, false_color_index=false_color_index,
+                **stage_kwargs
+            )
+        elif preds_csv_path:
             self._make_timelapses_from_preds_csv_path(
-                start=start, end=end, zooms=zooms, duration=duration, 
-                false_color_index=false_color_index, embed_date=embed_date, 
-                make_gifs=make_gifs, save_images=save_images, 
-                preds_csv_path=preds_csv_path, **kwargs
+                start=start, end=end, false_color_index=false_color_index, 
+                preds_csv_path=preds_csv_path, **stage_kwargs, **kwargs
             )
         else:
-            data = Data(
-                self.storage_handler.get_filepaths_from_dir, 
-                dir=self.target_handler.targets_dir
+            self._make_timelapses_from_targets(
+                start=start, end=end, zooms=zooms, 
+                false_color_index=false_color_index, **stage_kwargs
             )
-
-            with data:
-                data >> Transformer(self.storage_handler.get_as_bytes) \
-                    >> Transformer(self.make_monthly_mosaic_interval, start=start, end=end) \
-                    >> Transformer(self.make_monthly_mosaic_requests, zooms=zooms, 
-                        truncate=self.TRUNCATE, false_color_index=false_color_index) \
-                    >> Transformer(self.post_monthly_mosaic_request, parallelizer=AsyncGatherer()) \
-                    >> Transformer(
-                        self.save_responses, start=start, end=end, 
-                        duration=duration, embed_date=embed_date, make_gifs=make_gifs,
-                        save_images=save_images
-                )
+        self.tile_cache.flush()
+        self.tile_cache.log_stats()
+        if self.tile_ledger is not None:
+            self.tile_ledger.log_stats()
 
 
 class CBERS(ImageryHandler):
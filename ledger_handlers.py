@@ -0,0 +1,105 @@
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import List, Optional, Tuple
+
+
+class TileLedger:
+    """
+    Append-only JSON-lines record of the tiles of a timelapse run which
+    failed or completed. A tile's latest entry determines its status, so the
+    ledger can be shared by an original run and any number of retry runs.
+    """
+    __name__ = "TileLedger"
+
+    FAILED: str = "failed"
+    COMPLETED: str = "completed"
+
+
+    def __init__(self, path: str):
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.num_failed = 0
+        self.num_completed = 0
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def make_key(z: int, x: int, y: int, geojson_name: str) -> Tuple:
+        return int(z), int(x), int(y), geojson_name
+
+
+    def _append(self, entry: dict) -> None:
+        line = json.dumps(entry)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+    def record_failure(
+        self, z: int, x: int, y: int, geojson_name: str, stage: str,
+        error: Optional[str] = None
+    ) -> None:
+        logging.warning(
+            f"Tile {z}/{x}/{y} ({geojson_name}) failed while {stage}: {error}"
+        )
+        self._append({
+            "z": z, "x": x, "y": y, "geojson_name": geojson_name,
+            "status": self.FAILED, "stage": stage, "error": error,
+            "time": time.time()
+        })
+        self.num_failed += 1
+
+
+    def record_completion(self, z: int, x: int, y: int, geojson_name: str) -> None:
+        self._append({
+            "z": z, "x": x, "y": y, "geojson_name": geojson_name,
+            "status": self.COMPLETED, "time": time.time()
+        })
+        self.num_completed += 1
+
+
+    def read(self) -> dict:
+        """
+        Returns a mapping from `(z, x, y, geojson_name)` to the latest entry
+        of each tile.
+        """
+        entries = dict()
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                key = self.make_key(
+                    entry["z"], entry["x"], entry["y"], entry["geojson_name"]
+                )
+                entries[key] = entry
+        return entries
+
+
+    def get_failed_tiles(self) -> List[Tuple]:
+        """
+        Returns `(z, x, y, geojson_name)` for every tile whose latest entry
+        is a failure.
+        """
+        return [
+            key for key, entry in self.read().items()
+            if entry["status"] == self.FAILED
+        ]
+
+
+    def log_stats(self) -> None:
+        logging.info(
+            f"Tile ledger {self.path}: {self.num_completed} tiles completed, " \
+            f"{self.num_failed} tiles failed."
+        )
@@ -6,7 +6,7 @@ from typing import Optional, Union
 
 from osgeo import gdal, ogr, osr
 
-from light_pipe_geo import mercantile
+from light_pipe_geo import handle_cache, mercantile, raster_trans
 
 ogr.UseExceptions()
 osr.UseExceptions()
@@ -45,6 +45,14 @@ class GDALAdapter:
             self.data = None
 
 
+    def Invalidate(self):
+        """
+        Drops any cached handles of the file, e.g. after it is rewritten.
+        """
+        self.data = None
+        handle_cache.invalidate(str(self.filepath))
+
+
     def __enter__(self):
         self.data = self.Open() # Overrides `keep_open`
         return self
@@ -56,16 +64,26 @@ class GDALAdapter:
 
 class DatasetAdapter(GDALAdapter):
     def _Open(self, filepath: str):
-        return gdal.Open(filepath)
+        return handle_cache.open_dataset(filepath)
+
+
+    def ReadAsArray(self, pixel_size: Optional[float] = None):
+        """
+        Reads the whole dataset. If `pixel_size` is passed, reads from the 
+        coarsest overview whose pixels are no larger than `pixel_size`.
+        """
+        data = self.data if self.data is not None else self.Open()
+        if pixel_size is not None:
+            level = raster_trans.get_overview_level(data, pixel_size)
+            if level is not None:
+                return raster_trans.read_overview_as_array(data, level)
+        arr = data.ReadAsArray()
+        return arr
 
 
-    def ReadAsArray(self):
-        if self.data is not None:
-            arr = self.data.ReadAsArray()
-        else:
-            data = self.Open()
-            arr = data.ReadAsArray()
-        return arr
+    def BuildOverviews(self, resampling: Optional[str] = "AVERAGE"):
+        data = self.data if self.data is not None else self.Open()
+        raster_trans.build_overviews(data, resampling=resampling)
 
     
     def GetExtent(self, target_epsg = DEFAULT_EPSG):
@@ -138,7 +156,7 @@ class DataSourceAdapter:
         if self.data_source is not None:
             return self.data_source
         filepath = str(self.filepath)
-        data_source = ogr.Open(filepath)
+        data_source = handle_cache.open_datasource(filepath)
         if self.keep_open:
             self.data_source = data_source
         return data_source
@@ -148,6 +166,11 @@ class DataSourceAdapter:
         self.data_source = None
 
 
+    def Invalidate(self):
+        self.data_source = None
+        handle_cache.invalidate(str(self.filepath))
+
+
     def __enter__(self):
         self.data_source = self.Open() # Overrides `keep_open`
         return self
@@ -13,7 +13,7 @@ from typing import Optional, Sequence, Union
 
 from osgeo import gdal, ogr
 
-from light_pipe_geo import raster_io
+from light_pipe_geo import handle_cache, raster_io
 
 DATA_ARGS = ["datum", "dataset", "datasets", "datasource", "datasources"]
 
@@ -45,9 +45,9 @@ def open_osgeo_inputs(input):
             output = input
         elif isinstance(input, str):
             if raster_io.file_is_a(input, extension=".tif"):
-                output = gdal.Open(input)
+                output = handle_cache.open_dataset(input)
             else:
-                output = ogr.Open(input)
+                output = handle_cache.open_datasource(input)
         elif isinstance(input, list):
             output = list()
             for item in input:
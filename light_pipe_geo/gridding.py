@@ -7,9 +7,11 @@ arbitrarily-aligned imagery. These datasets are particularly useful in settings
 in which time-series of aligned geospatial raster data are useful.
 """
 
+import concurrent.futures
 import math
-from typing import Iterable, List, Optional, Union
+from typing import Iterable, Optional, Sequence, Set, Tuple, Union
 
+import numpy as np
 from osgeo import gdal, ogr, osr
 
 from light_pipe_geo import (gdal_data_handlers, mercantile, raster_io,
@@ -27,6 +29,9 @@ PSEUDO_MERCATOR_EPSG = 3857
 LIGHT_PIPE_QUAD_KEY = "LIGHT_PIPE_QUAD_KEY"
 DATETIME_KEY = 'TIFFTAG_DATETIME'
 
+# Points sampled along each edge of a feature envelope when it is reprojected
+DEFAULT_ENVELOPE_EDGE_POINTS = 3
+
 
 class GridCell(mercantile.Tile):
     """
@@ -37,6 +42,89 @@ class GridCell(mercantile.Tile):
     """
 
 
+def get_grid_cell_ids_from_lnglat(
+    lng: np.ndarray, lat: np.ndarray, zoom: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized `mercantile.tile`: returns the x and y indices of the grid 
+    cells at `zoom` containing each `(lng, lat)` pair.
+    """
+    lng = np.asarray(lng, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    x = lng / 360.0 + 0.5
+    sinlat = np.sin(np.radians(lat))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y = 0.5 - 0.25 * np.log((1.0 + sinlat) / (1.0 - sinlat)) / np.pi
+    if not np.all(np.isfinite(y)):
+        raise mercantile.InvalidLatitudeError("Y can not be computed for some latitudes.")
+    z2 = 2 ** zoom
+    x_ids = np.floor((x + mercantile.EPSILON) * z2)
+    y_ids = np.floor((y + mercantile.EPSILON) * z2)
+    x_ids = np.where(x <= 0, 0, np.where(x >= 1, z2 - 1, x_ids)).astype(np.int64)
+    y_ids = np.where(y <= 0, 0, np.where(y >= 1, z2 - 1, y_ids)).astype(np.int64)
+    return x_ids, y_ids
+
+
+def get_quadkeys(x: np.ndarray, y: np.ndarray, zoom: int) -> np.ndarray:
+    """
+    Vectorized `mercantile.quadkey` for grid cells at a single zoom level.
+    """
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    if zoom == 0:
+        return np.full(x.shape, "", dtype="U1")
+    shifts = np.arange(zoom - 1, -1, -1, dtype=np.int64)
+    digits = ((x[..., np.newaxis] >> shifts) & 1) \
+        + 2 * ((y[..., np.newaxis] >> shifts) & 1)
+    chars = (digits + ord("0")).astype(np.uint8)
+    return np.ascontiguousarray(chars).view(f"S{zoom}")[..., 0].astype(str)
+
+
+def pack_grid_cell_ids(
+    z: np.ndarray, x: np.ndarray, y: np.ndarray
+) -> np.ndarray:
+    """
+    Packs `(z, x, y)` grid cell indices into single `int64` keys (5 bits of 
+    zoom, 29 bits each of x and y) so that cells can be de-duplicated and 
+    sorted with vectorized operations.
+    """
+    z = np.asarray(z, dtype=np.int64)
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    return (z << 58) | (x << 29) | y
+
+
+def unpack_grid_cell_ids(
+    keys: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    keys = np.asarray(keys, dtype=np.int64)
+    mask = (1 << 29) - 1
+    return keys >> 58, (keys >> 29) & mask, keys & mask
+
+
+def get_pixel_size_in_dataset_units(
+    dataset: gdal.Dataset, srs: osr.SpatialReference, minx: float, 
+    miny: float, maxx: float, maxy: float, raster_x_size: int
+) -> float:
+    """
+    Returns the width of the pixels of a `raster_x_size`-pixel-wide raster 
+    spanning `(minx, miny, maxx, maxy)` in `srs`, measured in the units of 
+    `dataset`'s geotransform.
+    """
+    dataset_srs = dataset.GetSpatialRef()
+    if dataset_srs is None or dataset_srs.IsSame(srs):
+        return (maxx - minx) / raster_x_size
+    # Geotransforms are always in (x, y) order, whatever the CRS axis order
+    src_srs = srs.Clone()
+    src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    dst_srs = dataset_srs.Clone()
+    dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transformation = osr.CoordinateTransformation(src_srs, dst_srs)
+    envelope = np.asarray([[minx, maxx, miny, maxy]], dtype=np.float64)
+    dst_minx, dst_maxx, _, _ = transform_envelopes(envelope, transformation)[0]
+    return (dst_maxx - dst_minx) / raster_x_size
+
+
 @gdal_data_handlers.open_data
 def make_grid_cell_dataset(
     grid_cell: GridCell, datum: Union[gdal.Dataset, ogr.DataSource, dict], 
@@ -50,7 +138,7 @@ def make_grid_cell_dataset(
     default_dtype = gdal.GDT_Byte, default_n_bands = 1, 
     use_ancestor_driver = False, grid_cell_filepath: Optional[str] = None,
     default_driver_name: Optional[str] = "GTiff",
-    no_data_value = None,
+    no_data_value = None, use_overviews: Optional[bool] = False,
     *args, **kwargs
 ):
     if not in_memory and datum_filepath is None:
@@ -101,6 +189,15 @@ def make_grid_cell_dataset(
             driver_name = default_driver_name
         n_bands = datum.RasterCount
         dtype = datum.GetRasterBand(1).DataType
+        if use_overviews:
+            # Compare pixel sizes in the datum's units, e.g. degrees
+            datum_pixel_size = get_pixel_size_in_dataset_units(
+                datum, srs, minx, miny, maxx, maxy, raster_x_size
+            )
+            if datum_pixel_size >= 2 * abs(datum.GetGeoTransform()[1]):
+                raster_trans.build_overviews(
+                    datum, resampling="NEAREST" if is_label else "AVERAGE"
+                )
         datum, grid_cell_dataset = raster_trans.translate_dataset(
             datum, grid_cell_filepath, raster_x_size, raster_y_size, n_bands, 
             dtype, geotransform, projection, driver_name, srs, ulx=minx, uly=maxy, 
@@ -160,35 +257,158 @@ def get_grid_cells_from_dataset(
     return grid_cells
 
 
+def get_grid_cell_keys_from_bounds(
+    west: np.ndarray, south: np.ndarray, east: np.ndarray, north: np.ndarray,
+    zooms: Union[int, Sequence[int]], truncate: Optional[bool] = False
+) -> np.ndarray:
+    """
+    Vectorized `mercantile.tiles`: returns the unique packed keys (see 
+    `pack_grid_cell_ids`) of the grid cells overlapped by any of the 
+    geographic bounding boxes.
+    """
+    west, south, east, north = (
+        np.asarray(v, dtype=np.float64).ravel() for v in (west, south, east, north)
+    )
+    if truncate:
+        west, east = np.clip(west, -180.0, 180.0), np.clip(east, -180.0, 180.0)
+        south, north = np.clip(south, -90.0, 90.0), np.clip(north, -90.0, 90.0)
+    # Split boxes which cross the antimeridian
+    crosses = west > east
+    west = np.concatenate([np.where(crosses, -180.0, west), west[crosses]])
+    east = np.concatenate([east, np.full(crosses.sum(), 180.0)])
+    south = np.concatenate([south, south[crosses]])
+    north = np.concatenate([north, north[crosses]])
+
+    west = np.maximum(west, -180.0)
+    south = np.maximum(south, -85.051129)
+    east = np.minimum(east, 180.0)
+    north = np.minimum(north, 85.051129)
+
+    if not isinstance(zooms, Sequence):
+        zooms = [zooms]
+    keys = [np.empty(0, dtype=np.int64)]
+    for zoom in zooms:
+        x_0, y_0 = get_grid_cell_ids_from_lnglat(west, north, zoom)
+        x_1, y_1 = get_grid_cell_ids_from_lnglat(
+            east - mercantile.LL_EPSILON, south + mercantile.LL_EPSILON, zoom
+        )
+        n_x = np.maximum(x_1 - x_0 + 1, 0)
+        n_y = np.maximum(y_1 - y_0 + 1, 0)
+        counts = n_x * n_y
+        # Expand every box into one entry per grid cell it covers
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        n_x = np.repeat(n_x, counts)
+        x = np.repeat(x_0, counts) + offsets % n_x
+        y = np.repeat(y_0, counts) + offsets // n_x
+        keys.append(np.unique(pack_grid_cell_ids(zoom, x, y)))
+    return np.unique(np.concatenate(keys))
+
+
+def get_layer_envelopes(layer: ogr.Layer) -> np.ndarray:
+    """
+    Returns the `(minx, maxx, miny, maxy)` envelopes of the features of 
+    `layer` as an `(N, 4)` array, in the layer's coordinates.
+    """
+    layer.ResetReading()
+    envelopes = [
+        geometry.GetEnvelope() for geometry in 
+        (feature.GetGeometryRef() for feature in layer)
+        if geometry is not None and not geometry.IsEmpty()
+    ]
+    layer.ResetReading()
+    return np.asarray(envelopes, dtype=np.float64).reshape(-1, 4)
+
+
+def transform_envelopes(
+    envelopes: np.ndarray, transformation: osr.CoordinateTransformation,
+    edge_points: Optional[int] = DEFAULT_ENVELOPE_EDGE_POINTS
+) -> np.ndarray:
+    """
+    Reprojects `(minx, maxx, miny, maxy)` envelopes by transforming 
+    `edge_points` points along each of their edges in one call, and taking
+    the envelope of the results.
+    """
+    if not len(envelopes):
+        return envelopes
+    minx, maxx, miny, maxy = envelopes.T
+    t = np.linspace(0.0, 1.0, edge_points)
+    xs = minx[:, np.newaxis] + t * (maxx - minx)[:, np.newaxis]
+    ys = miny[:, np.newaxis] + t * (maxy - miny)[:, np.newaxis]
+    ones = np.ones_like(xs)
+    # Bottom, top, left and right edges
+    points_x = np.concatenate(
+        [xs, xs, minx[:, np.newaxis] * ones, maxx[:, np.newaxis] * ones], axis=1
+    )
+    points_y = np.concatenate(
+        [miny[:, np.newaxis] * ones, maxy[:, np.newaxis] * ones, ys, ys], axis=1
+    )
+    points = np.stack([points_x.ravel(), points_y.ravel()], axis=-1)
+    transformed = np.asarray(
+        transformation.TransformPoints(points.tolist()), dtype=np.float64
+    )[:, :2].reshape(len(envelopes), -1, 2)
+    return np.stack([
+        transformed[..., 0].min(axis=1), transformed[..., 0].max(axis=1),
+        transformed[..., 1].min(axis=1), transformed[..., 1].max(axis=1)
+    ], axis=-1)
+
+
+def _get_grid_cell_keys_from_envelopes(
+    envelopes: np.ndarray, srcSRS: Union[osr.SpatialReference, None],
+    dstSRS: osr.SpatialReference, zoom: Union[int, Sequence[int]],
+    truncate: bool
+) -> np.ndarray:
+    if srcSRS is not None and not srcSRS.IsSame(dstSRS):
+        transformation = osr.CoordinateTransformation(srcSRS, dstSRS)
+        envelopes = transform_envelopes(envelopes, transformation)
+    if dstSRS.EPSGTreatsAsLatLong():
+        miny, maxy, minx, maxx = envelopes.T
+    else:
+        minx, maxx, miny, maxy = envelopes.T
+    return get_grid_cell_keys_from_bounds(
+        west=minx, south=miny, east=maxx, north=maxy, zooms=zoom,
+        truncate=truncate
+    )
+
+
 def get_grid_cells_from_datasource(
     datasource: ogr.DataSource, zoom: Optional[int] = DEFAULT_ZOOM,
     dstSRS: Optional[Union[osr.SpatialReference, None]] = None,
     default_dd_epsg: Optional[int] = DEFAULT_DD_EPSG,    
-    truncate: Optional[bool] = False, *args, **kwargs
-) -> List[GridCell]:
+    truncate: Optional[bool] = False, max_workers: Optional[int] = None,
+    *args, **kwargs
+) -> Set[GridCell]:
+    """
+    Returns the grid cells covered by the envelopes of the features of every
+    layer of `datasource`. Envelopes are read in bulk, reprojected as arrays
+    and converted to grid cells with vectorized tile math. Each layer's 
+    envelopes are read on the calling thread (datasources cannot be shared 
+    across threads) while earlier layers are processed by a thread pool.
+    """
     if dstSRS is None:
         dstSRS = osr.SpatialReference()
         dstSRS.ImportFromEPSG(default_dd_epsg) 
     n_layers = datasource.GetLayerCount()
-    grid_cells = set()
-
-    # @TODO: Add support for concurrency
-    for i in range(n_layers):
-        layer = datasource.GetLayerByIndex(i)
-        srcSRS = layer.GetSpatialRef()
-        transformation = osr.CoordinateTransformation(srcSRS, dstSRS)
 
-        # extent = layer.GetExtent()
-        for feature in layer:
-            feature.GetGeometryRef().Transform(transformation)
-            extent = feature.GetGeometryRef().GetEnvelope()
-            # minx, maxx, miny, maxy = extent
-            miny, maxy, minx, maxx = extent
-            layer_cells = mercantile.tiles(
-                west=minx, south=miny, east=maxx, north=maxy, zooms=zoom,
-                truncate=truncate
-            )
-            grid_cells.update(layer_cells)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = list()
+        for i in range(n_layers):
+            layer = datasource.GetLayerByIndex(i)
+            srcSRS = layer.GetSpatialRef()
+            if srcSRS is not None:
+                srcSRS = srcSRS.Clone()
+            envelopes = get_layer_envelopes(layer)
+            futures.append(executor.submit(
+                _get_grid_cell_keys_from_envelopes, envelopes, srcSRS, 
+                dstSRS.Clone(), zoom, truncate
+            ))
+        keys = np.unique(np.concatenate(
+            [np.empty(0, dtype=np.int64)] + [future.result() for future in futures]
+        ))
+    zs, xs, ys = unpack_grid_cell_ids(keys)
+    grid_cells = {
+        mercantile.Tile(x, y, z) for z, x, y in 
+        zip(zs.tolist(), xs.tolist(), ys.tolist())
+    }
     return grid_cells
 
 
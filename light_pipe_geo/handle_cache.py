@@ -0,0 +1,158 @@
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+__doc__ = """
+This module contains a process-wide, size-bounded LRU cache of open GDAL and
+OGR handles. GDAL handles must not be used by more than one thread at a time,
+so by default each thread gets its own handle for a given path and open mode.
+Handles of local files are reopened if the file has changed on disk since it
+was opened.
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Tuple, Union
+
+from osgeo import gdal, ogr
+
+gdal.UseExceptions()
+ogr.UseExceptions()
+
+
+DEFAULT_MAX_HANDLES = 128
+
+
+def _get_file_signature(path: str) -> Optional[Tuple[int, int]]:
+    if path.startswith("/vsi"):
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class HandleCache:
+    """
+    LRU cache of open handles keyed by `(kind, path, mode)` and, if
+    `per_thread`, by the calling thread. Evicting or invalidating a handle
+    only drops the cache's reference to it, so callers still holding the
+    handle can keep using it.
+    """
+    def __init__(
+        self, max_handles: Optional[int] = DEFAULT_MAX_HANDLES,
+        per_thread: Optional[bool] = True
+    ):
+        self.max_handles = max_handles
+        self.per_thread = per_thread
+        self.enabled = max_handles > 0
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+        self.num_invalidations = 0
+
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def _make_key(self, kind: str, path: str, mode: Hashable) -> Tuple:
+        thread_id = threading.get_ident() if self.per_thread else None
+        return kind, path, mode, thread_id
+
+
+    def get(
+        self, kind: str, path: str, mode: Hashable, opener: Callable
+    ) -> Union[gdal.Dataset, ogr.DataSource]:
+        """
+        Returns the cached handle of `path` opened in `mode`, calling
+        `opener()` to open it on a miss.
+        """
+        if not self.enabled:
+            return opener()
+        key = self._make_key(kind, path, mode)
+        signature = _get_file_signature(path)
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is not None and entry[1] == signature:
+                self._handles.move_to_end(key)
+                self.num_hits += 1
+                return entry[0]
+            self.num_misses += 1
+        # Open outside the lock so that slow opens do not block other threads
+        handle = opener()
+        if handle is None:
+            return handle
+        with self._lock:
+            self._handles[key] = (handle, signature)
+            self._handles.move_to_end(key)
+            while len(self._handles) > self.max_handles:
+                self._handles.popitem(last=False)
+                self.num_evictions += 1
+        return handle
+
+
+    def invalidate(self, path: Optional[str] = None) -> int:
+        """
+        Drops every cached handle of `path` (in any mode and thread), or of
+        every path if `path` is None. Returns the number of handles dropped.
+        """
+        with self._lock:
+            if path is None:
+                keys = list(self._handles.keys())
+            else:
+                path = str(path)
+                keys = [key for key in self._handles if key[1] == path]
+            for key in keys:
+                del self._handles[key]
+            self.num_invalidations += len(keys)
+        return len(keys)
+
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+
+    def get_stats(self) -> dict:
+        return {
+            "hits": self.num_hits, "misses": self.num_misses,
+            "evictions": self.num_evictions,
+            "invalidations": self.num_invalidations, "open": len(self)
+        }
+
+
+    def log_stats(self) -> None:
+        logging.info(
+            f"GDAL handle cache: {self.num_hits} hits, {self.num_misses} " \
+            f"misses, {self.num_evictions} evictions, {self.num_invalidations} " \
+            f"invalidations, {len(self)} handles open."
+        )
+
+
+HANDLE_CACHE = HandleCache()
+
+
+def open_dataset(
+    filepath: str, mode: Optional[int] = gdal.GA_ReadOnly
+) -> gdal.Dataset:
+    filepath = str(filepath)
+    return HANDLE_CACHE.get(
+        "raster", filepath, mode, lambda: gdal.Open(filepath, mode)
+    )
+
+
+def open_datasource(filepath: str, update: Optional[int] = 0) -> ogr.DataSource:
+    filepath = str(filepath)
+    return HANDLE_CACHE.get(
+        "vector", filepath, update, lambda: ogr.Open(filepath, update)
+    )
+
+
+def invalidate(filepath: Optional[str] = None) -> int:
+    return HANDLE_CACHE.invalidate(filepath)
+
+
+def get_stats() -> dict:
+    return HANDLE_CACHE.get_stats()
@@ -9,13 +9,16 @@ which are generated by `LightPipeline` instances.
 
 
 from collections import namedtuple
-from typing import Generator, Optional, Sequence, Union
+from typing import Generator, List, Optional, Sequence, Union
 
 import numpy as np
-from light_pipe_geo import raster_io, raster_trans, tiling
-from osgeo import gdal
+from light_pipe_geo import gridding, raster_io, raster_trans, tiling
+from osgeo import gdal, osr
 
 gdal.UseExceptions()
+osr.UseExceptions()
+
+DEFAULT_DD_EPSG = 4326
 
 
 class LightPipeTile(namedtuple("LightPipeTile", ["X", "y", "band_map"])):
@@ -89,6 +92,123 @@ class SampleManifest(
         return new_manifest
 
 
+class TilePredictionTableWriter:
+    """
+    Writes per-tile predictions as rows of a Parquet (or CSV) table, along 
+    with each tile's pixel offsets, lon/lat bounds and the Z/X/Y indices and
+    quadkey of the grid cell at `zoom` containing the tile's center. All 
+    columns are computed with vectorized operations, and each call to 
+    `write` appends one row group.
+    """
+    PRED_COLUMN_NAME: str = "Predicted Class"
+    COORDINATE_COLUMN_NAMES: List[str] = [
+        "Tile Y Offset", "Tile X Offset", "West", "South", "East", "North",
+        "Z", "X", "Y", "Quadkey"
+    ]
+
+    def __init__(
+        self, filepath: str, tile_coords: np.ndarray, tile_y: int, tile_x: int,
+        geotransform: tuple, projection: str, 
+        zoom: Optional[int] = gridding.DEFAULT_ZOOM, n_preds: Optional[int] = 1,
+        pred_column_names: Optional[List[str]] = None,
+        use_parquet: Optional[bool] = None, 
+        default_dd_epsg: Optional[int] = DEFAULT_DD_EPSG
+    ):
+        if pred_column_names is None:
+            if n_preds == 1:
+                pred_column_names = [self.PRED_COLUMN_NAME]
+            else:
+                pred_column_names = [
+                    f"{self.PRED_COLUMN_NAME} {i}" for i in range(n_preds)
+                ]
+        assert len(pred_column_names) == n_preds, \
+            "`pred_column_names` must have length `n_preds`."
+        self.tile_coords = np.asarray(tile_coords)
+        self.tile_y = tile_y
+        self.tile_x = tile_x
+        self.geotransform = geotransform
+        self.zoom = zoom
+        self.pred_column_names = pred_column_names
+
+        source = osr.SpatialReference()
+        source.ImportFromWkt(projection)
+        target = osr.SpatialReference()
+        target.ImportFromEPSG(default_dd_epsg)
+        target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        self.transformation = osr.CoordinateTransformation(source, target)
+
+        self.table_writer = raster_io.TableWriter(
+            filepath, self.COORDINATE_COLUMN_NAMES + pred_column_names, 
+            use_parquet=use_parquet
+        )
+
+
+    def get_columns(self, tile_indices: np.ndarray) -> dict:
+        tile_coords = self.tile_coords[tile_indices]
+        uly = tile_coords[:, 0]
+        ulx = tile_coords[:, 1]
+        gt_0, gt_1, gt_2, gt_3, gt_4, gt_5 = self.geotransform
+        lry = uly + self.tile_y
+        lrx = ulx + self.tile_x
+        corners = np.concatenate([
+            np.stack([gt_0 + ulx * gt_1 + uly * gt_2, gt_3 + ulx * gt_4 + uly * gt_5], axis=1),
+            np.stack([gt_0 + lrx * gt_1 + lry * gt_2, gt_3 + lrx * gt_4 + lry * gt_5], axis=1)
+        ])
+        lnglats = np.array(
+            self.transformation.TransformPoints(corners.tolist())
+        )[:, :2].reshape(2, -1, 2)
+        (ul_lng, ul_lat), (lr_lng, lr_lat) = lnglats.transpose(0, 2, 1)
+        west = np.minimum(ul_lng, lr_lng)
+        east = np.maximum(ul_lng, lr_lng)
+        south = np.minimum(ul_lat, lr_lat)
+        north = np.maximum(ul_lat, lr_lat)
+        x, y = gridding.get_grid_cell_ids_from_lnglat(
+            (west + east) / 2, (south + north) / 2, self.zoom
+        )
+        columns = {
+            "Tile Y Offset": uly,
+            "Tile X Offset": ulx,
+            "West": west,
+            "South": south,
+            "East": east,
+            "North": north,
+            "Z": np.full(x.shape, self.zoom, dtype=np.int64),
+            "X": x,
+            "Y": y,
+            "Quadkey": gridding.get_quadkeys(x, y, self.zoom),
+        }
+        return columns
+
+
+    def write(
+        self, tile_indices: Union[Sequence[int], np.ndarray], 
+        preds: Union[Sequence, np.ndarray]
+    ) -> None:
+        """
+        `tile_indices` index `tile_coords`; `preds` has shape `(B,)` or 
+        `(B, n_preds)`.
+        """
+        tile_indices = np.asarray(tile_indices)
+        preds = np.asarray(preds).reshape(len(tile_indices), -1)
+        columns = self.get_columns(tile_indices)
+        for i, name in enumerate(self.pred_column_names):
+            columns[name] = preds[:, i]
+        self.table_writer.write(columns)
+
+
+    def close(self) -> str:
+        return self.table_writer.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+
 class LightPipeSample:
     """
     Serves analysis-ready subsamples from arbitrarily-large raster(s) and 
@@ -117,6 +237,12 @@ class LightPipeSample:
         self.row_major = row_major
         self.tile_coords = tile_coords
         self.shuffle_indices = shuffle_indices
+        self.tile_keep_mask = None
+        self.num_tiles_kept = None
+        self.num_tiles_skipped = None
+        self.window_coords = None
+        self.stitcher = None
+        self._window_pred_i = 0
         self._i = 0
 
 
@@ -177,17 +303,12 @@ class LightPipeSample:
         return preds
 
 
-    def tile(
+    def _set_tiling_params(
         self, tile_y: Optional[int] = None, tile_x: Optional[int] = None, 
         array_dtype = None, row_major: Optional[bool] = None, 
         tile_coords = None, pos_only: Optional[bool] = None, 
-        non_null_only: Optional[bool] = None, 
-        shuffle_tiles: Optional[bool] = False, 
-        assert_tile_smaller_than_raster: Optional[bool] = False,
-        *args, **kwargs
-    ) -> Generator:
-        datasets = self.data.datasets
-        labels = self.data.labels
+        non_null_only: Optional[bool] = None
+    ) -> tuple:
         if tile_y is None:
             tile_y = self.tile_y
         else:
@@ -216,30 +337,206 @@ class LightPipeSample:
             non_null_only = self.non_null_only
         else:
             self.non_null_only = non_null_only
+        return tile_y, tile_x, array_dtype, row_major, tile_coords, pos_only, \
+            non_null_only
 
-        datasets, tiles, tile_coords, shuffle_indices, band_map = tiling.get_tiles(
+
+    def _set_tiling_results(
+        self, tile_coords: np.ndarray, shuffle_indices: Optional[np.ndarray],
+        band_map: dict, keep: np.ndarray
+    ) -> None:
+        self.tile_coords = tile_coords
+        self.shuffle_indices = shuffle_indices
+        self.band_map = band_map
+        # `keep` is aligned with `tile_coords`; tiles where it is `False` were
+        # dropped by `pos_only` / `non_null_only` and are never yielded.
+        self.tile_keep_mask = keep
+        self.num_tiles_kept = int(np.count_nonzero(keep))
+        self.num_tiles_skipped = int(keep.shape[0] - self.num_tiles_kept)
+
+
+    def tile(
+        self, tile_y: Optional[int] = None, tile_x: Optional[int] = None, 
+        array_dtype = None, row_major: Optional[bool] = None, 
+        tile_coords = None, pos_only: Optional[bool] = None, 
+        non_null_only: Optional[bool] = None, 
+        shuffle_tiles: Optional[bool] = False, 
+        assert_tile_smaller_than_raster: Optional[bool] = False,
+        *args, **kwargs
+    ) -> Generator:
+        datasets = self.data.datasets
+        labels = self.data.labels
+        tile_y, tile_x, array_dtype, row_major, tile_coords, pos_only, \
+            non_null_only = self._set_tiling_params(
+                tile_y, tile_x, array_dtype, row_major, tile_coords, pos_only,
+                non_null_only
+            )
+
+        datasets, tiles, tile_coords, shuffle_indices, band_map, keep = tiling.get_tiles(
             datasets=datasets, labels=labels, tile_y=tile_y, tile_x=tile_x, 
             array_dtype=array_dtype, row_major=row_major, tile_coords=tile_coords, 
             shuffle_tiles=shuffle_tiles, 
             assert_tile_smaller_than_raster=assert_tile_smaller_than_raster, 
-            *args, **kwargs
+            pos_only=pos_only, non_null_only=non_null_only, *args, **kwargs
         )
-        self.tile_coords = tile_coords
-        self.shuffle_indices = shuffle_indices
-        self.band_map = band_map
+        self._set_tiling_results(tile_coords, shuffle_indices, band_map, keep)
+        # Slices (rather than lists) keep `X` and `y` as views of the tile
+        X_index = tiling.get_channel_index(band_map[False])
+        y_index = tiling.get_channel_index(band_map[True])
         for tile_array in tiles:
-            X = tile_array[band_map[False]]
-            y = tile_array[band_map[True]]
-
-            if pos_only and np.allclose(y, 0):
-                continue
-            if non_null_only and np.allclose(X, 0):
-                continue
-
+            X = tile_array[X_index]
+            y = tile_array[y_index]
             tile = LightPipeTile(X=X, y=y, band_map=band_map)
             yield tile
 
 
+    def tile_batches(
+        self, batch_size: Optional[int] = 32, tile_y: Optional[int] = None, 
+        tile_x: Optional[int] = None, array_dtype = None, 
+        row_major: Optional[bool] = None, tile_coords = None, 
+        pos_only: Optional[bool] = None, non_null_only: Optional[bool] = None, 
+        shuffle_tiles: Optional[bool] = False, 
+        assert_tile_smaller_than_raster: Optional[bool] = False,
+        *args, **kwargs
+    ) -> Generator:
+        """
+        Like `tile` but yields `LightPipeTile` instances whose `X` and `y` 
+        have shape `(B, C, tile_y, tile_x)`, with `B <= batch_size`. Batches 
+        follow the order of `self.tile_coords`, so `self.shuffle_indices` can 
+        be used to `unshuffle` predictions as usual.
+        """
+        datasets = self.data.datasets
+        labels = self.data.labels
+        tile_y, tile_x, array_dtype, row_major, tile_coords, pos_only, \
+            non_null_only = self._set_tiling_params(
+                tile_y, tile_x, array_dtype, row_major, tile_coords, pos_only,
+                non_null_only
+            )
+
+        datasets, batches, tile_coords, shuffle_indices, band_map, keep = tiling.get_tile_batches(
+            datasets=datasets, labels=labels, tile_y=tile_y, tile_x=tile_x, 
+            array_dtype=array_dtype, row_major=row_major, batch_size=batch_size,
+            tile_coords=tile_coords, shuffle_tiles=shuffle_tiles, 
+            assert_tile_smaller_than_raster=assert_tile_smaller_than_raster, 
+            pos_only=pos_only, non_null_only=non_null_only, *args, **kwargs
+        )
+        self._set_tiling_results(tile_coords, shuffle_indices, band_map, keep)
+        for X, y in batches:
+            yield LightPipeTile(X=X, y=y, band_map=band_map)
+
+
+    def windows(
+        self, window_y: Optional[int] = None, window_x: Optional[int] = None,
+        stride_y: Optional[int] = None, stride_x: Optional[int] = None,
+        batch_size: Optional[int] = 32, array_dtype = None,
+        n_pred_bands: Optional[int] = 1, blend: Optional[str] = "linear",
+        geotiff_path: Optional[str] = None, dtype = gdal.GDT_Float32,
+        block_y: Optional[int] = 256, out_driver: Optional[str] = "GTiff",
+        *args, **kwargs
+    ) -> Generator:
+        """
+        Yields `LightPipeTile` batches of overlapping windows of shape 
+        `(B, C, window_y, window_x)` placed every `stride_y` / `stride_x` 
+        pixels. Predictions for each batch may be passed, in order, to 
+        `add_window_preds` and written with `save_stitched`. If 
+        `geotiff_path` is passed, blended rows are written to it while 
+        predictions are added, so no full-resolution copy is held.
+        """
+        datasets = self.data.datasets
+        labels = self.data.labels
+        if window_y is None:
+            window_y = self.tile_y
+        if window_x is None:
+            window_x = self.tile_x
+        if stride_y is None:
+            stride_y = window_y // 2
+        if stride_x is None:
+            stride_x = window_x // 2
+        if array_dtype is None:
+            array_dtype = self.array_dtype
+        else:
+            self.array_dtype = array_dtype
+
+        datasets, batches, window_coords, padded_shape, band_map = tiling.get_window_batches(
+            datasets=datasets, labels=labels, window_y=window_y, 
+            window_x=window_x, stride_y=stride_y, stride_x=stride_x,
+            array_dtype=array_dtype, batch_size=batch_size, *args, **kwargs
+        )
+        self.window_coords = window_coords
+        self.band_map = band_map
+        padded_y, padded_x = padded_shape
+        out_dataset = None
+        if geotiff_path is not None:
+            out_dataset = self._make_stitched_dataset(
+                geotiff_path, n_pred_bands, dtype, out_driver
+            )
+        self.stitcher = tiling.PredictionStitcher(
+            raster_y=datasets[0].RasterYSize, raster_x=datasets[0].RasterXSize,
+            window_y=window_y, window_x=window_x, stride_y=stride_y, 
+            stride_x=stride_x, n_bands=n_pred_bands, blend=blend, 
+            padded_y=padded_y, padded_x=padded_x, block_y=block_y, 
+            dataset=out_dataset
+        )
+        self._window_pred_i = 0
+        for X, y in batches:
+            yield LightPipeTile(X=X, y=y, band_map=band_map)
+
+
+    def add_window_preds(self, preds: Union[Sequence, np.ndarray]) -> None:
+        """
+        Accumulates a batch of per-pixel predictions for the next 
+        `len(preds)` windows yielded by `windows`.
+        """
+        assert self.stitcher is not None, \
+            "`windows` must be called before `add_window_preds`."
+        i = self._window_pred_i
+        n = len(preds)
+        self.stitcher.add(self.window_coords[i:i + n], preds)
+        self._window_pred_i += n
+
+
+    def _make_stitched_dataset(
+        self, geotiff_path: str, n_bands: int, dtype, out_driver
+    ) -> gdal.Dataset:
+        ancestor = self.data.datasets[0]
+        if isinstance(ancestor, str):
+            ancestor = gdal.Open(ancestor)
+        if isinstance(out_driver, str):
+            out_driver = gdal.GetDriverByName(out_driver)
+        return raster_io.make_dataset(
+            out_driver, geotiff_path, ancestor.RasterXSize, 
+            ancestor.RasterYSize, n_bands, dtype, ancestor.GetGeoTransform(),
+            ancestor.GetProjection()
+        )
+
+
+    def save_stitched(
+        self, geotiff_path: Optional[str] = None, dtype = gdal.GDT_Float32, 
+        array_dtype = None, out_driver: Optional[str] = "GTiff", 
+        *args, **kwargs
+    ) -> gdal.Dataset:
+        """
+        Writes the blended window predictions as a raster aligned with the 
+        first dataset in `self.data`. If a `geotiff_path` was passed to 
+        `windows`, the remaining rows are flushed to it and it is returned.
+        """
+        assert self.stitcher is not None, \
+            "`windows` must be called before `save_stitched`."
+        if self.stitcher.dataset is not None:
+            out_dataset = self.stitcher.finish()
+            out_dataset.FlushCache()
+            return out_dataset
+        assert geotiff_path is not None, \
+            "`geotiff_path` must be passed to `windows` or `save_stitched`."
+        out_dataset = self._make_stitched_dataset(
+            geotiff_path, self.stitcher.n_bands, dtype, out_driver
+        )
+        out_dataset = self.stitcher.write_to_dataset(
+            out_dataset, array_dtype=array_dtype
+        )
+        return out_dataset
+
+
     def load(self) -> None:
         for i in range(self.data.num_datasets):
             dataset = self.data.datasets[i]
@@ -268,7 +565,11 @@ class LightPipeSample:
             )
         elif raster_io.file_is_a(savepath, extension=".csv"):
             self._save_preds_as_csv(
-                geotiff_path=savepath, preds=preds, *args, **kwargs
+                table_path=savepath, preds=preds, *args, **kwargs
+            )
+        elif raster_io.file_is_a(savepath, extension=".parquet"):
+            self._save_preds_as_parquet(
+                table_path=savepath, preds=preds, *args, **kwargs
             )
         else:
             raise NotImplementedError("`save` is not implemented for this file type.")
@@ -304,10 +605,127 @@ class LightPipeSample:
         return out_dataset
 
 
+    def make_pred_writer(
+        self, geotiff_path: str, tile_y: Optional[int] = None, 
+        tile_x: Optional[int] = None, 
+        use_ancestor_pixel_size: Optional[bool] = True, 
+        pixel_x_size: Optional[Union[int, float]] = None,
+        pixel_y_size: Optional[Union[int, float]] = None,
+        n_bands: Optional[int] = 1, dtype = gdal.GDT_Byte,
+        assert_north_up: Optional[bool] = True, 
+        block_size: Optional[int] = 256, threaded: Optional[bool] = True,
+        *args, **kwargs
+    ) -> raster_trans.TilePredictionWriter:
+        """
+        Returns a `TilePredictionWriter` which streams predictions into 
+        `geotiff_path` as they are produced. Tile indices passed to its 
+        `write` method index `self.tile_coords`, i.e. the order in which 
+        tiles were yielded (shuffled or not), so no `unshuffle` is needed.
+        Call `close` (or use it as a context manager) once all predictions 
+        have been written.
+        """
+        assert self.tile_coords is not None, \
+            "`tile` or `tile_batches` must be called before `make_pred_writer`."
+        if tile_y is None:
+            tile_y = self.tile_y
+        if tile_x is None:
+            tile_x = self.tile_x
+        ancestor = self.data.datasets[0]
+        if isinstance(ancestor, str):
+            ancestor = gdal.Open(ancestor)
+        geotransform = raster_trans.get_tile_grid_geotransform(
+            ancestor, tile_y, tile_x, use_ancestor_pixel_size, pixel_x_size,
+            pixel_y_size, assert_north_up
+        )
+        writer = raster_trans.TilePredictionWriter(
+            filepath=geotiff_path, tile_coords=self.tile_coords, tile_y=tile_y,
+            tile_x=tile_x, raster_y=ancestor.RasterYSize, 
+            raster_x=ancestor.RasterXSize, geotransform=geotransform,
+            projection=ancestor.GetProjection(), n_bands=n_bands, dtype=dtype,
+            block_size=block_size, threaded=threaded, 
+            tile_keep_mask=self.tile_keep_mask
+        )
+        return writer
+
+
+    def make_pred_table_writer(
+        self, table_path: str, tile_y: Optional[int] = None, 
+        tile_x: Optional[int] = None, zoom: Optional[int] = gridding.DEFAULT_ZOOM,
+        n_preds: Optional[int] = 1, pred_column_names: Optional[List[str]] = None,
+        use_parquet: Optional[bool] = None, *args, **kwargs
+    ) -> TilePredictionTableWriter:
+        """
+        Returns a `TilePredictionTableWriter` which appends predictions to 
+        `table_path` as they are produced. Tile indices passed to its `write`
+        method index `self.tile_coords`.
+        """
+        assert self.tile_coords is not None, \
+            "`tile` or `tile_batches` must be called before `make_pred_table_writer`."
+        if tile_y is None:
+            tile_y = self.tile_y
+        if tile_x is None:
+            tile_x = self.tile_x
+        ancestor = self.data.datasets[0]
+        if isinstance(ancestor, str):
+            ancestor = gdal.Open(ancestor)
+        writer = TilePredictionTableWriter(
+            filepath=table_path, tile_coords=self.tile_coords, tile_y=tile_y,
+            tile_x=tile_x, geotransform=ancestor.GetGeoTransform(),
+            projection=ancestor.GetProjection(), zoom=zoom, n_preds=n_preds,
+            pred_column_names=pred_column_names, use_parquet=use_parquet
+        )
+        return writer
+
+
+    def _save_preds_as_table(
+        self, table_path: str, preds: np.ndarray, use_parquet: bool,
+        tile_y: Optional[int] = None, tile_x: Optional[int] = None,
+        row_group_size: Optional[int] = 65536, *args, **kwargs
+    ) -> str:
+        assert self.tile_coords is not None, \
+            "`tile` or `tile_batches` must be called before saving predictions."
+        # `preds` follow the order in which tiles were yielded: one per kept
+        # tile, or one per tile
+        expected_lengths = {len(self.tile_coords)}
+        if self.tile_keep_mask is not None:
+            expected_lengths.add(self.num_tiles_kept)
+        assert len(preds) in expected_lengths, \
+            f"Expected one prediction per kept tile or per tile " \
+            f"({sorted(expected_lengths)}), got {len(preds)}."
+        if self.tile_keep_mask is not None \
+            and len(preds) == self.num_tiles_kept:
+            tile_indices = np.flatnonzero(self.tile_keep_mask)
+        else:
+            tile_indices = np.arange(len(preds))
+        n_preds = 1 if preds.ndim == 1 else int(np.prod(preds.shape[1:]))
+        writer = self.make_pred_table_writer(
+            table_path=table_path, tile_y=tile_y, tile_x=tile_x, 
+            n_preds=n_preds, use_parquet=use_parquet, *args, **kwargs
+        )
+        with writer:
+            for start in range(0, len(preds), row_group_size):
+                stop = start + row_group_size
+                writer.write(tile_indices[start:stop], preds[start:stop])
+        return writer.table_writer.filepath
+
+
     def _save_preds_as_csv(
-        self, geotiff_path: str, preds: np.ndarray, 
+        self, table_path: str, preds: np.ndarray, 
         tile_y: Optional[int] = None, tile_x: Optional[int] = None,
         *args, **kwargs
-    ) -> None:
-        # @TODO: IMPLEMENT THIS
-        raise NotImplementedError
+    ) -> str:
+        return self._save_preds_as_table(
+            table_path=table_path, preds=preds, use_parquet=False, 
+            tile_y=tile_y, tile_x=tile_x, *args, **kwargs
+        )
+
+
+    def _save_preds_as_parquet(
+        self, table_path: str, preds: np.ndarray, 
+        tile_y: Optional[int] = None, tile_x: Optional[int] = None,
+        *args, **kwargs
+    ) -> str:
+        return self._save_preds_as_table(
+            table_path=table_path, preds=preds, use_parquet=True, 
+            tile_y=tile_y, tile_x=tile_x, *args, **kwargs
+        )
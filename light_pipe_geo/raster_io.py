@@ -6,14 +6,23 @@ This module contains utility functions which facilitate file I/O.
 """
 
 
+import csv
 import json
+import logging
 import os
 import shutil
-from typing import List, Optional
+from typing import Dict, Generator, List, Optional
 
 import numpy as np
 from osgeo import gdal, ogr
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
 gdal.UseExceptions()
 ogr.UseExceptions()
 
@@ -64,6 +73,18 @@ def write_array_to_dataset(
     return dataset
 
 
+def write_block_to_dataset(
+    array: np.ndarray, dataset: gdal.Dataset, xoff: int, yoff: int, 
+    *args, **kwargs
+) -> gdal.Dataset:
+    if array.ndim == 2:
+        array = array[np.newaxis]
+    for i in range(array.shape[0]):
+        band = dataset.GetRasterBand(i + 1)
+        band.WriteArray(array[i], xoff=xoff, yoff=yoff)
+    return dataset
+
+
 def get_shapefile_attributes(
     vector_datasource: ogr.DataSource, *args, **kwargs
 ) -> List[str]:
@@ -123,3 +144,117 @@ def get_grid_cell_filepath(
             os.makedirs(directory)
     out_filepath = f"{directory}{qkey}{extension}" 
     return out_filepath
+
+
+class TableWriter:
+    """
+    Appends equal-length columns to a Parquet file, one row group per call 
+    to `write`. Falls back to CSV when `filepath` has a `.csv` extension or 
+    `pyarrow` is not installed.
+    """
+    def __init__(
+        self, filepath: str, column_names: List[str], 
+        use_parquet: Optional[bool] = None
+    ):
+        if use_parquet is None:
+            use_parquet = file_is_a(filepath, ".parquet")
+        if use_parquet and pq is None:
+            filepath = os.path.splitext(filepath)[0] + ".csv"
+            logging.warning(
+                f"`pyarrow` is not installed. Writing CSV to {filepath} instead."
+            )
+            use_parquet = False
+        self.filepath = filepath
+        self.column_names = column_names
+        self.use_parquet = use_parquet
+
+        self._parquet_writer = None
+        self._csv_file = None
+        self._csv_writer = None
+
+
+    def write(self, columns: Dict[str, np.ndarray]) -> None:
+        if self.use_parquet:
+            table = pa.table(
+                {name: np.asarray(columns[name]) for name in self.column_names}
+            )
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.filepath, table.schema)
+            self._parquet_writer.write_table(table)
+        else:
+            if self._csv_writer is None:
+                self._csv_file = open(self.filepath, "w", newline="")
+                self._csv_writer = csv.writer(self._csv_file)
+                self._csv_writer.writerow(self.column_names)
+            self._csv_writer.writerows(
+                zip(*[np.asarray(columns[name]).tolist() for name in self.column_names])
+            )
+
+
+    def close(self) -> str:
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        if self._csv_file is not None:
+            self._csv_file.close()
+            self._csv_file = None
+            self._csv_writer = None
+        return self.filepath
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+
+def read_table_columns(
+    filepath: str, column_names: List[str], dtype = None
+) -> Dict[str, np.ndarray]:
+    """
+    Reads only `column_names` from a Parquet or CSV file written by 
+    `TableWriter` and returns them as NumPy arrays. CSV columns must be 
+    numeric.
+    """
+    if file_is_a(filepath, ".parquet"):
+        assert pq is not None, "`pyarrow` is required to read Parquet files."
+        table = pq.read_table(filepath, columns=column_names)
+        columns = {
+            name: table.column(name).to_numpy() for name in column_names
+        }
+    else:
+        with open(filepath, "r", newline="") as f:
+            header = next(csv.reader(f))
+        usecols = [header.index(name) for name in column_names]
+        data = np.loadtxt(
+            filepath, delimiter=",", skiprows=1, usecols=usecols, 
+            dtype=np.float64 if dtype is None else dtype, ndmin=2
+        )
+        columns = {
+            name: data[:, i] for i, name in enumerate(column_names)
+        }
+    if dtype is not None:
+        columns = {name: col.astype(dtype) for name, col in columns.items()}
+    return columns
+
+
+def iter_table_columns(
+    filepath: str, column_names: List[str], chunk_size: Optional[int] = 1048576
+) -> Generator:
+    """
+    Streams `column_names` from a Parquet file in record batches of at most
+    `chunk_size` rows, yielding a dict of NumPy arrays per batch.
+    """
+    assert file_is_a(filepath, ".parquet"), \
+        f"Only Parquet files can be streamed. Passed file: {filepath}."
+    assert pq is not None, "`pyarrow` is required to read Parquet files."
+    parquet_file = pq.ParquetFile(filepath)
+    for batch in parquet_file.iter_batches(
+        batch_size=chunk_size, columns=column_names
+    ):
+        yield {
+            name: batch.column(i).to_numpy(zero_copy_only=False) 
+            for i, name in enumerate(column_names)
+        }
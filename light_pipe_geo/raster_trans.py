@@ -7,25 +7,105 @@ This module contains functions which operate on `gdal.Dataset` instances,
 """
 
 
+import concurrent.futures
 import os
-from typing import Callable, List, Optional, Tuple, Union
+import threading
+from typing import Callable, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
-from osgeo import gdal, ogr, osr
+from osgeo import gdal, gdal_array, ogr, osr
 
-from light_pipe_geo import gdal_data_handlers, raster_io, tiling
+from light_pipe_geo import gdal_data_handlers, raster_io, tiling, vsimem
 
 gdal.UseExceptions()
 ogr.UseExceptions()
 osr.UseExceptions()
 
 
+# Overviews are built until the smaller side of the coarsest level is below this
+OVERVIEW_MIN_SIZE = 256
+
+_OVERVIEWS_LOCK = threading.Lock()
+
+
+def get_overview_factors(
+    raster_x_size: int, raster_y_size: int, 
+    min_size: Optional[int] = OVERVIEW_MIN_SIZE
+) -> List[int]:
+    factors = []
+    factor = 2
+    while min(raster_x_size, raster_y_size) // factor >= min_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def build_overviews(
+    dataset: gdal.Dataset, factors: Optional[List[int]] = None,
+    resampling: Optional[str] = "AVERAGE", 
+    min_size: Optional[int] = OVERVIEW_MIN_SIZE
+) -> gdal.Dataset:
+    """
+    Builds power-of-two overviews of `dataset` unless it already has them. 
+    Datasets opened read-only get external `.ovr` overviews, so they are 
+    built once per scene and reused by later runs. Use `NEAREST` resampling 
+    for masks and labels.
+
+    `/vsimem` datasets are left as they are: their `.ovr` would be a second
+    virtual file which nothing unlinks.
+    """
+    if dataset.GetDescription().startswith(vsimem.VSIMEM_PREFIX):
+        return dataset
+    if factors is None:
+        factors = get_overview_factors(
+            dataset.RasterXSize, dataset.RasterYSize, min_size=min_size
+        )
+    if not factors:
+        return dataset
+    with _OVERVIEWS_LOCK:
+        if dataset.GetRasterBand(1).GetOverviewCount() < len(factors):
+            dataset.BuildOverviews(resampling, factors)
+    return dataset
+
+
+def get_overview_level(
+    dataset: gdal.Dataset, pixel_size: float
+) -> Optional[int]:
+    """
+    Returns the index of the coarsest overview of `dataset` whose pixels are
+    no larger than `pixel_size` (in the units of the dataset's geotransform),
+    or None if the full-resolution dataset should be read.
+    """
+    src_pixel_size = abs(dataset.GetGeoTransform()[1])
+    ratio = abs(pixel_size) / src_pixel_size
+    band = dataset.GetRasterBand(1)
+    level = None
+    best_factor = 1.0
+    for i in range(band.GetOverviewCount()):
+        factor = dataset.RasterXSize / band.GetOverview(i).XSize
+        if best_factor < factor <= ratio:
+            level, best_factor = i, factor
+    return level
+
+
+def read_overview_as_array(dataset: gdal.Dataset, level: int) -> np.ndarray:
+    arrays = [
+        dataset.GetRasterBand(i).GetOverview(level).ReadAsArray()
+        for i in range(1, dataset.RasterCount + 1)
+    ]
+    if len(arrays) == 1:
+        return arrays[0]
+    return np.stack(arrays)
+
+
 def translate_dataset(
     dataset: gdal.Dataset, filepath: str, raster_x_size: int,
     raster_y_size: int, n_bands: int, dtype, geotransform, projection, driver_name,
     srs: osr.SpatialReference, ulx: Union[float, int], uly: Union[float, int], 
     lrx: Union[float, int], lry: Union[float, int], noData = None, *args, **kwargs
 ):
+    # When the output is coarser than `dataset`, GDAL reads from the 
+    # closest overview that is not coarser than the output, if any exist
     proj_win = [ulx, uly, lrx, lry]
     band_list = [i for i in range(1, n_bands + 1)]
     out_dataset = gdal.Translate(
@@ -119,6 +199,30 @@ def rasterize_datasources(
         yield item_uid, (dataset, False, metadata)
 
 
+def get_tile_grid_geotransform(
+    dataset: gdal.Dataset, tile_y: int, tile_x: int, 
+    use_ancestor_pixel_size = False, pixel_x_size = None, pixel_y_size = None,
+    assert_north_up: Optional[bool] = True, *args, **kwargs
+) -> tuple:
+    """
+    Geotransform of a raster with one pixel per `tile_y` by `tile_x` tile of
+    `dataset`.
+    """
+    if use_ancestor_pixel_size:
+        gt_0, pixel_x_size, gt_2, gt_3, gt_4, pixel_y_size = dataset.GetGeoTransform()
+        if assert_north_up:
+            ancestor_filepath = dataset.GetDescription()
+            assert abs(gt_2) <= 1e-16 and (gt_4) <= 1e-16, \
+                f"Transformation coefficients are not equal to zero for dataset {ancestor_filepath}."
+    else:
+        assert pixel_y_size is not None
+        assert pixel_x_size is not None
+        gt_0, _, _, gt_3, _, _ = dataset.GetGeoTransform()
+    return (
+        gt_0, tile_x * pixel_x_size, 0.0, gt_3, 0.0, tile_y * pixel_y_size
+    )
+
+
 @gdal_data_handlers.open_data
 def make_north_up_dataset_from_tiles_like(
     datasets: List[gdal.Dataset], filepath: str, tiles: np.ndarray, tile_y: int, 
@@ -139,20 +243,11 @@ def make_north_up_dataset_from_tiles_like(
         return dataset
 
 
-    if use_ancestor_pixel_size:
-        gt_0, pixel_x_size, gt_2, gt_3, gt_4, pixel_y_size = datasets[0].GetGeoTransform()
-        if assert_north_up:
-            ancestor_filepath = datasets[0].GetDescription()
-            assert abs(gt_2) <= 1e-16 and (gt_4) <= 1e-16, \
-                f"Transformation coefficients are not equal to zero for dataset {ancestor_filepath}."
-    else:
-        assert pixel_y_size is not None
-        assert pixel_x_size is not None
-        gt_0, _, _, gt_3, _, _ = datasets[0].GetGeoTransform()
-    out_projection = datasets[0].GetProjection()
-    out_geotransform = (
-        gt_0, tile_x * pixel_x_size, 0.0, gt_3, 0.0, tile_y * pixel_y_size
+    out_geotransform = get_tile_grid_geotransform(
+        datasets[0], tile_y, tile_x, use_ancestor_pixel_size, pixel_x_size, 
+        pixel_y_size, assert_north_up
     )
+    out_projection = datasets[0].GetProjection()
     raster_y = datasets[0].RasterYSize
     raster_x = datasets[0].RasterXSize
 
@@ -173,3 +268,163 @@ def make_north_up_dataset_from_tiles_like(
         out_dataset, tiles, out_raster_y_size, out_raster_x_size, row_major
     )
     return datasets, out_dataset
+
+
+class TilePredictionWriter:
+    """
+    Incrementally writes per-tile predictions, received as 
+    `(tile_indices, preds)` batches in any order, into a tiled raster with 
+    one pixel per tile. Predictions are buffered per output block and each 
+    block is written as soon as all of its expected pixels have arrived, so
+    memory is bounded by the number of partially-filled blocks. Tiles where 
+    `tile_keep_mask` is `False` are never predicted, so their pixels are not
+    waited for (and are left as zero). When `threaded` is `True` completed 
+    blocks are written by a single background thread, which lets writing 
+    overlap with inference; at most `max_pending_writes` blocks are queued 
+    for it before `write` waits on the oldest.
+    """
+    def __init__(
+        self, filepath: str, tile_coords: np.ndarray, tile_y: int, tile_x: int,
+        raster_y: int, raster_x: int, geotransform: tuple, projection: str, 
+        n_bands: Optional[int] = 1, dtype = gdal.GDT_Byte, 
+        block_size: Optional[int] = 256, out_driver: Optional[str] = "GTiff",
+        creation_options: Optional[List[str]] = None, 
+        threaded: Optional[bool] = True, 
+        tile_keep_mask: Optional[np.ndarray] = None,
+        max_pending_writes: Optional[int] = 4
+    ):
+        tile_coords = np.asarray(tile_coords)
+        self.out_raster_y_size = tiling.round_up(raster_y, tile_y) // tile_y
+        self.out_raster_x_size = tiling.round_up(raster_x, tile_x) // tile_x
+        self.rows = tile_coords[:, 0] // tile_y
+        self.cols = tile_coords[:, 1] // tile_x
+        # Pixels of the output raster for which a prediction will arrive
+        self._expected = np.zeros(
+            (self.out_raster_y_size, self.out_raster_x_size), dtype=bool
+        )
+        if tile_keep_mask is None:
+            self._expected[self.rows, self.cols] = True
+        else:
+            tile_keep_mask = np.asarray(tile_keep_mask, dtype=bool)
+            assert tile_keep_mask.shape == (len(tile_coords),), \
+                "`tile_keep_mask` must have one entry per row of `tile_coords`."
+            self._expected[self.rows[tile_keep_mask], self.cols[tile_keep_mask]] = True
+        self.n_bands = n_bands
+        self.block_size = block_size
+        self.geotransform = geotransform
+        self.projection = projection
+        self.array_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(dtype)
+
+        if creation_options is None:
+            creation_options = [
+                "TILED=YES", f"BLOCKXSIZE={block_size}", 
+                f"BLOCKYSIZE={block_size}"
+            ]
+        if isinstance(out_driver, str):
+            out_driver = gdal.GetDriverByName(out_driver)
+        self.dataset = out_driver.Create(
+            filepath, self.out_raster_x_size, self.out_raster_y_size, n_bands,
+            dtype, options=creation_options
+        )
+        self._blocks = dict()
+        if threaded:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        else:
+            self._executor = None
+        self.max_pending_writes = max_pending_writes
+        self._futures = list()
+
+
+    def _get_block_shape(self, block_row: int, block_col: int) -> Tuple[int, int]:
+        yoff = block_row * self.block_size
+        xoff = block_col * self.block_size
+        block_y = min(self.block_size, self.out_raster_y_size - yoff)
+        block_x = min(self.block_size, self.out_raster_x_size - xoff)
+        return block_y, block_x
+
+
+    def _write_block(self, block: np.ndarray, yoff: int, xoff: int) -> None:
+        raster_io.write_block_to_dataset(block, self.dataset, xoff=xoff, yoff=yoff)
+
+
+    def _flush_block(self, key: Tuple[int, int]) -> None:
+        block, _ = self._blocks.pop(key)
+        block_row, block_col = key
+        yoff = block_row * self.block_size
+        xoff = block_col * self.block_size
+        if self._executor is not None:
+            self._futures = [future for future in self._futures if not future.done()]
+            # Bound the blocks queued for the writer thread
+            while len(self._futures) >= max(self.max_pending_writes, 1):
+                self._futures.pop(0).result()
+            self._futures.append(
+                self._executor.submit(self._write_block, block, yoff, xoff)
+            )
+        else:
+            self._write_block(block, yoff, xoff)
+
+
+    def write(
+        self, tile_indices: Union[Sequence[int], np.ndarray], 
+        preds: Union[Sequence, np.ndarray]
+    ) -> None:
+        """
+        `tile_indices` index the `tile_coords` passed to `__init__`; `preds`
+        has shape `(B,)` or `(B, n_bands)`.
+        """
+        tile_indices = np.asarray(tile_indices)
+        preds = np.asarray(preds).reshape(len(tile_indices), -1)
+        assert preds.shape[1] == self.n_bands, \
+            f"Expected {self.n_bands} prediction(s) per tile, got {preds.shape[1]}."
+        rows = self.rows[tile_indices]
+        cols = self.cols[tile_indices]
+        block_rows = rows // self.block_size
+        block_cols = cols // self.block_size
+        n_block_cols = -(-self.out_raster_x_size // self.block_size)
+        block_ids = block_rows * n_block_cols + block_cols
+        for block_id in np.unique(block_ids):
+            in_block = block_ids == block_id
+            key = (int(block_id // n_block_cols), int(block_id % n_block_cols))
+            if key not in self._blocks:
+                block_y, block_x = self._get_block_shape(*key)
+                yoff = key[0] * self.block_size
+                xoff = key[1] * self.block_size
+                # Pixels no prediction will arrive for start out filled
+                self._blocks[key] = (
+                    np.zeros((self.n_bands, block_y, block_x), dtype=self.array_dtype),
+                    ~self._expected[yoff:yoff + block_y, xoff:xoff + block_x]
+                )
+            block, filled = self._blocks[key]
+            block_y_ids = rows[in_block] % self.block_size
+            block_x_ids = cols[in_block] % self.block_size
+            block[:, block_y_ids, block_x_ids] = preds[in_block].T
+            filled[block_y_ids, block_x_ids] = True
+            if filled.all():
+                self._flush_block(key)
+
+
+    def close(self) -> gdal.Dataset:
+        """
+        Writes any partially-filled blocks (missing tiles are left as zero),
+        waits for pending writes and sets the georeferencing.
+        """
+        for key in list(self._blocks.keys()):
+            self._flush_block(key)
+        if self._executor is not None:
+            for future in self._futures:
+                future.result()
+            self._executor.shutdown()
+            self._executor = None
+        self._futures = list()
+        self.dataset.SetGeoTransform(self.geotransform)
+        self.dataset.SetProjection(self.projection)
+        self.dataset.FlushCache()
+        return self.dataset
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
@@ -0,0 +1,187 @@
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+__doc__ = """
+This module contains vectorized band math for computing spectral indices from
+multispectral raster arrays, along with lookup-table colormapping of the
+results. Every function operates on arrays of any leading shape so that whole
+batches of tiles can be processed in a single call.
+"""
+
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+
+# Band order of PlanetScope 4-band analytic assets
+PLANETSCOPE_4_BAND_MAP = {"blue": 0, "green": 1, "red": 2, "nir": 3}
+# Band order of RGB(A) basemap tiles
+RGB_BAND_MAP = {"red": 0, "green": 1, "blue": 2}
+
+# Multiplies analytic_sr digital numbers into surface reflectance
+PLANETSCOPE_SR_SCALE = 1e-4
+RGB_SCALE = 1 / 255
+
+
+def _safe_divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    out = np.full(np.broadcast(numerator, denominator).shape, np.nan, dtype=np.float32)
+    np.divide(numerator, denominator, out=out, where=denominator != 0)
+    return out
+
+
+def ndvi(nir: np.ndarray, red: np.ndarray) -> np.ndarray:
+    return _safe_divide(nir - red, nir + red)
+
+
+def ndwi(green: np.ndarray, nir: np.ndarray) -> np.ndarray:
+    return _safe_divide(green - nir, green + nir)
+
+
+def msavi2(nir: np.ndarray, red: np.ndarray) -> np.ndarray:
+    a = 2 * nir + 1
+    return (a - np.sqrt(np.maximum(a ** 2 - 8 * (nir - red), 0))) / 2
+
+
+def mtvi2(nir: np.ndarray, red: np.ndarray, green: np.ndarray) -> np.ndarray:
+    numerator = 1.5 * (1.2 * (nir - green) - 2.5 * (red - green))
+    denominator = np.sqrt(np.maximum(
+        (2 * nir + 1) ** 2 - (6 * nir - 5 * np.sqrt(np.maximum(red, 0))) - 0.5, 0
+    ))
+    return _safe_divide(numerator, denominator)
+
+
+def vari(green: np.ndarray, red: np.ndarray, blue: np.ndarray) -> np.ndarray:
+    return _safe_divide(green - red, green + red - blue)
+
+
+def tgi(red: np.ndarray, green: np.ndarray, blue: np.ndarray) -> np.ndarray:
+    # Normalized form of the triangular greenness index
+    return green - 0.39 * red - 0.61 * blue
+
+
+# Index name: (function, names of the bands it takes, display range)
+SPECTRAL_INDICES = {
+    "ndvi": (ndvi, ("nir", "red"), (-1.0, 1.0)),
+    "ndwi": (ndwi, ("green", "nir"), (-1.0, 1.0)),
+    "msavi2": (msavi2, ("nir", "red"), (-1.0, 1.0)),
+    "mtvi2": (mtvi2, ("nir", "red", "green"), (-1.0, 1.0)),
+    "vari": (vari, ("green", "red", "blue"), (-1.0, 1.0)),
+    "tgi": (tgi, ("red", "green", "blue"), (-0.5, 0.5)),
+}
+
+DEFAULT_COLORMAPS = {
+    "ndvi": "rdylgn",
+    "ndwi": "brbg",
+    "msavi2": "rdylgn",
+    "mtvi2": "rdylgn",
+    "vari": "rdylgn",
+    "tgi": "rdylgn",
+}
+
+# Colormap name: RGB control points spaced evenly over the display range
+COLORMAP_CONTROL_POINTS = {
+    "rdylgn": [
+        (165, 0, 38), (244, 109, 67), (254, 224, 139), (217, 239, 139),
+        (102, 189, 99), (0, 104, 55)
+    ],
+    "brbg": [
+        (140, 81, 10), (223, 194, 125), (245, 245, 245), (128, 205, 193),
+        (1, 102, 94)
+    ],
+    "gray": [(0, 0, 0), (255, 255, 255)],
+}
+
+
+def get_index_bands(index_name: str) -> Tuple[str, ...]:
+    assert index_name in SPECTRAL_INDICES, \
+        f"Spectral index `{index_name}` not recognized."
+    return SPECTRAL_INDICES[index_name][1]
+
+
+def can_compute_index(index_name: str, band_map: dict) -> bool:
+    return all(band in band_map for band in get_index_bands(index_name))
+
+
+def compute_indices(
+    array: np.ndarray, index_names: Iterable[str],
+    band_map: Optional[dict] = PLANETSCOPE_4_BAND_MAP,
+    scale: Optional[float] = PLANETSCOPE_SR_SCALE, band_axis: Optional[int] = -3
+) -> Dict[str, np.ndarray]:
+    """
+    Computes several spectral indices from `array` in one pass. `array` has
+    bands along `band_axis` (e.g. `(C, H, W)` or `(N, C, H, W)`); each band
+    is converted to reflectance once and shared by every index. Returns a
+    dict of `float32` arrays with the band axis removed.
+    """
+    index_names = list(index_names)
+    needed_bands = set()
+    for index_name in index_names:
+        assert can_compute_index(index_name, band_map), \
+            f"Spectral index `{index_name}` requires bands " \
+            f"{get_index_bands(index_name)} but only {list(band_map)} are available."
+        needed_bands.update(get_index_bands(index_name))
+    bands = {
+        band: np.take(array, band_map[band], axis=band_axis).astype(np.float32) * np.float32(scale)
+        for band in needed_bands
+    }
+    indices = dict()
+    for index_name in index_names:
+        fn, band_names, _ = SPECTRAL_INDICES[index_name]
+        indices[index_name] = fn(*[bands[band] for band in band_names]).astype(
+            np.float32, copy=False
+        )
+    return indices
+
+
+def make_colormap_lut(colormap: Optional[str] = "rdylgn", num_colors: Optional[int] = 256) -> np.ndarray:
+    assert colormap in COLORMAP_CONTROL_POINTS, \
+        f"Colormap `{colormap}` not recognized."
+    control_points = np.asarray(COLORMAP_CONTROL_POINTS[colormap], dtype=np.float32)
+    positions = np.linspace(0, 1, len(control_points))
+    samples = np.linspace(0, 1, num_colors)
+    lut = np.stack(
+        [np.interp(samples, positions, control_points[:, i]) for i in range(3)],
+        axis=-1
+    )
+    return np.round(lut).astype(np.uint8)
+
+
+def colormap_index(
+    values: np.ndarray, vmin: Optional[float] = None, vmax: Optional[float] = None,
+    colormap: Optional[str] = "rdylgn", index_name: Optional[str] = None
+) -> np.ndarray:
+    """
+    Maps index values to RGBA `uint8` colors with a lookup table. Values
+    outside `[vmin, vmax]` are clipped and NaNs are transparent. If
+    `index_name` is passed, its display range is used for unset bounds.
+    """
+    if index_name is not None:
+        default_vmin, default_vmax = SPECTRAL_INDICES[index_name][2]
+        vmin = default_vmin if vmin is None else vmin
+        vmax = default_vmax if vmax is None else vmax
+    assert vmin is not None and vmax is not None and vmax > vmin, \
+        "`vmax` must be greater than `vmin`."
+    lut = make_colormap_lut(colormap)
+    valid = np.isfinite(values)
+    scaled = (np.where(valid, values, vmin) - vmin) / (vmax - vmin)
+    lut_indices = np.clip(
+        np.round(scaled * (len(lut) - 1)), 0, len(lut) - 1
+    ).astype(np.intp)
+    rgba = np.empty((*values.shape, 4), dtype=np.uint8)
+    rgba[..., :3] = lut[lut_indices]
+    rgba[..., 3] = np.where(valid, 255, 0)
+    return rgba
+
+
+def colormap_indices(
+    indices: Dict[str, np.ndarray], colormaps: Optional[dict] = None
+) -> Dict[str, np.ndarray]:
+    if colormaps is None:
+        colormaps = DEFAULT_COLORMAPS
+    return {
+        index_name: colormap_index(
+            values, colormap=colormaps.get(index_name, "rdylgn"),
+            index_name=index_name
+        )
+        for index_name, values in indices.items()
+    }
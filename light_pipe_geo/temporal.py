@@ -0,0 +1,290 @@
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+__doc__ = """
+This module contains an append-only store for time series of aligned raster
+tiles. Every acquisition of a grid cell is stored as one timestep of a single
+`(T, C, H, W)` array on disk, alongside per-timestep UDM masks and acquisition
+timestamps, so that a whole time series can be read with one sequential read.
+"""
+
+import json
+import os
+import threading
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+
+_LOCKS = dict()
+_LOCKS_LOCK = threading.Lock()
+
+
+def _get_lock(path: str) -> threading.Lock:
+    path = os.path.abspath(path)
+    with _LOCKS_LOCK:
+        if path not in _LOCKS:
+            _LOCKS[path] = threading.Lock()
+        return _LOCKS[path]
+
+
+class TemporalCube:
+    """
+    Directory-backed `(T, C, H, W)` array with a `(T, H, W)` UDM mask.
+
+    Timesteps are appended to the end of raw C-order files, so adding an
+    acquisition never rewrites existing data. `index.json` records the shape,
+    dtypes, timestamps and asset IDs, and is replaced atomically after each
+    append; bytes beyond the timesteps it lists are ignored and overwritten
+    by the next append.
+    """
+    DATA_FILENAME: str = "cube.dat"
+    UDM_FILENAME: str = "udm.dat"
+    INDEX_FILENAME: str = "index.json"
+
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data_path = os.path.join(path, self.DATA_FILENAME)
+        self.udm_path = os.path.join(path, self.UDM_FILENAME)
+        self.index_path = os.path.join(path, self.INDEX_FILENAME)
+        self._lock = _get_lock(path)
+
+
+    def read_index(self) -> Optional[dict]:
+        if not os.path.exists(self.index_path):
+            return None
+        with open(self.index_path, "r") as f:
+            return json.load(f)
+
+
+    def _write_index(self, index: dict) -> None:
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+
+    def __len__(self) -> int:
+        index = self.read_index()
+        if index is None:
+            return 0
+        return len(index["timestamps"])
+
+
+    @staticmethod
+    def _append_frames(path: str, frames: np.ndarray, num_valid: int) -> None:
+        frame_bytes = frames[0].nbytes
+        mode = "r+b" if os.path.exists(path) else "wb"
+        with open(path, mode) as f:
+            # Drop any bytes left by an interrupted append
+            f.truncate(num_valid * frame_bytes)
+            f.seek(num_valid * frame_bytes)
+            f.write(np.ascontiguousarray(frames).tobytes())
+
+
+    def append(
+        self, array: np.ndarray, udm: np.ndarray,
+        timestamps: Union[str, List[str]], asset_ids: Union[str, List[str]],
+        geotransform: Optional[Tuple] = None, projection: Optional[str] = None
+    ) -> int:
+        """
+        Appends one `(C, H, W)` or several `(N, C, H, W)` acquisitions with
+        their `(H, W)` / `(N, H, W)` UDM masks. Acquisitions whose asset ID
+        is already in the cube are skipped. Returns the number appended.
+        """
+        if array.ndim == 3:
+            array, udm = array[np.newaxis], udm[np.newaxis]
+            timestamps, asset_ids = [timestamps], [asset_ids]
+        if udm.ndim == 4: # Single-band UDM read as (N, 1, H, W)
+            udm = udm[:, 0]
+        assert len(array) == len(udm) == len(timestamps) == len(asset_ids), \
+            "`array`, `udm`, `timestamps` and `asset_ids` must have the same length."
+        assert array.shape[-2:] == udm.shape[-2:], \
+            "`array` and `udm` must have the same height and width."
+
+        with self._lock:
+            index = self.read_index()
+            if index is None:
+                os.makedirs(self.path, exist_ok=True)
+                index = {
+                    "shape": list(array.shape[1:]), "dtype": array.dtype.str,
+                    "udm_dtype": udm.dtype.str, "timestamps": list(),
+                    "asset_ids": list(), "geotransform": geotransform,
+                    "projection": projection
+                }
+            assert list(array.shape[1:]) == index["shape"], \
+                f"Cannot append arrays of shape {array.shape[1:]} to a cube " \
+                f"of shape {index['shape']}."
+            existing = set(index["asset_ids"])
+            keep = [
+                i for i, asset_id in enumerate(asset_ids)
+                if asset_id not in existing
+            ]
+            if not keep:
+                return 0
+            num_valid = len(index["timestamps"])
+            self._append_frames(
+                self.data_path, array[keep].astype(np.dtype(index["dtype"]), copy=False),
+                num_valid
+            )
+            self._append_frames(
+                self.udm_path, udm[keep].astype(np.dtype(index["udm_dtype"]), copy=False),
+                num_valid
+            )
+            index["timestamps"].extend(timestamps[i] for i in keep)
+            index["asset_ids"].extend(asset_ids[i] for i in keep)
+            self._write_index(index)
+        return len(keep)
+
+
+    def read(
+        self, sort_by_time: Optional[bool] = True, mmap: Optional[bool] = False
+    ) -> Tuple[np.ndarray, np.ndarray, List[str], List[str]]:
+        """
+        Returns `(cube, udm, timestamps, asset_ids)`. The cube and mask are
+        each read with one sequential read (or memory-mapped if `mmap`) and
+        are ordered by acquisition time if `sort_by_time`.
+        """
+        index = self.read_index()
+        assert index is not None, f"No temporal cube found at {self.path}."
+        num_timesteps = len(index["timestamps"])
+        shape = (num_timesteps, *index["shape"])
+        udm_shape = (num_timesteps, *index["shape"][1:])
+        if mmap:
+            cube = np.memmap(self.data_path, dtype=index["dtype"], mode="r", shape=shape)
+            udm = np.memmap(self.udm_path, dtype=index["udm_dtype"], mode="r", shape=udm_shape)
+        else:
+            cube = np.fromfile(
+                self.data_path, dtype=index["dtype"], count=int(np.prod(shape))
+            ).reshape(shape)
+            udm = np.fromfile(
+                self.udm_path, dtype=index["udm_dtype"], count=int(np.prod(udm_shape))
+            ).reshape(udm_shape)
+        timestamps, asset_ids = index["timestamps"], index["asset_ids"]
+        if sort_by_time:
+            order = sorted(
+                range(num_timesteps), key=lambda i: (timestamps[i] or "", asset_ids[i])
+            )
+            if order != list(range(num_timesteps)):
+                cube, udm = cube[order], udm[order]
+                timestamps = [timestamps[i] for i in order]
+                asset_ids = [asset_ids[i] for i in order]
+        return cube, udm, timestamps, asset_ids
+
+
+def get_clear_mask(udm: np.ndarray, clear_value: Optional[int] = 0) -> np.ndarray:
+    """
+    Returns a boolean mask of the pixels of `udm` which are clear. Any other
+    UDM value (blackfill, cloud, etc.) is treated as unusable.
+    """
+    return udm == clear_value
+
+
+def _fill_unobserved(
+    composite: np.ndarray, clear: np.ndarray, no_data_value: Union[int, float]
+) -> np.ndarray:
+    composite[:, ~clear.any(axis=0)] = no_data_value
+    return composite
+
+
+def median_composite(
+    cube: np.ndarray, clear: np.ndarray, no_data_value: Optional[Union[int, float]] = 0
+) -> np.ndarray:
+    """
+    Per-pixel median of the clear observations of a `(T, C, H, W)` cube.
+    """
+    values = np.where(clear[:, np.newaxis], cube.astype(np.float32), np.nan)
+    observed = clear.any(axis=0)
+    composite = np.full(cube.shape[1:], no_data_value, dtype=np.float32)
+    # Only take the median where there is at least one clear observation
+    composite[:, observed] = np.nanmedian(values[:, :, observed], axis=0)
+    if np.issubdtype(cube.dtype, np.integer):
+        composite = np.round(composite)
+    return composite.astype(cube.dtype)
+
+
+def best_pixel_composite(
+    cube: np.ndarray, clear: np.ndarray, scores: Optional[np.ndarray] = None,
+    no_data_value: Optional[Union[int, float]] = 0
+) -> np.ndarray:
+    """
+    Takes, for each pixel, the clear observation with the highest `(T, H, W)`
+    score. By default the score is the negated first (blue) band, which
+    prefers the least hazy observation.
+    """
+    if scores is None:
+        scores = -cube[:, 0].astype(np.float32)
+    scores = np.where(clear, scores, -np.inf)
+    best = np.argmax(scores, axis=0)
+    composite = np.take_along_axis(
+        cube, best[np.newaxis, np.newaxis], axis=0
+    )[0]
+    return _fill_unobserved(composite, clear, no_data_value)
+
+
+def latest_clear_composite(
+    cube: np.ndarray, clear: np.ndarray,
+    no_data_value: Optional[Union[int, float]] = 0
+) -> np.ndarray:
+    """
+    Takes, for each pixel, its most recent clear observation. `cube` must be
+    ordered by acquisition time.
+    """
+    latest = len(cube) - 1 - np.argmax(clear[::-1], axis=0)
+    composite = np.take_along_axis(
+        cube, latest[np.newaxis, np.newaxis], axis=0
+    )[0]
+    return _fill_unobserved(composite, clear, no_data_value)
+
+
+COMPOSITE_METHODS = {
+    "median": median_composite,
+    "best_pixel": best_pixel_composite,
+    "latest_clear": latest_clear_composite,
+}
+
+
+def get_time_window(timestamp: str, window: Optional[str] = "month") -> str:
+    """
+    Maps an ISO 8601 timestamp to the name of its `month`, `quarter`, `year`
+    or `all` compositing window.
+    """
+    year, month = timestamp[:4], timestamp[5:7]
+    if window == "month":
+        return f"{year}_{month}"
+    if window == "quarter":
+        return f"{year}_Q{(int(month) - 1) // 3 + 1}"
+    if window == "year":
+        return year
+    assert window == "all", f"Compositing window `{window}` not recognized."
+    return "all"
+
+
+def composite_by_window(
+    cube: np.ndarray, udm: np.ndarray, timestamps: List[Optional[str]],
+    method: Optional[str] = "median", window: Optional[str] = "month",
+    clear_value: Optional[int] = 0, no_data_value: Optional[Union[int, float]] = 0
+) -> dict:
+    """
+    Composites a time-ordered `(T, C, H, W)` cube over each time window.
+    Returns a dict mapping window names to `(composite, num_clear)`, where
+    `num_clear` is the `(H, W)` number of clear observations per pixel.
+    Timesteps without a timestamp are ignored.
+    """
+    assert method in COMPOSITE_METHODS, \
+        f"Compositing method `{method}` not recognized."
+    composite_fn = COMPOSITE_METHODS[method]
+    windows = dict()
+    for i, timestamp in enumerate(timestamps):
+        if timestamp is not None:
+            windows.setdefault(get_time_window(timestamp, window), list()).append(i)
+    composites = dict()
+    for window_name, ids in windows.items():
+        window_cube = cube[ids]
+        clear = get_clear_mask(udm[ids], clear_value=clear_value)
+        composites[window_name] = (
+            composite_fn(window_cube, clear, no_data_value=no_data_value),
+            clear.sum(axis=0)
+        )
+    return composites
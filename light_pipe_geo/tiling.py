@@ -10,12 +10,12 @@ latter as _tiles_.
 """
 
 
-from typing import List, Optional, Tuple
+from typing import Generator, List, Optional, Tuple, Union
 
 import numpy as np
 from osgeo import gdal
 
-from light_pipe_geo import gdal_data_handlers
+from light_pipe_geo import gdal_data_handlers, raster_io
 
 gdal.UseExceptions()
 
@@ -73,6 +73,405 @@ def get_tiles_from_padded_array(
         yield tile
 
 
+def get_channel_index(channels: List[int]) -> Union[slice, List[int]]:
+    """
+    Returns a `slice` when `channels` are consecutive so that indexing the 
+    band axis with the result produces a view rather than a copy.
+    """
+    if len(channels) == 0:
+        return slice(0, 0)
+    start = channels[0]
+    stop = channels[-1] + 1
+    if list(channels) == list(range(start, stop)):
+        return slice(start, stop)
+    return list(channels)
+
+
+def get_tile_view_from_padded_array(
+    padded: np.ndarray, tile_y: int, tile_x: int, *args, **kwargs
+) -> np.ndarray:
+    """
+    Returns a zero-copy view of `padded` with shape 
+    `(n_tiles_y, n_tiles_x, C, tile_y, tile_x)` such that 
+    `view[uly // tile_y, ulx // tile_x]` is the tile with upper-left pixel
+    `(uly, ulx)`.
+    """
+    assert padded.shape[-2] % tile_y == 0, \
+        "`tile_y` must evenly divide the padded array's y dimension."
+    assert padded.shape[-1] % tile_x == 0, \
+        "`tile_x` must evenly divide the padded array's x dimension."
+    n_channels, padded_y, padded_x = padded.shape
+    blocked = padded.reshape(
+        n_channels, padded_y // tile_y, tile_y, padded_x // tile_x, tile_x
+    )
+    return blocked.transpose(1, 3, 0, 2, 4)
+
+
+def get_nonzero_tile_mask(
+    padded: np.ndarray, tile_coords: np.ndarray, tile_y: int, tile_x: int,
+    channels: Union[slice, List[int]], *args, **kwargs
+) -> np.ndarray:
+    """
+    Returns a boolean array with one entry per row of `tile_coords` which is 
+    `True` when the tile contains at least one non-zero value in `channels`. 
+    The test is computed for every tile at once with a reduction over a 
+    blocked view of `padded`.
+    """
+    n_channels, padded_y, padded_x = padded.shape
+    assert padded_y % tile_y == 0, \
+        "`tile_y` must evenly divide the padded array's y dimension."
+    assert padded_x % tile_x == 0, \
+        "`tile_x` must evenly divide the padded array's x dimension."
+    selected = padded[channels]
+    blocked = selected.reshape(
+        selected.shape[0], padded_y // tile_y, tile_y, padded_x // tile_x, tile_x
+    )
+    nonzero_grid = blocked.any(axis=(0, 2, 4))
+    tile_coords = np.asarray(tile_coords)
+    return nonzero_grid[tile_coords[:, 0] // tile_y, tile_coords[:, 1] // tile_x]
+
+
+def get_tile_keep_mask(
+    padded: np.ndarray, tile_coords: np.ndarray, tile_y: int, tile_x: int,
+    band_map: dict, pos_only: Optional[bool] = False, 
+    non_null_only: Optional[bool] = False, *args, **kwargs
+) -> np.ndarray:
+    """
+    Returns a boolean array with one entry per row of `tile_coords` which is 
+    `False` for tiles dropped by `pos_only` (all-zero label bands) or 
+    `non_null_only` (all-zero non-label bands).
+    """
+    keep = np.ones(len(tile_coords), dtype=bool)
+    if pos_only:
+        keep &= get_nonzero_tile_mask(
+            padded, tile_coords, tile_y, tile_x, 
+            get_channel_index(band_map[True])
+        )
+    if non_null_only:
+        keep &= get_nonzero_tile_mask(
+            padded, tile_coords, tile_y, tile_x, 
+            get_channel_index(band_map[False])
+        )
+    return keep
+
+
+def _gather_from_view(
+    view: np.ndarray, batch_ids_y: np.ndarray, batch_ids_x: np.ndarray,
+    channel_index: Union[slice, List[int]]
+) -> np.ndarray:
+    """
+    Gathers the `(B, C, y, x)` batch of tiles `(batch_ids_y, batch_ids_x)` 
+    restricted to `channel_index`. A list of channels is an index array like
+    the tile ids, so the ids are given a trailing axis to broadcast against 
+    it rather than be paired with it element-wise.
+    """
+    if isinstance(channel_index, slice):
+        return view[batch_ids_y, batch_ids_x, channel_index]
+    channel_index = np.asarray(channel_index)
+    return view[
+        batch_ids_y[:, np.newaxis], batch_ids_x[:, np.newaxis], 
+        channel_index[np.newaxis, :]
+    ]
+
+
+def _get_batches_from_view(
+    view: np.ndarray, ids_y: np.ndarray, ids_x: np.ndarray, batch_size: int,
+    band_map: Optional[dict] = None
+) -> Generator:
+    if band_map is None:
+        X_index = slice(None)
+        y_index = None
+    else:
+        X_index = get_channel_index(band_map[False])
+        y_index = get_channel_index(band_map[True])
+    for start in range(0, ids_y.shape[0], batch_size):
+        batch_ids_y = ids_y[start:start + batch_size]
+        batch_ids_x = ids_x[start:start + batch_size]
+        X = _gather_from_view(view, batch_ids_y, batch_ids_x, X_index)
+        if y_index is None:
+            y = None
+        else:
+            y = _gather_from_view(view, batch_ids_y, batch_ids_x, y_index)
+        yield X, y
+
+
+def get_tile_batches_from_padded_array(
+    padded: np.ndarray, tile_coords: np.ndarray, tile_y: int, tile_x: int,
+    batch_size: int, band_map: Optional[dict] = None, *args, **kwargs
+) -> Generator:
+    """
+    Yields `(X, y)` batches of shape `(B, C, tile_y, tile_x)` in the order of
+    `tile_coords` (which is already permuted when tiles are shuffled). Each 
+    batch is gathered from a strided view of `padded`, so the only copy made 
+    is the batch itself. When `band_map` is `None` the whole band axis is 
+    returned as `X` and `y` is `None`.
+    """
+    tile_view = get_tile_view_from_padded_array(padded, tile_y, tile_x)
+    tile_coords = np.asarray(tile_coords)
+    yield from _get_batches_from_view(
+        tile_view, tile_coords[:, 0] // tile_y, tile_coords[:, 1] // tile_x,
+        batch_size, band_map
+    )
+
+
+def get_window_padded_size(raster_size: int, window_size: int, stride: int) -> int:
+    """
+    Smallest size `>= raster_size` covered exactly by windows of 
+    `window_size` pixels placed every `stride` pixels.
+    """
+    if raster_size <= window_size:
+        return window_size
+    return window_size + round_up(raster_size - window_size, stride)
+
+
+def get_window_id_mapping(
+    raster_y: int, raster_x: int, window_y: int, window_x: int, 
+    stride_y: int, stride_x: int, *args, **kwargs
+) -> np.ndarray:
+    """
+    Returns the `(uly, ulx)` pixel offsets of every (possibly overlapping) 
+    window covering a `raster_y` by `raster_x` raster, in row-major order.
+    """
+    padded_y = get_window_padded_size(raster_y, window_y, stride_y)
+    padded_x = get_window_padded_size(raster_x, window_x, stride_x)
+    y_window_ids = np.arange(0, padded_y - window_y + 1, stride_y)
+    x_window_ids = np.arange(0, padded_x - window_x + 1, stride_x)
+    window_coords = np.stack(
+        np.meshgrid(y_window_ids, x_window_ids, indexing="ij"), axis=-1
+    ).reshape(-1, 2)
+    return window_coords
+
+
+def get_window_view_from_padded_array(
+    padded: np.ndarray, window_y: int, window_x: int, stride_y: int, 
+    stride_x: int, *args, **kwargs
+) -> np.ndarray:
+    """
+    Returns a read-only, zero-copy view of `padded` with shape 
+    `(n_windows_y, n_windows_x, C, window_y, window_x)` such that 
+    `view[uly // stride_y, ulx // stride_x]` is the window with upper-left 
+    pixel `(uly, ulx)`. Overlapping windows share memory.
+    """
+    n_channels, padded_y, padded_x = padded.shape
+    assert (padded_y - window_y) % stride_y == 0, \
+        "Windows placed every `stride_y` pixels must exactly cover the padded array."
+    assert (padded_x - window_x) % stride_x == 0, \
+        "Windows placed every `stride_x` pixels must exactly cover the padded array."
+    n_windows_y = (padded_y - window_y) // stride_y + 1
+    n_windows_x = (padded_x - window_x) // stride_x + 1
+    channel_stride, y_stride, x_stride = padded.strides
+    return np.lib.stride_tricks.as_strided(
+        padded, 
+        shape=(n_windows_y, n_windows_x, n_channels, window_y, window_x),
+        strides=(
+            y_stride * stride_y, x_stride * stride_x, channel_stride, 
+            y_stride, x_stride
+        ),
+        writeable=False
+    )
+
+
+def get_window_batches_from_padded_array(
+    padded: np.ndarray, window_coords: np.ndarray, window_y: int, 
+    window_x: int, stride_y: int, stride_x: int, batch_size: int, 
+    band_map: Optional[dict] = None, *args, **kwargs
+) -> Generator:
+    """
+    Overlapping-window counterpart of `get_tile_batches_from_padded_array`.
+    """
+    window_view = get_window_view_from_padded_array(
+        padded, window_y, window_x, stride_y, stride_x
+    )
+    window_coords = np.asarray(window_coords)
+    yield from _get_batches_from_view(
+        window_view, window_coords[:, 0] // stride_y, 
+        window_coords[:, 1] // stride_x, batch_size, band_map
+    )
+
+
+def get_window_weights(
+    window_y: int, window_x: int, blend: Optional[str] = "linear", 
+    min_weight: Optional[float] = 1e-3
+) -> np.ndarray:
+    """
+    Per-pixel blending weights for a window. `"uniform"` averages overlapping
+    predictions; `"linear"` and `"hann"` down-weight pixels near the window 
+    edges, where predictions are least reliable. Weights are floored at 
+    `min_weight` so pixels covered by a single window remain defined.
+    """
+    if blend == "uniform":
+        return np.ones((window_y, window_x), dtype=np.float32)
+    elif blend == "linear":
+        def ramp(n: int) -> np.ndarray:
+            ramp = np.arange(1, n + 1, dtype=np.float32)
+            return np.minimum(ramp, ramp[::-1]) / np.ceil(n / 2)
+    elif blend == "hann":
+        def ramp(n: int) -> np.ndarray:
+            return np.hanning(n + 2)[1:-1].astype(np.float32)
+    else:
+        raise ValueError(f"Blend {blend} not recognized.")
+    weights = np.outer(ramp(window_y), ramp(window_x))
+    return np.maximum(weights, min_weight).astype(np.float32)
+
+
+class PredictionStitcher:
+    """
+    Accumulates per-pixel predictions made on overlapping windows into a
+    weighted average over the whole raster. Windows must be added in the 
+    row-major order of `get_window_id_mapping`, so once a window starting at
+    row `uly` arrives no later window covers the rows above it. Sums are 
+    kept for a rolling band of `block_y + window_y` rows and each block of 
+    `block_y` finished rows is normalized and written to `dataset` as soon 
+    as the band must move past it, so memory does not grow with the raster 
+    height. Without a `dataset`, normalized blocks are held until 
+    `write_to_dataset` is called, which costs one full-resolution array of 
+    `accumulator_dtype`.
+    """
+    def __init__(
+        self, raster_y: int, raster_x: int, window_y: int, window_x: int,
+        stride_y: int, stride_x: int, n_bands: Optional[int] = 1, 
+        blend: Optional[str] = "linear", padded_y: Optional[int] = None, 
+        padded_x: Optional[int] = None, accumulator_dtype = np.float32,
+        block_y: Optional[int] = 256, dataset: Optional[gdal.Dataset] = None,
+        array_dtype = None
+    ):
+        if padded_y is None:
+            padded_y = max(raster_y, window_y)
+        if padded_x is None:
+            padded_x = max(raster_x, window_x)
+        self.raster_y = raster_y
+        self.raster_x = raster_x
+        self.window_y = window_y
+        self.window_x = window_x
+        self.stride_y = stride_y
+        self.stride_x = stride_x
+        self.n_bands = n_bands
+        self.block_y = block_y
+        self.dataset = dataset
+        self.array_dtype = array_dtype
+        self.weights = get_window_weights(window_y, window_x, blend=blend)
+        # Windows in the same phase are at least a window apart, so they 
+        # never overlap and can be accumulated with one fancy-indexed add
+        self._n_phases_y = -(-window_y // stride_y)
+        self._n_phases_x = -(-window_x // stride_x)
+
+        band_y = block_y + window_y
+        self._sums = np.zeros((n_bands, band_y, padded_x), dtype=accumulator_dtype)
+        self._weight_sums = np.zeros((band_y, padded_x), dtype=accumulator_dtype)
+        # Raster row held in the first row of the band
+        self._yoff = 0
+        self._last_uly = 0
+        self._blocks = list()
+
+
+    def _flush_block(self) -> None:
+        """
+        Normalizes the first `block_y` rows of the band, writes (or holds) 
+        those inside the raster and moves the band down by `block_y` rows.
+        """
+        n_rows = min(self.block_y, self.raster_y - self._yoff)
+        if n_rows > 0:
+            sums = self._sums[:, :n_rows, :self.raster_x]
+            weight_sums = self._weight_sums[:n_rows, :self.raster_x]
+            block = np.zeros_like(sums)
+            np.divide(sums, weight_sums, out=block, where=weight_sums > 0)
+            if self.array_dtype is not None:
+                block = block.astype(self.array_dtype)
+            if self.dataset is not None:
+                raster_io.write_block_to_dataset(
+                    block, self.dataset, xoff=0, yoff=self._yoff
+                )
+            else:
+                self._blocks.append((self._yoff, block))
+        self._sums[:, :-self.block_y] = self._sums[:, self.block_y:]
+        self._sums[:, -self.block_y:] = 0
+        self._weight_sums[:-self.block_y] = self._weight_sums[self.block_y:]
+        self._weight_sums[-self.block_y:] = 0
+        self._yoff += self.block_y
+
+
+    def add(self, window_coords: np.ndarray, preds: np.ndarray) -> None:
+        """
+        `preds` has shape `(B, n_bands, window_y, window_x)` (or 
+        `(B, window_y, window_x)` when `n_bands == 1`) and is aligned with 
+        the `B` rows of `window_coords`.
+        """
+        window_coords = np.asarray(window_coords)
+        preds = np.asarray(preds)
+        if preds.ndim == 3:
+            preds = preds[:, np.newaxis]
+        assert preds.shape[0] == len(window_coords), \
+            "`preds` and `window_coords` must have the same length."
+        if not len(window_coords):
+            return
+        uly, ulx = window_coords[:, 0], window_coords[:, 1]
+        assert uly[0] >= self._last_uly and np.all(np.diff(uly) >= 0), \
+            "Windows must be added in row-major order."
+        assert np.all(uly % self.stride_y == 0) and np.all(ulx % self.stride_x == 0), \
+            "Window offsets must be multiples of the strides."
+        weighted = preds * self.weights
+        band_y = self._weight_sums.shape[0]
+        start = 0
+        while start < len(window_coords):
+            # Every row above the first window not yet added is finished
+            while uly[start] >= self._yoff + self.block_y:
+                self._flush_block()
+            # Add the windows which fit in the band
+            stop = np.searchsorted(
+                uly, self._yoff + band_y - self.window_y, side="right"
+            )
+            self._accumulate(
+                uly[start:stop], ulx[start:stop], weighted[start:stop]
+            )
+            start = stop
+        self._last_uly = int(uly[-1])
+
+
+    def _accumulate(
+        self, uly: np.ndarray, ulx: np.ndarray, weighted: np.ndarray
+    ) -> None:
+        rows = (uly - self._yoff)[:, np.newaxis, np.newaxis] \
+            + np.arange(self.window_y)[np.newaxis, :, np.newaxis]
+        cols = ulx[:, np.newaxis, np.newaxis] \
+            + np.arange(self.window_x)[np.newaxis, np.newaxis, :]
+        phases = (uly // self.stride_y) % self._n_phases_y * self._n_phases_x \
+            + (ulx // self.stride_x) % self._n_phases_x
+        for phase in np.unique(phases):
+            in_phase = phases == phase
+            phase_rows, phase_cols = rows[in_phase], cols[in_phase]
+            # (n_bands, B, window_y, window_x)
+            self._sums[:, phase_rows, phase_cols] += \
+                weighted[in_phase].transpose(1, 0, 2, 3)
+            self._weight_sums[phase_rows, phase_cols] += self.weights
+
+
+    def finish(self) -> Optional[gdal.Dataset]:
+        """
+        Flushes the remaining rows once every window has been added.
+        """
+        while self._yoff < self.raster_y:
+            self._flush_block()
+        return self.dataset
+
+
+    def write_to_dataset(
+        self, dataset: gdal.Dataset, array_dtype = None
+    ) -> gdal.Dataset:
+        """
+        Writes the held blocks to `dataset`, for stitchers created without 
+        one.
+        """
+        self.finish()
+        for yoff, block in self._blocks:
+            if array_dtype is not None:
+                block = block.astype(array_dtype)
+            dataset = raster_io.write_block_to_dataset(
+                block, dataset, xoff=0, yoff=yoff
+            )
+        self._blocks = list()
+        return dataset
+
+
 def get_padded_raster_array(
     raster_dataset: gdal.Dataset, tile_y: int, tile_x: int, padded = None, 
     channels_to_write: list = None, array_dtype = np.uint16, *args, **kwargs
@@ -103,7 +502,8 @@ def get_padded_raster_array(
 def get_padded_array_from_multiple_datasets(
     datasets: List[gdal.Dataset], labels: List[bool],
     tile_y: int, tile_x: int, 
-    array_dtype = np.uint16, *args, **kwargs
+    array_dtype = np.uint16, padded_shape: Optional[Tuple[int, int]] = None,
+    *args, **kwargs
 ) -> Tuple[List[gdal.Dataset], np.ndarray]:
     dataset_bands_list = []
     n_bands_total = 0
@@ -115,8 +515,11 @@ def get_padded_array_from_multiple_datasets(
     raster_y = raster_dataset.RasterYSize
     raster_x = raster_dataset.RasterXSize
 
-    padded_y = round_up(raster_y, tile_y)
-    padded_x = round_up(raster_x, tile_x)
+    if padded_shape is None:
+        padded_y = round_up(raster_y, tile_y)
+        padded_x = round_up(raster_x, tile_x)
+    else:
+        padded_y, padded_x = padded_shape
 
     padded = np.zeros((n_bands_total, padded_y, padded_x), dtype=array_dtype) 
 
@@ -147,6 +550,7 @@ def get_tiles(
     tile_x: int, array_dtype, row_major: bool, 
     tile_coords = None, shuffle_tiles: Optional[bool] = False, 
     assert_tile_smaller_than_raster: Optional[bool] = False,
+    pos_only: Optional[bool] = False, non_null_only: Optional[bool] = False,
     *args, **kwargs
 ):
     datasets, padded, band_map = get_padded_array_from_multiple_datasets(
@@ -164,14 +568,95 @@ def get_tiles(
             raster_y, raster_x, tile_y, tile_x, row_major, 
             assert_evenly_divisble=True
         )
+    tile_coords = np.asarray(tile_coords)
     if shuffle_tiles:
         shuffle_indices = np.arange(tile_coords.shape[0])
         np.random.shuffle(shuffle_indices)
         tile_coords = tile_coords[shuffle_indices]
     else:
         shuffle_indices = None
+    keep = get_tile_keep_mask(
+        padded, tile_coords, tile_y, tile_x, band_map, pos_only, non_null_only
+    )
     tiles = get_tiles_from_padded_array(
-        padded, tile_coords, tile_y, tile_x, assert_evenly_divisble=True, 
+        padded, tile_coords[keep], tile_y, tile_x, assert_evenly_divisble=True, 
         *args, **kwargs
     )
-    return datasets, tiles, tile_coords, shuffle_indices, band_map
+    return datasets, tiles, tile_coords, shuffle_indices, band_map, keep
+
+
+@gdal_data_handlers.open_data
+def get_tile_batches(
+    datasets: List[gdal.Dataset], labels: List[bool], tile_y: int, 
+    tile_x: int, array_dtype, row_major: bool, batch_size: int,
+    tile_coords = None, shuffle_tiles: Optional[bool] = False, 
+    assert_tile_smaller_than_raster: Optional[bool] = False,
+    pos_only: Optional[bool] = False, non_null_only: Optional[bool] = False,
+    *args, **kwargs
+):
+    """
+    Batched counterpart of `get_tiles`. Yields `(X, y)` arrays of shape 
+    `(B, C, tile_y, tile_x)` instead of one `(C, tile_y, tile_x)` slice at a 
+    time.
+    """
+    datasets, padded, band_map = get_padded_array_from_multiple_datasets(
+        datasets, labels, tile_y, tile_x, array_dtype, **kwargs
+    )
+    raster_y = padded.shape[-2]
+    raster_x = padded.shape[-1]
+    if assert_tile_smaller_than_raster:
+        assert tile_y <= raster_y, \
+            f"Tile y size {tile_y} is larger than raster y size {raster_y}."
+        assert tile_x <= raster_x, \
+            f"Tile x size {tile_x} is larger than raster x size {raster_x}."
+    if tile_coords is None:
+        tile_coords = get_tile_id_mapping(
+            raster_y, raster_x, tile_y, tile_x, row_major, 
+            assert_evenly_divisble=True
+        )
+    tile_coords = np.asarray(tile_coords)
+    if shuffle_tiles:
+        shuffle_indices = np.arange(tile_coords.shape[0])
+        np.random.shuffle(shuffle_indices)
+        tile_coords = tile_coords[shuffle_indices]
+    else:
+        shuffle_indices = None
+    keep = get_tile_keep_mask(
+        padded, tile_coords, tile_y, tile_x, band_map, pos_only, non_null_only
+    )
+    batches = get_tile_batches_from_padded_array(
+        padded, tile_coords[keep], tile_y, tile_x, batch_size, band_map, 
+        *args, **kwargs
+    )
+    return datasets, batches, tile_coords, shuffle_indices, band_map, keep
+
+
+@gdal_data_handlers.open_data
+def get_window_batches(
+    datasets: List[gdal.Dataset], labels: List[bool], window_y: int, 
+    window_x: int, stride_y: int, stride_x: int, array_dtype, batch_size: int,
+    *args, **kwargs
+):
+    """
+    Yields `(X, y)` batches of overlapping windows with shape 
+    `(B, C, window_y, window_x)`, read from a strided view of one padded 
+    array.
+    """
+    raster_y = datasets[0].RasterYSize
+    raster_x = datasets[0].RasterXSize
+    padded_shape = (
+        get_window_padded_size(raster_y, window_y, stride_y),
+        get_window_padded_size(raster_x, window_x, stride_x)
+    )
+    datasets, padded, band_map = get_padded_array_from_multiple_datasets(
+        datasets, labels, window_y, window_x, array_dtype, 
+        padded_shape=padded_shape, **kwargs
+    )
+    window_coords = get_window_id_mapping(
+        raster_y, raster_x, window_y, window_x, stride_y, stride_x
+    )
+    batches = get_window_batches_from_padded_array(
+        padded, window_coords, window_y, window_x, stride_y, stride_x, 
+        batch_size, band_map, *args, **kwargs
+    )
+    return datasets, batches, window_coords, padded_shape, band_map
@@ -0,0 +1,188 @@
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+__doc__ = """
+This module contains an in-memory spatial index over the features of a vector
+layer. Features are ingested once and bucketed by envelope into a uniform
+grid, so that the features intersecting a grid cell can be found, and
+rasterized, at a cost which depends on the local feature density rather than
+on the total number of features in the layer.
+"""
+
+from typing import Optional
+
+import numpy as np
+from osgeo import ogr
+
+ogr.UseExceptions()
+
+
+# Features whose envelopes span more buckets than this are checked on every
+# query instead of being copied into each bucket
+DEFAULT_MAX_BUCKETS_PER_FEATURE = 64
+
+
+class FeatureIndex:
+    """
+    Bucket-grid index over the envelopes of the features of one layer of
+    `datasource`. The bucket size defaults to the median feature extent, so
+    most features fall in one to four buckets.
+    """
+    def __init__(
+        self, datasource: ogr.DataSource, layer_index: Optional[int] = 0,
+        bucket_size: Optional[float] = None,
+        max_buckets_per_feature: Optional[int] = DEFAULT_MAX_BUCKETS_PER_FEATURE
+    ):
+        layer = datasource.GetLayerByIndex(layer_index)
+        self.layer_name = layer.GetName()
+        srs = layer.GetSpatialRef()
+        self.srs = srs.Clone() if srs is not None else None
+        self.geom_type = layer.GetGeomType()
+        layer_defn = layer.GetLayerDefn()
+        self.field_defns = [
+            layer_defn.GetFieldDefn(i) for i in range(layer_defn.GetFieldCount())
+        ]
+
+        self.features = list()
+        envelopes = list()
+        layer.ResetReading()
+        for feature in layer:
+            geometry = feature.GetGeometryRef()
+            if geometry is None or geometry.IsEmpty():
+                continue
+            self.features.append(feature.Clone())
+            envelopes.append(geometry.GetEnvelope())
+        layer.ResetReading()
+        # Columns are (minx, maxx, miny, maxy), the order of `GetEnvelope`
+        self.envelopes = np.asarray(envelopes, dtype=np.float64).reshape(-1, 4)
+        self._build_buckets(bucket_size, max_buckets_per_feature)
+
+
+    def __len__(self) -> int:
+        return len(self.features)
+
+
+    def _build_buckets(
+        self, bucket_size: Optional[float], max_buckets_per_feature: int
+    ) -> None:
+        envelopes = self.envelopes
+        if not len(envelopes):
+            self.bucket_size = 1.0
+            self.origin = (0.0, 0.0)
+            self.n_bucket_rows = 1
+            self.bucket_keys = np.empty(0, dtype=np.int64)
+            self.bucket_starts = np.empty(0, dtype=np.int64)
+            self.bucket_ids = np.empty(0, dtype=np.int64)
+            self.large_ids = np.empty(0, dtype=np.int64)
+            return
+        minx, maxx = envelopes[:, 0], envelopes[:, 1]
+        miny, maxy = envelopes[:, 2], envelopes[:, 3]
+        if bucket_size is None:
+            bucket_size = float(np.median(np.maximum(maxx - minx, maxy - miny)))
+        if not bucket_size > 0:
+            # Points: spread the layer extent over roughly one feature per bucket
+            extent = max(maxx.max() - minx.min(), maxy.max() - miny.min())
+            bucket_size = extent / max(np.sqrt(len(envelopes)), 1.0) or 1.0
+        self.bucket_size = bucket_size
+        self.origin = (float(minx.min()), float(miny.min()))
+
+        col_0, col_1, row_0, row_1 = self._get_bucket_ranges(minx, maxx, miny, maxy)
+        self.n_bucket_rows = int(row_1.max()) + 1
+        n_cols, n_rows = col_1 - col_0 + 1, row_1 - row_0 + 1
+        counts = n_cols * n_rows
+        small = counts <= max_buckets_per_feature
+        self.large_ids = np.flatnonzero(~small)
+
+        # Expand every small feature into one (bucket, feature) pair per bucket
+        small_ids = np.flatnonzero(small)
+        counts = counts[small]
+        feature_ids = np.repeat(small_ids, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        n_cols = np.repeat(n_cols[small], counts)
+        cols = np.repeat(col_0[small], counts) + offsets % n_cols
+        rows = np.repeat(row_0[small], counts) + offsets // n_cols
+        keys = cols * self.n_bucket_rows + rows
+
+        order = np.argsort(keys, kind="stable")
+        self.bucket_ids = feature_ids[order]
+        self.bucket_keys, self.bucket_starts = np.unique(keys[order], return_index=True)
+
+
+    def _get_bucket_ranges(
+        self, minx: np.ndarray, maxx: np.ndarray, miny: np.ndarray,
+        maxy: np.ndarray
+    ):
+        origin_x, origin_y = self.origin
+        col_0 = np.floor((minx - origin_x) / self.bucket_size).astype(np.int64)
+        col_1 = np.floor((maxx - origin_x) / self.bucket_size).astype(np.int64)
+        row_0 = np.floor((miny - origin_y) / self.bucket_size).astype(np.int64)
+        row_1 = np.floor((maxy - origin_y) / self.bucket_size).astype(np.int64)
+        return col_0, col_1, row_0, row_1
+
+
+    def query(
+        self, minx: float, miny: float, maxx: float, maxy: float
+    ) -> np.ndarray:
+        """
+        Returns the sorted indices of the features whose envelopes intersect
+        the box `(minx, miny, maxx, maxy)`, given in the layer's coordinates.
+        """
+        if not len(self.features):
+            return np.empty(0, dtype=np.int64)
+        col_0, col_1, row_0, row_1 = (
+            int(v) for v in self._get_bucket_ranges(
+                np.float64(minx), np.float64(maxx), np.float64(miny), np.float64(maxy)
+            )
+        )
+        col_0, row_0 = max(col_0, 0), max(row_0, 0)
+        row_1 = min(row_1, self.n_bucket_rows - 1)
+        candidates = [self.large_ids]
+        if col_0 <= col_1 and row_0 <= row_1:
+            cols, rows = np.meshgrid(
+                np.arange(col_0, col_1 + 1), np.arange(row_0, row_1 + 1), indexing="ij"
+            )
+            keys = (cols * self.n_bucket_rows + rows).ravel()
+            positions = np.searchsorted(self.bucket_keys, keys)
+            found = positions < len(self.bucket_keys)
+            found[found] = self.bucket_keys[positions[found]] == keys[found]
+            bucket_ends = np.append(self.bucket_starts[1:], len(self.bucket_ids))
+            for position in positions[found]:
+                candidates.append(
+                    self.bucket_ids[self.bucket_starts[position]:bucket_ends[position]]
+                )
+        candidates = np.unique(np.concatenate(candidates))
+        envelopes = self.envelopes[candidates]
+        hits = (envelopes[:, 0] <= maxx) & (envelopes[:, 1] >= minx) \
+            & (envelopes[:, 2] <= maxy) & (envelopes[:, 3] >= miny)
+        return candidates[hits]
+
+
+    def make_datasource(self, feature_ids: np.ndarray) -> ogr.DataSource:
+        """
+        Copies the features `feature_ids` into a new in-memory datasource
+        with the same schema and spatial reference as the indexed layer.
+        """
+        driver = ogr.GetDriverByName("Memory")
+        datasource = driver.CreateDataSource("")
+        layer = datasource.CreateLayer(
+            self.layer_name, srs=self.srs, geom_type=self.geom_type
+        )
+        for field_defn in self.field_defns:
+            layer.CreateField(field_defn)
+        layer_defn = layer.GetLayerDefn()
+        for feature_id in feature_ids:
+            feature = ogr.Feature(layer_defn)
+            feature.SetFrom(self.features[feature_id])
+            layer.CreateFeature(feature)
+            feature = None
+        return datasource
+
+
+    def filter(
+        self, minx: float, miny: float, maxx: float, maxy: float
+    ) -> ogr.DataSource:
+        """
+        Returns an in-memory datasource containing only the features which
+        intersect the box `(minx, miny, maxx, maxy)`.
+        """
+        return self.make_datasource(self.query(minx, miny, maxx, maxy))
@@ -0,0 +1,129 @@
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+__doc__ = """
+This module contains a manager of GDAL `/vsimem` virtual files. Every file it
+hands out has a unique path, so datasets decoded concurrently in different
+threads never share a virtual file, and is tracked until it is unlinked so
+that leaked files can be found.
+"""
+
+import contextlib
+import itertools
+import logging
+import os
+import threading
+import uuid
+from typing import Dict, Generator, Optional
+
+from osgeo import gdal
+
+gdal.UseExceptions()
+
+
+VSIMEM_PREFIX = "/vsimem/"
+
+
+class VSIMemManager:
+    """
+    Hands out unique `/vsimem` paths and unlinks them when the block using
+    them exits, including on error.
+    """
+    def __init__(self, prefix: Optional[str] = VSIMEM_PREFIX):
+        # Unique per manager, so separate processes and managers never collide
+        self.root = prefix + uuid.uuid4().hex + "/"
+        self._counter = itertools.count()
+        self._live_paths = set()
+        self._lock = threading.Lock()
+
+
+    def make_path(
+        self, name: Optional[str] = "dataset", suffix: Optional[str] = ".tif"
+    ) -> str:
+        """
+        Returns a new, unique `/vsimem` path and starts tracking it. The
+        file is only created when something is written to it.
+        """
+        name = os.path.splitext(os.path.basename(str(name)))[0] or "dataset"
+        path = f"{self.root}{next(self._counter)}_{name}{suffix}"
+        with self._lock:
+            self._live_paths.add(path)
+        return path
+
+
+    def unlink(self, path: str) -> None:
+        with self._lock:
+            self._live_paths.discard(path)
+        if gdal.VSIStatL(path) is not None:
+            gdal.Unlink(path)
+
+
+    @contextlib.contextmanager
+    def temp_path(
+        self, name: Optional[str] = "dataset", suffix: Optional[str] = ".tif"
+    ) -> Generator:
+        """
+        Yields a unique `/vsimem` path which is unlinked on exit.
+        """
+        path = self.make_path(name=name, suffix=suffix)
+        try:
+            yield path
+        finally:
+            self.unlink(path)
+
+
+    @contextlib.contextmanager
+    def from_buffer(
+        self, buffer, name: Optional[str] = "dataset",
+        suffix: Optional[str] = ".tif"
+    ) -> Generator:
+        """
+        Copies `buffer` (any object supporting the buffer protocol) into a
+        unique `/vsimem` file, yields its path and unlinks it on exit.
+        """
+        with self.temp_path(name=name, suffix=suffix) as path:
+            gdal.FileFromMemBuffer(path, buffer)
+            yield path
+
+
+    def get_live_files(self) -> Dict[str, int]:
+        """
+        Returns the size in bytes of every tracked file which has not been
+        unlinked.
+        """
+        with self._lock:
+            paths = sorted(self._live_paths)
+        live_files = dict()
+        for path in paths:
+            stat = gdal.VSIStatL(path)
+            live_files[path] = stat.size if stat is not None else 0
+        return live_files
+
+
+    def log_live_files(self) -> None:
+        live_files = self.get_live_files()
+        logging.info(
+            f"{len(live_files)} live /vsimem files using " \
+            f"{sum(live_files.values())} bytes."
+        )
+        for path, size in live_files.items():
+            logging.debug(f"Live /vsimem file {path}: {size} bytes.")
+
+
+VSIMEM_MANAGER = VSIMemManager()
+
+
+def temp_path(
+    name: Optional[str] = "dataset", suffix: Optional[str] = ".tif"
+):
+    return VSIMEM_MANAGER.temp_path(name=name, suffix=suffix)
+
+
+def from_buffer(
+    buffer, name: Optional[str] = "dataset", suffix: Optional[str] = ".tif"
+):
+    return VSIMEM_MANAGER.from_buffer(buffer, name=name, suffix=suffix)
+
+
+def get_live_files() -> Dict[str, int]:
+    return VSIMEM_MANAGER.get_live_files()
@@ -1,7 +1,11 @@
 __author__ = "Richard Correro (richard@richardcorrero.com)"
 
 
-from typing import AsyncGenerator, Iterable, Optional
+import asyncio
+import concurrent.futures
+import queue
+import threading
+from typing import AsyncGenerator, Generator, Iterable, Optional, Tuple
 
 import aiohttp
 from light_pipe import AsyncGatherer
@@ -42,3 +46,138 @@ class AiohttpGatherer(AsyncGatherer):
             async for result in results:
                 yield result
         await self.session.close()
+
+
+class BoundedAsyncGatherer(AsyncGatherer):
+    """
+    Awaits at most `max_in_flight` tasks at a time, pulling a new item from 
+    the upstream iterable each time a task completes. The event loop runs 
+    in a background thread so in-flight tasks keep making progress while 
+    downstream stages consume results; at most `max_queued_results` finished 
+    results are buffered before the loop waits on the consumer. Upstream 
+    items are pulled in a separate thread, so slow upstream stages never 
+    block the loop. If the consumer stops early the loop cancels its tasks 
+    and exits.
+    """
+    # Seconds between checks of whether the consumer has stopped
+    STOP_POLL_INTERVAL: float = 0.1
+
+    def __init__(
+        self, max_in_flight: Optional[int] = 64, 
+        max_queued_results: Optional[int] = None
+    ):
+        assert max_in_flight is not None and max_in_flight > 0, \
+            "`max_in_flight` must be a positive integer."
+        if max_queued_results is None:
+            max_queued_results = max_in_flight
+        self.max_in_flight = max_in_flight
+        self.max_queued_results = max_queued_results
+
+
+    async def _async_gen(
+        self, iterable: Iterable, **kwargs
+    ) -> AsyncGenerator:
+        loop = asyncio.get_running_loop()
+        iterable = iter(iterable)
+        exhausted = object()
+        pending = set()
+        pull = None
+        # The upstream iterable is only ever advanced by this one thread
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as puller:
+            try:
+                while True:
+                    if pull is None and exhausted is not None \
+                        and len(pending) < self.max_in_flight:
+                        pull = loop.run_in_executor(puller, next, iterable, exhausted)
+                    if pull is None and not pending:
+                        break
+                    waiting = pending if pull is None else pending | {pull}
+                    done, _ = await asyncio.wait(
+                        waiting, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if pull is not None and pull in done:
+                        done.discard(pull)
+                        pulled, pull = pull.result(), None
+                        if pulled is exhausted:
+                            exhausted = None
+                        else:
+                            f, item, args, wkwargs = pulled
+                            f = self._make_async_decorator(f)
+                            pending.add(asyncio.ensure_future(
+                                f(item, *args, **kwargs, **wkwargs)
+                            ))
+                    pending -= done
+                    for task in done:
+                        yield task.result()
+            finally:
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    await asyncio.gather(*pending, return_exceptions=True)
+
+
+    def _put(
+        self, results: queue.Queue, result: Tuple, stop: threading.Event
+    ) -> bool:
+        """
+        Puts `result` on `results`, giving up (and returning False) if the 
+        consumer stops first.
+        """
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=self.STOP_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+    def _run_loop(
+        self, iterable: Iterable, results: queue.Queue, stop: threading.Event
+    ) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        async def produce():
+            async_results = self._async_gen(iterable)
+            try:
+                async for result in async_results:
+                    # Blocks in an executor thread so in-flight tasks keep running
+                    put = await loop.run_in_executor(
+                        None, self._put, results, (False, result), stop
+                    )
+                    if not put:
+                        break
+            finally:
+                await async_results.aclose()
+
+        error = None
+        try:
+            loop.run_until_complete(produce())
+        except BaseException as e:
+            error = e
+        finally:
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
+            self._put(results, (True, error), stop)
+
+
+    def __call__(self, iterable: Iterable) -> Generator:
+        results = queue.Queue(maxsize=self.max_queued_results)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._run_loop, args=(iterable, results, stop), daemon=True
+        )
+        thread.start()
+        try:
+            while True:
+                finished, result = results.get()
+                if finished:
+                    if result is not None:
+                        raise result
+                    break
+                yield result
+        finally:
+            # Also reached if the consumer closes this generator early
+            stop.set()
+            thread.join()
@@ -0,0 +1,119 @@
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+import logging
+import threading
+import time
+
+from osgeo import gdal
+
+gdal.UseExceptions()
+
+
+def estimate_dataset_bytes(dataset: gdal.Dataset) -> int:
+    """
+    Returns the decoded size of `dataset` from its dimensions, band count
+    and data type.
+    """
+    if dataset is None or not dataset.RasterCount:
+        return 0
+    dtype_bytes = gdal.GetDataTypeSize(dataset.GetRasterBand(1).DataType) // 8
+    return dataset.RasterXSize * dataset.RasterYSize * dataset.RasterCount * dtype_bytes
+
+
+class MemoryReservation:
+    def __init__(self, nbytes: int):
+        self.nbytes = nbytes
+        self.released = False
+
+
+class MemoryGovernor:
+    """
+    Admits work only while the total memory reserved for it stays under
+    `budget_bytes`. Callers block in `acquire` (and `resize`) until enough
+    memory has been released, which applies backpressure to whatever feeds
+    them. A request is always admitted if no other reservation could free
+    memory for it, so a single scene larger than the budget still runs.
+    """
+    __name__ = "MemoryGovernor"
+
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = int(budget_bytes)
+
+        self.used_bytes = 0
+        self.peak_bytes = 0
+        self.num_waits = 0
+        self.wait_seconds = 0.0
+
+        self._num_holders = 0
+        self._num_waiting_holders = 0
+        self._cond = threading.Condition()
+
+
+    def _wait(self, predicate) -> None:
+        if predicate():
+            self.num_waits += 1
+            start = time.monotonic()
+            while predicate():
+                self._cond.wait()
+            self.wait_seconds += time.monotonic() - start
+
+
+    def _add(self, nbytes: int) -> None:
+        self.used_bytes += nbytes
+        self.peak_bytes = max(self.peak_bytes, self.used_bytes)
+
+
+    def acquire(self, nbytes: int) -> MemoryReservation:
+        nbytes = max(int(nbytes), 0)
+        with self._cond:
+            self._wait(
+                lambda: self.used_bytes + nbytes > self.budget_bytes \
+                    and self._num_holders > 0
+            )
+            self._add(nbytes)
+            self._num_holders += 1
+        return MemoryReservation(nbytes)
+
+
+    def resize(self, reservation: MemoryReservation, nbytes: int) -> None:
+        """
+        Changes the size of a held reservation, e.g. once a scene's header
+        has been read. Growing waits until the extra memory is available or
+        every other holder is itself waiting to grow.
+        """
+        nbytes = max(int(nbytes), 0)
+        with self._cond:
+            assert not reservation.released, "Cannot resize a released reservation."
+            delta = nbytes - reservation.nbytes
+            if delta > 0:
+                self._num_waiting_holders += 1
+                try:
+                    self._wait(
+                        lambda: self.used_bytes + delta > self.budget_bytes \
+                            and self._num_holders > self._num_waiting_holders
+                    )
+                finally:
+                    self._num_waiting_holders -= 1
+            self._add(delta)
+            reservation.nbytes = nbytes
+            self._cond.notify_all()
+
+
+    def release(self, reservation: MemoryReservation) -> None:
+        with self._cond:
+            if reservation.released:
+                return
+            reservation.released = True
+            self.used_bytes -= reservation.nbytes
+            self._num_holders -= 1
+            self._cond.notify_all()
+
+
+    def log_stats(self) -> None:
+        logging.info(
+            f"Memory governor: peak of {self.peak_bytes / 1e9:.2f} GB reserved " \
+            f"out of a {self.budget_bytes / 1e9:.2f} GB budget; waited " \
+            f"{self.num_waits} times for {self.wait_seconds:.1f} s."
+        )
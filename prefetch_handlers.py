@@ -0,0 +1,239 @@
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+import contextlib
+import logging
+import os
+import threading
+import time
+from typing import Generator, Optional
+
+from osgeo import gdal
+
+from light_pipe_geo import vsimem
+from memory_handlers import (MemoryGovernor, MemoryReservation,
+                             estimate_dataset_bytes)
+from storage_handlers import StorageHandler
+
+gdal.UseExceptions()
+
+
+class PrefetchedScene:
+    """
+    A scene fetched ahead of time: either a path to open in place, a
+    `/vsimem` copy of a remote file, or a decoded in-memory dataset. Calling
+    `open()` returns a context manager yielding the dataset, which frees the
+    prefetched copy on exit.
+    """
+    def __init__(
+        self, prefetcher: "ScenePrefetcher", path: str,
+        vsi_path: Optional[str] = None, dataset: Optional[gdal.Dataset] = None,
+        copy_bytes: Optional[int] = 0
+    ):
+        self.prefetcher = prefetcher
+        self.path = path
+        self.vsi_path = vsi_path
+        self.dataset = dataset
+        # Size of the copy of the scene held in memory until it is tiled
+        self.copy_bytes = copy_bytes
+        self.reservation = None
+        self.ready_time = time.monotonic()
+
+
+    def estimate_bytes(self) -> int:
+        """
+        Estimates the memory the scene needs: its in-memory copy plus its
+        decoded size, which bounds the blocks GDAL caches and the grid cell
+        datasets cut from it. Only the header is read. A decoded scene is its
+        own in-memory copy, so it is only counted once.
+        """
+        if self.dataset is not None:
+            return estimate_dataset_bytes(self.dataset)
+        if self.vsi_path is not None:
+            dataset = gdal.Open(self.vsi_path)
+            decoded_bytes = estimate_dataset_bytes(dataset)
+            dataset = None
+        else:
+            with self.prefetcher.storage_handler.open_as_gdal_dataset(self.path) as dataset:
+                decoded_bytes = estimate_dataset_bytes(dataset)
+        return self.copy_bytes + decoded_bytes
+
+
+    @contextlib.contextmanager
+    def open(self) -> Generator:
+        self.prefetcher._on_open(self)
+        dataset = None
+        try:
+            if self.dataset is not None:
+                dataset, self.dataset = self.dataset, None
+                yield dataset
+            elif self.vsi_path is not None:
+                dataset = gdal.Open(self.vsi_path)
+                yield dataset
+            else:
+                with self.prefetcher.storage_handler.open_as_gdal_dataset(self.path) as dataset:
+                    yield dataset
+        finally:
+            dataset = None
+            self.release()
+            self.prefetcher._on_close(self)
+
+
+    def release(self) -> None:
+        self.dataset = None
+        if self.vsi_path is not None:
+            vsimem.VSIMEM_MANAGER.unlink(self.vsi_path)
+        self.prefetcher._release_reservation(self)
+
+
+class ScenePrefetcher:
+    """
+    Fetches the image and UDM of upcoming assets while the current asset is
+    being tiled. Run `fetch_asset` under a `BlockingThreadPooler` whose
+    `queue_size` is the lookahead. Remote scenes are downloaded into
+    `/vsimem`; if `decode`, scenes are also decoded into in-memory datasets.
+
+    The time the tiler spends waiting for a fetch to finish (stall time)
+    and the time fetched assets spend waiting for the tiler (idle time) are
+    recorded: a run is I/O-bound if the former dominates and CPU-bound if
+    the latter does.
+
+    If a `governor` is passed, each asset reserves its estimated footprint
+    before it is handed to the tiler and releases it once both of its 
+    scenes are closed, so fetching stalls while the budget is used up.
+    """
+    __name__ = "ScenePrefetcher"
+
+
+    def __init__(
+        self, storage_handler: StorageHandler, decode: Optional[bool] = False,
+        governor: Optional[MemoryGovernor] = None
+    ):
+        self.storage_handler = storage_handler
+        self.decode = decode
+        self.governor = governor
+        self._num_unreleased_scenes = dict()
+
+        self.num_fetched = 0
+        self.stall_seconds = 0.0
+        self.idle_seconds = 0.0
+
+        self._num_open = 0
+        self._last_close_time = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def fetch_scene(
+        self, path: str, reservation: Optional[MemoryReservation] = None
+    ) -> PrefetchedScene:
+        if self.decode:
+            with self.storage_handler.open_as_gdal_dataset(path) as dataset:
+                if reservation is not None:
+                    # Blocks until the decoded scene fits in the budget, 
+                    # before it is decoded
+                    self.governor.resize(
+                        reservation, 
+                        reservation.nbytes + estimate_dataset_bytes(dataset)
+                    )
+                decoded = gdal.Translate("", dataset, format="MEM")
+            return PrefetchedScene(self, path, dataset=decoded)
+        if self.storage_handler.IS_REMOTE:
+            name, suffix = os.path.splitext(os.path.basename(path))
+            vsi_path = vsimem.VSIMEM_MANAGER.make_path(name=name, suffix=suffix)
+            try:
+                copy_bytes = self.storage_handler.download_to_vsimem(path, vsi_path)
+            except Exception:
+                vsimem.VSIMEM_MANAGER.unlink(vsi_path)
+                raise
+            return PrefetchedScene(self, path, vsi_path=vsi_path, copy_bytes=copy_bytes)
+        # Local files are opened in place when they are tiled
+        return PrefetchedScene(self, path)
+
+
+    def _reserve(self, paths) -> Optional[MemoryReservation]:
+        if self.governor is None:
+            return None
+        # Remote scenes are copied into memory before their headers can be 
+        # read, so their file sizes are reserved first
+        copy_bytes = 0
+        if self.storage_handler.IS_REMOTE:
+            copy_bytes = sum(self.storage_handler.get_size(path) for path in paths)
+        return self.governor.acquire(copy_bytes)
+
+
+    def _release_reservation(self, scene: PrefetchedScene) -> None:
+        reservation, scene.reservation = scene.reservation, None
+        if reservation is None:
+            return
+        with self._lock:
+            self._num_unreleased_scenes[id(reservation)] -= 1
+            done = not self._num_unreleased_scenes[id(reservation)]
+            if done:
+                del self._num_unreleased_scenes[id(reservation)]
+        if done:
+            self.governor.release(reservation)
+
+
+    def fetch_asset(self, input):
+        asset_id, geojson, img_path, udm_path = input
+        reservation = self._reserve([img_path, udm_path])
+        try:
+            img_scene = self.fetch_scene(img_path, reservation=reservation)
+        except Exception:
+            if reservation is not None:
+                self.governor.release(reservation)
+            raise
+        scenes = [img_scene]
+        try:
+            udm_scene = self.fetch_scene(udm_path, reservation=reservation)
+            scenes.append(udm_scene)
+            if reservation is not None:
+                with self._lock:
+                    self._num_unreleased_scenes[id(reservation)] = len(scenes)
+                for scene in scenes:
+                    scene.reservation = reservation
+                # Blocks until the asset's full footprint fits in the budget.
+                # Decoded scenes only shrink their reservation here, as the 
+                # copies they were decoded from have been freed
+                self.governor.resize(
+                    reservation, sum(scene.estimate_bytes() for scene in scenes)
+                )
+        except Exception:
+            for scene in scenes:
+                scene.release()
+            if reservation is not None:
+                self.governor.release(reservation)
+            raise
+        # The asset is ready once both of its scenes are
+        img_scene.ready_time = udm_scene.ready_time = time.monotonic()
+        with self._lock:
+            self.num_fetched += 1
+        return asset_id, geojson, img_scene.open, udm_scene.open
+
+
+    def _on_open(self, scene: PrefetchedScene) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if self._num_open == 0:
+                # The tiler has been idle since the last scene was closed
+                self.stall_seconds += max(0.0, min(scene.ready_time, now) - self._last_close_time)
+                self.idle_seconds += max(0.0, now - scene.ready_time)
+            self._num_open += 1
+
+
+    def _on_close(self, scene: PrefetchedScene) -> None:
+        with self._lock:
+            self._num_open -= 1
+            if self._num_open == 0:
+                self._last_close_time = time.monotonic()
+
+
+    def log_stats(self) -> None:
+        if self.governor is not None:
+            self.governor.log_stats()
+        bound = "I/O" if self.stall_seconds > self.idle_seconds else "CPU"
+        logging.info(
+            f"Prefetched {self.num_fetched} assets. The tiler waited " \
+            f"{self.stall_seconds:.1f} s for fetches and fetched assets waited " \
+            f"{self.idle_seconds:.1f} s for the tiler ({bound}-bound)."
+        )
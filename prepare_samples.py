@@ -13,6 +13,9 @@ SCRIPT_PATH = os.path.basename(__file__)
 
 DEFAULT_IMAGERY_TYPE = PlanetScope.__name__
 DEFAULT_DATASET_DIR = "datasets/"
+DEFAULT_PREFETCH_SCENES = 2
+DEFAULT_PREFETCH_DECODE = False
+DEFAULT_MEMORY_BUDGET_GB = None # No limit
 
 IMAGERY_HANDLERS = {
     PlanetScope.__name__: PlanetScope,
@@ -49,6 +52,26 @@ def parse_args():
     parser.add_argument(
         "--src-base-dir",
     )
+    parser.add_argument(
+        "--prefetch-scenes",
+        default=DEFAULT_PREFETCH_SCENES,
+        type=int,
+        help="Number of assets to fetch ahead of the one being tiled. Pass " \
+            "0 to fetch each asset only when it is tiled."
+    )
+    parser.add_argument(
+        "--prefetch-decode",
+        default=DEFAULT_PREFETCH_DECODE
+    )
+    parser.add_argument(
+        "--memory-budget-gb",
+        default=DEFAULT_MEMORY_BUDGET_GB,
+        type=float,
+        help="Memory which prefetched and in-progress scenes may use. " \
+            "Fetching pauses while the estimated footprint of the scenes " \
+            "in flight would exceed it. Ignored (with a warning) when " \
+            "`--prefetch-scenes` is 0."
+    )
     p_args, _ = parser.parse_known_args()
     return p_args    
 
@@ -83,6 +106,9 @@ def main():
     train = arg_is_true(args["train"])
     from_cloud_storage = arg_is_true(args["from_cloud_storage"])
     src_base_dir = args["src_base_dir"]
+    prefetch_scenes = int(args["prefetch_scenes"])
+    prefetch_decode = arg_is_true(args["prefetch_decode"])
+    memory_budget_gb = args["memory_budget_gb"]
 
     args = get_args(
         script_path=SCRIPT_PATH, log_filepath=log_filepath, **args, 
@@ -94,7 +120,9 @@ def main():
     
     img_handler.prepare_samples(
         manifest_path=manifest_path, train=train, 
-        from_cloud_storage=from_cloud_storage, src_base_dir=src_base_dir
+        from_cloud_storage=from_cloud_storage, src_base_dir=src_base_dir,
+        prefetch_scenes=prefetch_scenes, prefetch_decode=prefetch_decode,
+        memory_budget_gb=memory_budget_gb
     )
 
     logging.info(
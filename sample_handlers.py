@@ -2,16 +2,24 @@ __author__ = "Richard Correro (richard@richardcorrero.com)"
 
 
 import argparse
+import contextlib
+import datetime
+import hashlib
 import io
 import json
+import logging
+import os
+import threading
 from typing import Generator, List
 
 import numpy as np
 from light_pipe import Data, Optional, Transformer
-from osgeo import gdal, ogr
+from osgeo import gdal, gdal_array, ogr
+from PIL import Image
 
-from light_pipe_geo import gridding, mercantile
-from script_utils import get_random_string
+from light_pipe_geo import (gridding, mercantile, raster_io, spectral, temporal,
+                            vector_index, vsimem)
+from script_utils import arg_is_true
 from storage_handlers import StorageHandler
 
 gdal.UseExceptions()
@@ -32,6 +40,11 @@ class QuadKeyTileHandler(SampleHandler):
     __name__ = "QuadKeyTileHandler"
 
     TILES_MANIFEST_NAME = "tiles_manifest.json"
+    COMPOSITES_MANIFEST_NAME = "composites_manifest.json"
+    COMPOSITES_SUB_DIR = "composites/"
+    NEGATIVES_MANIFEST_NAME = "negatives_dropped.json"
+
+    NEGATIVE_POLICIES = ["all", "ratio", "none"]
 
     def __init__(
         self
@@ -39,12 +52,101 @@ class QuadKeyTileHandler(SampleHandler):
 
         args = self.parse_args()
 
+        spectral_indices = args["spectral_indices"]
+        if spectral_indices is None:
+            spectral_indices = list()
+        for index_name in spectral_indices:
+            assert spectral.can_compute_index(
+                index_name, spectral.PLANETSCOPE_4_BAND_MAP
+            ), f"Spectral index {index_name} not recognized."
+        self.spectral_indices = spectral_indices
+        self.temporal_cube_dir = args["temporal_cube_dir"]
+        self.min_clear_fraction = float(args["min_clear_fraction"])
+        self.num_cloudy_tiles_skipped = 0
+
+        # Target GeoJSONs are shared by every asset of an order, so each is
+        # indexed once
+        self._target_indices = dict()
+        self._target_indices_lock = threading.Lock()
+
+        self.negative_policy = args["negative_policy"]
+        assert self.negative_policy in self.NEGATIVE_POLICIES, \
+            f"Negative policy {self.negative_policy} not recognized."
+        self.negative_keep_ratio = float(args["negative_keep_ratio"])
+        assert 0.0 <= self.negative_keep_ratio <= 1.0, \
+            "`--negative-keep-ratio` must be between 0 and 1."
+        self.negative_seed = int(args["negative_seed"])
+        self.num_negatives_dropped = dict()
+        self.use_overviews = arg_is_true(args["use_overviews"])
+        self.composite_method = args["composite_method"]
+        self.composite_window = args["composite_window"]
+        if self.composite_method:
+            assert self.composite_method in temporal.COMPOSITE_METHODS, \
+                f"Compositing method {self.composite_method} not recognized."
+            assert self.temporal_cube_dir, \
+                "`--temporal-cube-dir` must be set to make composites."
+
         self.args = args        
 
 
     def parse_args(self):
         parser = argparse.ArgumentParser()
-        # @TODO: Add args
+        parser.add_argument(
+            "--spectral-indices",
+            nargs="+",
+            default=None,
+            help="Spectral indices to compute from each analytic tile and " \
+                "save as colormapped PNGs."
+        )
+        parser.add_argument(
+            "--temporal-cube-dir",
+            default=None,
+            help="Local directory in which to build one appendable " \
+                "(T, C, H, W) time series per quadkey. Reusing it across " \
+                "runs appends new acquisitions to the existing series."
+        )
+        parser.add_argument(
+            "--min-clear-fraction",
+            default=0.0,
+            type=float,
+            help="Tiles whose UDM marks less than this fraction of pixels " \
+                "as clear are skipped before their image and label are cut."
+        )
+        parser.add_argument(
+            "--negative-policy",
+            default="all",
+            help="Which all-null (negative) training tiles to save: `all`, " \
+                "`none`, or a seeded `ratio` of them."
+        )
+        parser.add_argument(
+            "--negative-keep-ratio",
+            default=1.0,
+            type=float
+        )
+        parser.add_argument(
+            "--negative-seed",
+            default=0,
+            type=int
+        )
+        parser.add_argument(
+            "--use-overviews",
+            default=False,
+            help="If true, scenes are cut into grid cells coarser than " \
+                "their pixels from overviews. Overviews are built for local and " \
+                "decoded scenes; other in-memory scenes use only those they have."
+        )
+        parser.add_argument(
+            "--composite-method",
+            default=None,
+            help="One of `median`, `best_pixel` or `latest_clear`. If set, " \
+                "one cloud-free composite per quadkey and time window is " \
+                "saved from its temporal cube."
+        )
+        parser.add_argument(
+            "--composite-window",
+            default="month",
+            help="One of `month`, `quarter`, `year` or `all`."
+        )
         args = super().parse_args(parser=parser)
         return args
 
@@ -61,67 +163,82 @@ class QuadKeyTileHandler(SampleHandler):
             yield tile             
 
 
+    def get_target_index(self, geojson: dict) -> vector_index.FeatureIndex:
+        geojson_bytes = json.dumps(geojson, sort_keys=True).encode('utf-8')
+        digest = hashlib.sha256(geojson_bytes).hexdigest()
+        with self._target_indices_lock:
+            if digest not in self._target_indices:
+                geojson_ds = ogr.Open(geojson_bytes)
+                self._target_indices[digest] = vector_index.FeatureIndex(geojson_ds)
+                geojson_ds = None
+            return self._target_indices[digest]
+
+
     # @TODO: IMPLEMENT THIS
     def make_tile_datasets(
         self, input, pixel_x_meters: Optional[float] = 3.0, 
         pixel_y_meters: Optional[float] = -3.0, train: Optional[bool] = True
     ):
-        asset_id, geojson, img_bs, udm_bs, tiles = input
+        asset_id, geojson, img_src, udm_src, tiles = input
         if train:
-            geojson_bytes = json.dumps(geojson).encode('utf-8')
-            geojson_ds = ogr.Open(geojson_bytes)
-        img_ds_gen = self._bytes_to_dataset(img_bs)
-        img_ds = next(img_ds_gen)
-
-        udm_ds_gen = self._bytes_to_dataset(udm_bs)
-        udm_ds = next(udm_ds_gen)
-        for tile in tiles:
-            zoom = tile.z
-
-            quad_key = mercantile.quadkey(tile)
-
-            # out_sub_dir = os.path.join(
-            #     tiles_dir, "zoom_" + str(zoom), quad_key + '/'
-            # )
-            # os.makedirs(out_sub_dir, exist_ok=True)
-            # out_udm_path = os.path.join(out_sub_dir, f"{asset_id}_udm.tif")
-            # out_target_path = os.path.join(out_sub_dir, f"{asset_id}_target.tif")
-            # out_geotiff_path = os.path.join(out_sub_dir, f"{asset_id}_geotiff.tif")
-
-            # Make datasets
-            if train:
-                qkey, (geojson_grid_cell_dataset, _, _) = gridding.make_grid_cell_dataset(
-                    grid_cell=tile, datum=geojson_ds, return_filepaths=False, is_label=True, 
+            target_index = self.get_target_index(geojson)
+        # Scenes are closed (and any in-memory copies freed) once every tile 
+        # has been cut, or if cutting fails
+        with self._open_dataset(img_src) as img_ds, \
+            self._open_dataset(udm_src) as udm_ds:
+            for tile in tiles:
+                zoom = tile.z
+
+                quad_key = mercantile.quadkey(tile)
+
+                # out_sub_dir = os.path.join(
+                #     tiles_dir, "zoom_" + str(zoom), quad_key + '/'
+                # )
+                # os.makedirs(out_sub_dir, exist_ok=True)
+                # out_udm_path = os.path.join(out_sub_dir, f"{asset_id}_udm.tif")
+                # out_target_path = os.path.join(out_sub_dir, f"{asset_id}_target.tif")
+                # out_geotiff_path = os.path.join(out_sub_dir, f"{asset_id}_geotiff.tif")
+
+                # The single-band UDM is cut first so that tiles which are too 
+                # cloudy are skipped before the image and label are cut
+                qkey, (udm_grid_cell_dataset, _, _) = gridding.make_grid_cell_dataset(
+                    grid_cell=tile, datum=udm_ds, return_filepaths=False, is_label=True, 
                     in_memory=True, pixel_x_meters=pixel_x_meters, pixel_y_meters=pixel_y_meters,
-                    # grid_cell_filepath=out_target_path
+                    # grid_cell_filepath=out_udm_path,
+                    no_data_value=1, use_overviews=self.use_overviews
                 )
+                clear_fraction = self.get_clear_fraction(udm_grid_cell_dataset)
+                if clear_fraction < self.min_clear_fraction:
+                    self.num_cloudy_tiles_skipped += 1
+                    udm_grid_cell_dataset = None
+                    continue
+
+                # Make datasets
+                if train:
+                    # GeoJSON coordinates are longitude and latitude (RFC 7946), 
+                    # so only the targets within the tile's bounds are rasterized
+                    west, south, east, north = mercantile.bounds(tile)
+                    geojson_ds = target_index.filter(west, south, east, north)
+                    qkey, (geojson_grid_cell_dataset, _, _) = gridding.make_grid_cell_dataset(
+                        grid_cell=tile, datum=geojson_ds, return_filepaths=False, is_label=True, 
+                        in_memory=True, pixel_x_meters=pixel_x_meters, pixel_y_meters=pixel_y_meters,
+                        # grid_cell_filepath=out_target_path
+                    )
+                    geojson_ds = None
     
-            qkey, (geotiff_grid_cell_dataset, _, _) = gridding.make_grid_cell_dataset(
-                    grid_cell=tile, datum=img_ds, return_filepaths=False, is_label=False, 
-                    in_memory=True, pixel_x_meters=pixel_x_meters, pixel_y_meters=pixel_y_meters,
-                    # grid_cell_filepath=out_geotiff_path
-            )
-
-            qkey, (udm_grid_cell_dataset, _, _) = gridding.make_grid_cell_dataset(
-                grid_cell=tile, datum=udm_ds, return_filepaths=False, is_label=True, 
-                in_memory=True, pixel_x_meters=pixel_x_meters, pixel_y_meters=pixel_y_meters,
-                # grid_cell_filepath=out_udm_path,
-                no_data_value=1
-            )
-            if not train:
-                yield zoom, quad_key, asset_id, None, \
-                    geotiff_grid_cell_dataset, udm_grid_cell_dataset
-            else:
-                yield zoom, quad_key, asset_id, geojson_grid_cell_dataset, \
-                    geotiff_grid_cell_dataset, udm_grid_cell_dataset
-        
-        try:
-            next(img_ds_gen)
-            next(udm_ds_gen)
-        except StopIteration:
-            pass
+                qkey, (geotiff_grid_cell_dataset, _, _) = gridding.make_grid_cell_dataset(
+                        grid_cell=tile, datum=img_ds, return_filepaths=False, is_label=False, 
+                        in_memory=True, pixel_x_meters=pixel_x_meters, pixel_y_meters=pixel_y_meters,
+                        # grid_cell_filepath=out_geotiff_path
+                        use_overviews=self.use_overviews
+                )
 
-        geojson_ds = None
+                if not train:
+                    yield zoom, quad_key, asset_id, None, \
+                        geotiff_grid_cell_dataset, udm_grid_cell_dataset, clear_fraction
+                else:
+                    yield zoom, quad_key, asset_id, geojson_grid_cell_dataset, \
+                        geotiff_grid_cell_dataset, udm_grid_cell_dataset, clear_fraction
 
 
     def make_synthetic_masks(
@@ -129,7 +246,7 @@ class QuadKeyTileHandler(SampleHandler):
         binary: Optional[bool] = True
     ):
         zoom, quad_key, asset_id, geojson_grid_cell_dataset, \
-            geotiff_grid_cell_dataset, udm_grid_cell_dataset = input
+            geotiff_grid_cell_dataset, udm_grid_cell_dataset, clear_fraction = input
         # Write new synthetic mask to `out_target_path`
         udm_arr = udm_grid_cell_dataset.ReadAsArray()
         dataset =  geojson_grid_cell_dataset
@@ -153,7 +270,7 @@ class QuadKeyTileHandler(SampleHandler):
             all_null = False
 
         return all_null, zoom, quad_key, asset_id, geojson_grid_cell_dataset, \
-            geotiff_grid_cell_dataset, udm_grid_cell_dataset
+            geotiff_grid_cell_dataset, udm_grid_cell_dataset, clear_fraction
 
 
     def _get_tiles_from_bytes(self, input, zooms, truncate):
@@ -163,6 +280,31 @@ class QuadKeyTileHandler(SampleHandler):
         return asset_id, geojson, img_bs, udm_bs, tiles       
 
 
+    def keep_negative(self, zoom: int, quad_key: str, asset_id: str) -> bool:
+        """
+        Decides whether to keep an all-null tile. The `ratio` policy hashes 
+        the tile with `self.negative_seed`, so the same tiles are kept 
+        regardless of the order in which they are processed.
+        """
+        if self.negative_policy == "all":
+            return True
+        if self.negative_policy == "none":
+            return False
+        digest = hashlib.blake2b(
+            f"{self.negative_seed}/{zoom}/{quad_key}/{asset_id}".encode('utf-8'),
+            digest_size=8
+        ).digest()
+        return int.from_bytes(digest, "big") / 2 ** 64 < self.negative_keep_ratio
+
+
+    def _apply_negative_policy(self, input) -> Generator:
+        all_null, zoom, quad_key, asset_id = input[:4]
+        if all_null and not self.keep_negative(zoom, quad_key, asset_id):
+            self.num_negatives_dropped[zoom] = self.num_negatives_dropped.get(zoom, 0) + 1
+            return
+        yield input
+
+
     def _save_samples(
         self, input, save_dir: str, tiles_dir: str, storage_handler: StorageHandler,
         train: Optional[bool] = True
@@ -174,10 +316,10 @@ class QuadKeyTileHandler(SampleHandler):
         """
         if train:
             all_null, zoom, quad_key, asset_id, geojson_grid_cell_dataset, \
-                geotiff_grid_cell_dataset, udm_grid_cell_dataset = input
+                geotiff_grid_cell_dataset, udm_grid_cell_dataset, clear_fraction = input
         else:
             zoom, quad_key, asset_id, geojson_grid_cell_dataset, \
-                geotiff_grid_cell_dataset, udm_grid_cell_dataset = input
+                geotiff_grid_cell_dataset, udm_grid_cell_dataset, clear_fraction = input
 
         out_sub_dir = storage_handler.join_paths(
             save_dir, tiles_dir, "zoom_" + str(zoom), quad_key + '/'
@@ -190,19 +332,161 @@ class QuadKeyTileHandler(SampleHandler):
             storage_handler.set_from_gdal_mem_dataset(out_target_path, geojson_grid_cell_dataset)
         storage_handler.set_from_gdal_mem_dataset(out_udm_path, udm_grid_cell_dataset)
         storage_handler.set_from_gdal_mem_dataset(out_geotiff_path, geotiff_grid_cell_dataset)
-        return all_null, zoom, quad_key, asset_id, out_udm_path, out_target_path, out_geotiff_path             
+        out_index_paths = self._save_spectral_indices(
+            geotiff_grid_cell_dataset, out_sub_dir=out_sub_dir, asset_id=asset_id,
+            storage_handler=storage_handler
+        )
+        return all_null, zoom, quad_key, asset_id, out_udm_path, out_target_path, \
+            out_geotiff_path, out_index_paths, clear_fraction             
+
+
+    def _save_spectral_indices(
+        self, dataset: gdal.Dataset, out_sub_dir: str, asset_id: str, 
+        storage_handler: StorageHandler
+    ) -> dict:
+        """
+        Computes every index in `self.spectral_indices` from a single read of
+        `dataset` and saves each as a colormapped PNG.
+        """
+        out_index_paths = dict()
+        if not self.spectral_indices:
+            return out_index_paths
+        array = dataset.ReadAsArray()
+        indices = spectral.compute_indices(
+            array, self.spectral_indices, band_map=spectral.PLANETSCOPE_4_BAND_MAP,
+            scale=spectral.PLANETSCOPE_SR_SCALE
+        )
+        for index_name, rgba in spectral.colormap_indices(indices).items():
+            bs = io.BytesIO()
+            Image.fromarray(rgba, mode="RGBA").save(fp=bs, format="png")
+            out_index_path = storage_handler.join_paths(
+                out_sub_dir, f"{asset_id}_{index_name}.png"
+            )
+            storage_handler.set_from_bytes(out_index_path, bs)
+            out_index_paths[index_name] = out_index_path
+        return out_index_paths
+
+
+    @staticmethod
+    def get_clear_fraction(
+        udm_dataset: gdal.Dataset, clear_value: Optional[int] = 0
+    ) -> float:
+        udm_arr = udm_dataset.ReadAsArray()
+        return float(np.mean(temporal.get_clear_mask(udm_arr, clear_value=clear_value)))
+
+
+    @staticmethod
+    def get_acquisition_time(asset_id: str) -> Optional[str]:
+        """
+        Parses the acquisition time from PlanetScope asset IDs of the form 
+        `YYYYMMDD_HHMMSS_...`. Returns None if `asset_id` is not of this form.
+        """
+        try:
+            acquired = datetime.datetime.strptime(asset_id[:15], "%Y%m%d_%H%M%S")
+        except ValueError:
+            return None
+        return acquired.isoformat()
+
+
+    def _append_to_temporal_cube(
+        self, input, cube_dir: str, tiles_dir: str, train: Optional[bool] = True
+    ):
+        """
+        Appends the image and UDM of a tile to the temporal cube of its 
+        quadkey and passes `input` through unchanged.
+        """
+        if train:
+            _, zoom, quad_key, asset_id, _, \
+                geotiff_grid_cell_dataset, udm_grid_cell_dataset, _ = input
+        else:
+            zoom, quad_key, asset_id, _, \
+                geotiff_grid_cell_dataset, udm_grid_cell_dataset, _ = input
+        cube_path = os.path.join(cube_dir, tiles_dir, "zoom_" + str(zoom), quad_key)
+        array = geotiff_grid_cell_dataset.ReadAsArray()
+        if array.ndim == 2:
+            array = array[np.newaxis]
+        cube = temporal.TemporalCube(cube_path)
+        cube.append(
+            array, udm_grid_cell_dataset.ReadAsArray(),
+            timestamps=self.get_acquisition_time(asset_id), asset_ids=asset_id,
+            geotransform=geotiff_grid_cell_dataset.GetGeoTransform(),
+            projection=geotiff_grid_cell_dataset.GetProjection()
+        )
+        return input
+
+
+    def make_composites(
+        self, quad_keys: List[tuple], save_dir: str, tiles_dir: str,
+        storage_handler: StorageHandler
+    ) -> dict:
+        """
+        Composites the temporal cube of each `(zoom, quad_key)` over every 
+        time window, masking unclear pixels with the UDM, and saves one 
+        GeoTIFF per window.
+        """
+        results_dict = dict()
+        driver = gdal.GetDriverByName("MEM")
+        for zoom, quad_key in quad_keys:
+            cube_path = os.path.join(
+                self.temporal_cube_dir, tiles_dir, "zoom_" + str(zoom), quad_key
+            )
+            temporal_cube = temporal.TemporalCube(cube_path)
+            index = temporal_cube.read_index()
+            if index is None:
+                continue
+            cube, udm, timestamps, _ = temporal_cube.read()
+            composites = temporal.composite_by_window(
+                cube, udm, timestamps, method=self.composite_method,
+                window=self.composite_window
+            )
+            out_sub_dir = storage_handler.join_paths(
+                save_dir, tiles_dir, "zoom_" + str(zoom), quad_key + '/', 
+                self.COMPOSITES_SUB_DIR
+            )
+            quad_key_dict = results_dict.setdefault(zoom, dict()).setdefault(quad_key, dict())
+            for window_name, (composite, num_clear) in composites.items():
+                n_bands, raster_y, raster_x = composite.shape
+                dataset = raster_io.make_dataset(
+                    driver, "", raster_x, raster_y, n_bands,
+                    gdal_array.NumericTypeCodeToGDALTypeCode(composite.dtype),
+                    index["geotransform"], index["projection"]
+                )
+                raster_io.write_array_to_dataset(composite, dataset)
+                out_path = storage_handler.join_paths(
+                    out_sub_dir, f"{window_name}_{self.composite_method}.tif"
+                )
+                storage_handler.set_from_gdal_mem_dataset(out_path, dataset)
+                dataset = None
+                quad_key_dict[window_name] = {
+                    "composite": out_path.replace("\\", "/"),
+                    "clear_fraction": float(np.mean(num_clear > 0)),
+                    "mean_num_clear": float(np.mean(num_clear))
+                }
+        return results_dict
+
+
+    def _open_dataset(self, source) -> contextlib.AbstractContextManager:
+        """
+        Opens a scene passed either as a zero-argument callable returning a 
+        context manager (e.g. a bound `open_as_gdal_dataset`) or as bytes.
+        """
+        if callable(source):
+            return source()
+        return contextlib.contextmanager(self._bytes_to_dataset)(source)
 
 
     def _bytes_to_dataset(
-        self, bs: io.BytesIO, vsi_path: str = '/vsimem/tiffinmem' + get_random_string()
+        self, bs: io.BytesIO, name: Optional[str] = "tiffinmem"
     ) -> Generator:
+        # Each call gets its own virtual file, which is unlinked even if the
+        # consumer fails, so scenes can be decoded concurrently
         bs.seek(0)
-        gdal.FileFromMemBuffer(vsi_path, bs.getbuffer()) 
-        ds = gdal.Open(vsi_path)
-        yield ds
-        
-        del(ds)
-        gdal.Unlink(vsi_path)
+        with vsimem.from_buffer(bs.getbuffer(), name=name) as vsi_path:
+            ds = gdal.Open(vsi_path)
+            try:
+                yield ds
+            finally:
+                ds = None
 
 
     def make_samples(
@@ -218,22 +502,58 @@ class QuadKeyTileHandler(SampleHandler):
         if train:
             data >> Transformer(self.make_synthetic_masks)
 
+        if self.temporal_cube_dir:
+            data >> Transformer(
+                self._append_to_temporal_cube, cube_dir=self.temporal_cube_dir,
+                tiles_dir=tiles_dir, train=train
+            )
+
+        if train and self.negative_policy != "all":
+            # Dropped tiles are never written
+            data >> Transformer(self._apply_negative_policy)
+
         data >> Transformer(
             self._save_samples, save_dir=save_dir, tiles_dir=tiles_dir,
             train=train, storage_handler=storage_handler
         )
 
         results = data(block=True)
+        # Every scene should have been unlinked by now
+        if vsimem.get_live_files():
+            vsimem.VSIMEM_MANAGER.log_live_files()
+        if self.num_cloudy_tiles_skipped:
+            logging.info(
+                f"Skipped {self.num_cloudy_tiles_skipped} tiles with a UDM " \
+                f"clear fraction below {self.min_clear_fraction}."
+            )
+        if train and self.negative_policy != "all":
+            logging.info(
+                f"Dropped negative tiles per zoom: {self.num_negatives_dropped}"
+            )
+            negatives_bs = io.BytesIO(
+                json.dumps(self.num_negatives_dropped).encode('utf-8')
+            )
+            negatives_manifest_path = storage_handler.join_paths(
+                save_dir, self.NEGATIVES_MANIFEST_NAME
+            )
+            storage_handler.set_from_bytes(negatives_manifest_path, negatives_bs)
         results_dict = dict()
         for result in results:
-            all_null, zoom, quad_key, asset_id, out_udm_path, out_target_path, out_geotiff_path = result
+            all_null, zoom, quad_key, asset_id, out_udm_path, out_target_path, \
+                out_geotiff_path, out_index_paths, clear_fraction = result
             paths_dict = {
                 "target": out_target_path.replace("\\", "/"),
                 "image": out_geotiff_path.replace("\\", "/"),
                 "udm": out_udm_path.replace("\\", "/"),
                 "all_null": all_null,
+                "clear_fraction": clear_fraction,
 
             }
+            if out_index_paths:
+                paths_dict["indices"] = {
+                    index_name: path.replace("\\", "/") 
+                    for index_name, path in out_index_paths.items()
+                }
             if zoom not in results_dict.keys():
                 results_dict[zoom] = dict()
             zoom_dict = results_dict[zoom]
@@ -245,7 +565,22 @@ class QuadKeyTileHandler(SampleHandler):
         results_bs = json.dumps(results_dict).encode('utf-8')
         results_bs = io.BytesIO(results_bs)
         samples_manifest_path = storage_handler.join_paths(save_dir, self.TILES_MANIFEST_NAME)
-        storage_handler.set_from_bytes(samples_manifest_path, results_bs)  
+        storage_handler.set_from_bytes(samples_manifest_path, results_bs)
+
+        if self.composite_method:
+            quad_keys = [
+                (zoom, quad_key) for zoom, zoom_dict in results_dict.items()
+                for quad_key in zoom_dict.keys()
+            ]
+            composites_dict = self.make_composites(
+                quad_keys, save_dir=save_dir, tiles_dir=tiles_dir,
+                storage_handler=storage_handler
+            )
+            composites_bs = io.BytesIO(json.dumps(composites_dict).encode('utf-8'))
+            composites_manifest_path = storage_handler.join_paths(
+                save_dir, self.COMPOSITES_MANIFEST_NAME
+            )
+            storage_handler.set_from_bytes(composites_manifest_path, composites_bs)  
 
 
 class StandardTileHandler(SampleHandler):
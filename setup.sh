@@ -29,7 +29,8 @@ conda create --name $CONDAENV --file $SETUPFILE
 conda run -n $CONDAENV pip3 install light-pipe \
     && pip3 install aiohttp \
     && pip3 install Pillow \
-    && pip3 install google-cloud-storage
+    && pip3 install google-cloud-storage \
+    && pip3 install pyarrow
 
 ### GCloud Setup
 # gcloud init --no-browser      
\ No newline at end of file
@@ -2,6 +2,7 @@ __author__ = "Richard Correro (richard@richardcorrero.com)"
 
 
 import argparse
+import contextlib
 import io
 import os
 from pathlib import Path
@@ -10,11 +11,33 @@ from typing import Generator, List, Optional, Union
 from google.cloud import storage
 from osgeo import gdal
 
+from light_pipe_geo import vsimem
+
 gdal.UseExceptions()
 
+
+class VSIFileWriter:
+    """
+    Minimal writable file object over a GDAL virtual file, so that downloads
+    can be streamed directly into `/vsimem`.
+    """
+    def __init__(self, vsi_file):
+        self.vsi_file = vsi_file
+
+
+    def write(self, bs) -> int:
+        bs = bytes(bs)
+        written = gdal.VSIFWriteL(bs, 1, len(bs), self.vsi_file)
+        assert written == len(bs), "Failed to write to virtual file."
+        return written
+
+
 class StorageHandler:
     __name__ = "StorageHandler"
 
+    # Whether reading a file requires downloading it first
+    IS_REMOTE: bool = False
+
 
     def parse_args(self, parser: argparse.ArgumentParser) -> dict:
         args, _ = parser.parse_known_args()
@@ -76,6 +99,23 @@ class LocalStorage(StorageHandler):
         return path, bs
 
 
+    def get_size(self, path) -> int:
+        return os.path.getsize(path)
+
+
+    @contextlib.contextmanager
+    def open_as_gdal_dataset(self, path) -> Generator:
+        """
+        Opens the file at `path` in place. GDAL reads blocks from disk as 
+        they are needed, so the scene is never copied into memory.
+        """
+        dataset = gdal.Open(str(path))
+        try:
+            yield dataset
+        finally:
+            dataset = None
+
+
     def set_from_bytes(self, path, bs):
         os.makedirs(os.path.dirname(path), exist_ok=True)
         with open(path, "wb") as f:
@@ -108,6 +148,8 @@ class LocalStorage(StorageHandler):
 class GCSStorage(StorageHandler):
     __name__ = "GCSStorage"     
 
+    IS_REMOTE: bool = True
+
 
     def __init__(self):
         args = self.parse_args()
@@ -153,18 +195,55 @@ class GCSStorage(StorageHandler):
     def get_as_bytes(self, path):
         bucket = self.client.get_bucket(self.bucket)
         blob = bucket.blob(path)
-        bytes = blob.download_as_bytes()
 
         bs = io.BytesIO()
-
-        # If you're deserializing from a bytestring:
-        bs.write(bytes)
-        # Or if you're deserializing from JSON:
-        # bs.write(json.loads(serialized_as_json).encode('latin-1'))
+        # Stream into the buffer instead of holding a second copy as `bytes`
+        blob.download_to_file(bs)
         bs.seek(0)
         return path, bs          
 
 
+    def get_size(self, path) -> int:
+        blob = self.client.bucket(self.bucket).get_blob(path)
+        assert blob is not None, f"Blob {path} not found in bucket {self.bucket}."
+        return blob.size
+
+
+    def download_to_vsimem(self, path, vsi_path: str) -> int:
+        """
+        Streams the blob at `path` into the `/vsimem` file `vsi_path`, which
+        is sized up front. Returns the number of bytes downloaded.
+        """
+        bucket = self.client.bucket(self.bucket)
+        blob = bucket.get_blob(path)
+        assert blob is not None, f"Blob {path} not found in bucket {self.bucket}."
+        vsi_file = gdal.VSIFOpenL(vsi_path, "wb")
+        try:
+            if blob.size:
+                # Allocate once rather than growing while writing
+                gdal.VSIFTruncateL(vsi_file, blob.size)
+            blob.download_to_file(VSIFileWriter(vsi_file))
+        finally:
+            gdal.VSIFCloseL(vsi_file)
+        return blob.size
+
+
+    @contextlib.contextmanager
+    def open_as_gdal_dataset(self, path) -> Generator:
+        """
+        Streams the blob at `path` into a `/vsimem` file, opens it with GDAL
+        and unlinks it on exit. The scene is held in memory once.
+        """
+        name, suffix = os.path.splitext(os.path.basename(path))
+        with vsimem.temp_path(name=name, suffix=suffix) as vsi_path:
+            self.download_to_vsimem(path, vsi_path)
+            dataset = gdal.Open(vsi_path)
+            try:
+                yield dataset
+            finally:
+                dataset = None
+
+
 class AWSStorage(StorageHandler):
     __name__ = "AWSStorage"
 
@@ -0,0 +1,33 @@
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+import itertools
+
+import cache_handlers
+from cache_handlers import BasemapTileCache
+
+
+def test_shared_blob_survives_eviction_of_one_key(tmp_path, monkeypatch):
+    # Strictly increasing access times make the LRU order deterministic
+    clock = itertools.count()
+    monkeypatch.setattr(cache_handlers.time, "time", lambda: float(next(clock)))
+    cache = BasemapTileCache(
+        path=str(tmp_path / "tiles.sqlite3"), max_gb=150 / 1e9
+    )
+    shared = b"s" * 60
+    # LRU order is a, x, b; a and b share one blob
+    cache.set("a", shared)
+    cache.set("x", b"x" * 60)
+    cache.set("b", shared)
+    assert cache._total_bytes == 120
+
+    # Exceeds the limit, so keys are evicted oldest first down to 135 bytes:
+    # evicting a frees nothing as b still references its blob, so x goes too
+    cache.set("c", b"c" * 60)
+    assert cache.num_evictions == 2
+    assert cache.get("a") is None
+    assert cache.get("x") is None
+    assert cache.get("b") == shared
+    assert cache.get("c") == b"c" * 60
+    assert cache._total_bytes == 120
+    cache.close()
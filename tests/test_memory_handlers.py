@@ -0,0 +1,42 @@
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+import threading
+import time
+
+from memory_handlers import MemoryGovernor
+
+
+def test_holders_growing_past_the_budget_both_progress():
+    governor = MemoryGovernor(budget_bytes=100)
+    reservation_a = governor.acquire(40)
+    reservation_b = governor.acquire(40)
+    a_resized = threading.Event()
+    a_grew_before_b_released = list()
+
+    def grow_a():
+        governor.resize(reservation_a, 80)
+        a_resized.set()
+
+    def grow_and_release_b():
+        # Admitted once every other holder is itself waiting to grow
+        governor.resize(reservation_b, 80)
+        # a can only grow once b frees its memory
+        a_grew_before_b_released.append(a_resized.is_set())
+        governor.release(reservation_b)
+
+    thread_a = threading.Thread(target=grow_a, daemon=True)
+    thread_a.start()
+    # Let a start waiting before b grows
+    while not governor._num_waiting_holders:
+        time.sleep(0.001)
+    thread_b = threading.Thread(target=grow_and_release_b, daemon=True)
+    thread_b.start()
+    thread_b.join(timeout=5)
+    thread_a.join(timeout=5)
+    assert not thread_a.is_alive() and not thread_b.is_alive()
+    assert a_grew_before_b_released == [False]
+    assert a_resized.is_set()
+    assert governor.used_bytes == 80
+    governor.release(reservation_a)
+    assert governor.used_bytes == 0
@@ -0,0 +1,63 @@
+__author__ = "Richard Correro (richard@richardcorrero.com)"
+
+
+import numpy as np
+
+from light_pipe_geo import tiling
+
+
+# Image bands on either side of the label band, so neither channel list is
+# contiguous when split by the band map
+BAND_MAP = {False: [0, 2, 3], True: [1]}
+
+
+def _make_padded(n_channels: int, padded_y: int, padded_x: int) -> np.ndarray:
+    return np.arange(
+        n_channels * padded_y * padded_x, dtype=np.float32
+    ).reshape(n_channels, padded_y, padded_x)
+
+
+def _assert_batches_match(batches, padded, coords, size_y, size_x, batch_size):
+    start = 0
+    for X, y in batches:
+        batch_coords = coords[start:start + batch_size]
+        assert X.shape == (len(batch_coords), len(BAND_MAP[False]), size_y, size_x)
+        assert y.shape == (len(batch_coords), len(BAND_MAP[True]), size_y, size_x)
+        for i, (uly, ulx) in enumerate(batch_coords):
+            window = padded[:, uly:uly + size_y, ulx:ulx + size_x]
+            np.testing.assert_array_equal(X[i], window[BAND_MAP[False]])
+            np.testing.assert_array_equal(y[i], window[BAND_MAP[True]])
+        start += len(batch_coords)
+    assert start == len(coords)
+
+
+def test_tile_batches_with_non_contiguous_band_map():
+    tile_y = tile_x = 4
+    padded = _make_padded(4, 16, 12)
+    tile_coords = tiling.get_tile_id_mapping(16, 12, tile_y, tile_x, row_major=True)
+    tile_coords = tile_coords[np.random.default_rng(0).permutation(len(tile_coords))]
+    # Batch sizes both equal to and different from the number of X channels
+    for batch_size in (3, 5):
+        batches = tiling.get_tile_batches_from_padded_array(
+            padded, tile_coords, tile_y, tile_x, batch_size, band_map=BAND_MAP
+        )
+        _assert_batches_match(
+            batches, padded, tile_coords, tile_y, tile_x, batch_size
+        )
+
+
+def test_window_batches_with_non_contiguous_band_map():
+    window_y = window_x = 4
+    stride_y = stride_x = 2
+    padded = _make_padded(4, 10, 12)
+    window_coords = tiling.get_window_id_mapping(
+        10, 12, window_y, window_x, stride_y, stride_x
+    )
+    for batch_size in (3, 7):
+        batches = tiling.get_window_batches_from_padded_array(
+            padded, window_coords, window_y, window_x, stride_y, stride_x,
+            batch_size, band_map=BAND_MAP
+        )
+        _assert_batches_match(
+            batches, padded, window_coords, window_y, window_x, batch_size
+        )
@@ -25,6 +25,15 @@ DEFAULT_SAVE_IMAGES = True
 DEFAULT_TARGET_VALUE = 1
 DEFAULT_FILTER_BY_TARGET_VALUE = True
 
+DEFAULT_MAX_IN_FLIGHT_TILES = 64
+DEFAULT_NUM_ENCODE_WORKERS = None # Defaults to the number of CPUs
+DEFAULT_NUM_WRITE_WORKERS = 4
+
+DEFAULT_RETRY_FAILED = False
+DEFAULT_MAX_FETCH_RETRIES = 3
+DEFAULT_RETRY_BASE_DELAY = 1.0 # Seconds; doubled after every attempt
+TILE_LEDGER_FILENAME = "tile_ledger.jsonl"
+
 IMAGERY_HANDLERS = {
     PlanetScope.__name__: PlanetScope,
     CBERS.__name__: CBERS,
@@ -61,6 +70,13 @@ def parse_args():
         "--fc-index",
         default=None
     )    
+    parser.add_argument(
+        "--local-indices",
+        nargs="+",
+        default=None,
+        help="Spectral indices to compute locally from the RGB basemap " \
+            "tiles, e.g. `vari tgi`."
+    )
     parser.add_argument(
         "--id"
     )  
@@ -92,6 +108,42 @@ def parse_args():
         "--filter-by-target-value",
         default=DEFAULT_FILTER_BY_TARGET_VALUE
     )
+    parser.add_argument(
+        "--max-in-flight-tiles",
+        default=DEFAULT_MAX_IN_FLIGHT_TILES,
+        type=int
+    )
+    parser.add_argument(
+        "--num-encode-workers",
+        default=DEFAULT_NUM_ENCODE_WORKERS,
+        type=int
+    )
+    parser.add_argument(
+        "--num-write-workers",
+        default=DEFAULT_NUM_WRITE_WORKERS,
+        type=int
+    )
+    parser.add_argument(
+        "--tile-ledger-path",
+        default=None,
+        help="Path to the ledger of failed and completed tiles. Defaults to " \
+            f"`{TILE_LEDGER_FILENAME}` in the directory of the dataset ID so " \
+            "that it is shared by all runs with the same `--id`."
+    )
+    parser.add_argument(
+        "--retry-failed",
+        default=DEFAULT_RETRY_FAILED
+    )
+    parser.add_argument(
+        "--max-fetch-retries",
+        default=DEFAULT_MAX_FETCH_RETRIES,
+        type=int
+    )
+    parser.add_argument(
+        "--retry-base-delay",
+        default=DEFAULT_RETRY_BASE_DELAY,
+        type=float
+    )
     p_args, _ = parser.parse_known_args()
     return p_args    
 
@@ -127,6 +179,7 @@ def main():
     zooms = [int(zoom) for zoom in args["zooms"]]
     duration = float(args["duration"])
     false_color_index = args["fc_index"]
+    local_indices = args["local_indices"]
     embed_date = arg_is_true(args["embed_date"])
     make_gifs = arg_is_true(args["make_gifs"])
     save_images = arg_is_true(args["save_images"])
@@ -134,6 +187,17 @@ def main():
 
     preds_csv_path = args["preds_csv_path"]
     target_value = int(args["target_value"])
+    max_in_flight_tiles = int(args["max_in_flight_tiles"])
+    num_encode_workers = args["num_encode_workers"]
+    num_write_workers = int(args["num_write_workers"])
+    retry_failed = arg_is_true(args["retry_failed"])
+    max_fetch_retries = int(args["max_fetch_retries"])
+    retry_base_delay = float(args["retry_base_delay"])
+    tile_ledger_path = args["tile_ledger_path"]
+    if not tile_ledger_path:
+        tile_ledger_path = os.path.join(
+            dataset_super_dir, dataset_id, TILE_LEDGER_FILENAME
+        ).replace("\\", "/")
 
     args = get_args(
         script_path=SCRIPT_PATH, log_filepath=log_filepath, **args, 
@@ -147,7 +211,12 @@ def main():
         start=start, end=end, zooms=zooms, duration=duration, 
         false_color_index=false_color_index, embed_date=embed_date,
         make_gifs=make_gifs, save_images=save_images, preds_csv_path=preds_csv_path,
-        target_value=target_value, filter_by_target_value=filter_by_target_value
+        target_value=target_value, filter_by_target_value=filter_by_target_value,
+        max_in_flight_tiles=max_in_flight_tiles, 
+        num_encode_workers=num_encode_workers, 
+        num_write_workers=num_write_workers, max_fetch_retries=max_fetch_retries,
+        retry_base_delay=retry_base_delay, tile_ledger_path=tile_ledger_path,
+        retry_failed=retry_failed, local_indices=local_indices
     )
 
     logging.info(